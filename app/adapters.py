@@ -0,0 +1,182 @@
+"""
+app/adapters.py
+
+Purpose:
+    Registry of LoRA adapters sharing one base model. Adapters are loaded
+    onto the shared PeftModel by name, picked per request, and loaded or
+    unloaded at runtime (e.g. from the admin endpoints) without reloading
+    the base weights. At most `MAX_LORA_ADAPTERS` are resident; the least
+    recently used idle adapter is evicted to make room, and a known adapter
+    that was evicted is transparently reloaded on its next request.
+
+Inputs:
+    - The shared PeftModel and its GenerationScheduler.
+    - Adapter name -> directory pairs.
+
+Outputs:
+    - `AdapterRegistry.submit`: a scheduler request for the named adapter.
+    - `AdapterRegistry.list`: loaded/known adapters for the admin endpoint.
+"""
+
+from __future__ import annotations
+
+import builtins
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from app.quantization import QUANTIZATION
+
+MAX_LORA_ADAPTERS = int(os.environ.get("MAX_LORA_ADAPTERS", "4"))
+
+_VALID_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class AdapterInUseError(RuntimeError):
+    """
+    Raised when an adapter cannot be unloaded because requests still use it.
+    """
+
+
+class AdapterRegistry:
+    """
+    Name -> LoRA adapter mapping on top of one shared PeftModel.
+    """
+
+    def __init__(self, model, scheduler, max_adapters: int = MAX_LORA_ADAPTERS):
+        self.model = model
+        self.scheduler = scheduler
+        self.max_adapters = max_adapters
+        # Held while checking/loading an adapter and queueing a request for
+        # it, so an eviction can never slip in between the two.
+        self.lock = threading.RLock()
+        # Every known adapter's directory, and the resident ones in LRU order.
+        self._paths: dict[str, str] = {}
+        self._loaded: OrderedDict[str, str] = OrderedDict()
+
+    def register(self, name: str, path: str, loaded: bool = False):
+        """
+        Make `name` known (e.g. the adapter the model was created with).
+        """
+        with self.lock:
+            self._paths[name] = path
+            if loaded:
+                self._loaded[name] = path
+
+    def load(self, name: str, path: str) -> builtins.list[str]:
+        """
+        Load (or replace) adapter `name` from `path`. Returns evicted names.
+        """
+        if not _VALID_NAME.match(name):
+            raise ValueError(
+                f"Invalid adapter name '{name}': use letters, digits, '-' and '_'"
+            )
+        if not os.path.exists(os.path.join(path, "adapter_config.json")):
+            raise FileNotFoundError(f"No LoRA adapter found at '{path}'")
+        if QUANTIZATION == "int8":
+            # PEFT cannot inject into torch's dynamically-quantized linears.
+            raise ValueError(
+                "Loading adapters at runtime needs QUANTIZATION=none or int4"
+            )
+        with self.lock:
+            # Replacing in place may drop the only adapter for a moment, so
+            # it skips unload()'s last-adapter guard (but not the in-use one).
+            previous = self._loaded.get(name)
+            if previous is not None:
+                if name in self.scheduler.adapters_in_use():
+                    raise AdapterInUseError(f"Adapter '{name}' has requests in flight")
+                self._remove(name)
+            evicted = self._make_room()
+            print(f"[adapters] Loading adapter '{name}' from '{path}'...")
+            try:
+                self._load_weights(name, path)
+            except Exception:
+                if previous is not None:
+                    print(f"[adapters] Restoring adapter '{name}' from '{previous}'")
+                    self._load_weights(name, previous)
+                    self._loaded[name] = previous
+                raise
+            self._paths[name] = path
+            self._loaded[name] = path
+            return evicted
+
+    def unload(self, name: str, forget: bool = True):
+        """
+        Remove adapter `name` from the model.
+
+        Raises KeyError if it is not loaded and AdapterInUseError if requests
+        still reference it or it is the only adapter left.
+        """
+        with self.lock:
+            if name not in self._loaded:
+                raise KeyError(name)
+            if name in self.scheduler.adapters_in_use():
+                raise AdapterInUseError(f"Adapter '{name}' has requests in flight")
+            if len(self._loaded) == 1:
+                raise AdapterInUseError("Cannot unload the last loaded adapter")
+            print(f"[adapters] Unloading adapter '{name}'...")
+            self._remove(name)
+            if forget:
+                self._paths.pop(name, None)
+
+    def _load_weights(self, name: str, path: str):
+        with self.scheduler.model_lock:
+            self.model.load_adapter(path, adapter_name=name)
+            self.model.eval()
+
+    def _remove(self, name: str):
+        others = [other for other in self._loaded if other != name]
+        with self.scheduler.model_lock:
+            if others and self.model.active_adapter == name:
+                self.model.set_adapter(others[0])
+            self.model.delete_adapter(name)
+        del self._loaded[name]
+        self.scheduler.forget_adapter(name)
+
+    def _make_room(self) -> builtins.list[str]:
+        evicted = []
+        busy = self.scheduler.adapters_in_use()
+        for name in list(self._loaded):
+            if len(self._loaded) < self.max_adapters:
+                break
+            if name not in busy and len(self._loaded) > 1:
+                self.unload(name, forget=False)
+                evicted.append(name)
+        if len(self._loaded) >= self.max_adapters:
+            raise AdapterInUseError(
+                f"All {self.max_adapters} adapter slots are in use; try again later"
+            )
+        return evicted
+
+    def _ensure(self, name: str):
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return
+        path = self._paths.get(name)
+        if not path:
+            raise KeyError(f"Unknown adapter '{name}'")
+        self.load(name, path)
+
+    def submit(self, adapter: str | None, input_ids, **kwargs):
+        """
+        Queue a request on the shared scheduler for `adapter` (None = base),
+        loading the adapter first if it was evicted.
+        """
+        with self.lock:
+            if adapter is not None:
+                self._ensure(adapter)
+            return self.scheduler.submit(input_ids, adapter=adapter, **kwargs)
+
+    def list(self) -> builtins.list[dict]:
+        with self.lock:
+            busy = self.scheduler.adapters_in_use()
+            return [
+                {
+                    "name": name,
+                    "path": path,
+                    "loaded": name in self._loaded,
+                    "in_use": name in busy,
+                }
+                for name, path in self._paths.items()
+            ]
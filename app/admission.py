@@ -0,0 +1,161 @@
+"""
+app/admission.py
+
+Purpose:
+    Admission control for the generation endpoints. At most
+    `MAX_CONCURRENT_REQUESTS` requests generate at once and at most
+    `MAX_QUEUED_REQUESTS` more wait for a slot; anything beyond that is
+    rejected immediately (429) instead of joining an unbounded backlog.
+    Every request gets a deadline (`REQUEST_TIMEOUT_S`) that covers both the
+    wait for a slot (503 when it runs out) and generation itself, so tail
+    latency under load stays bounded. New requests are also refused (429)
+    while the KV cache is nearly full (see app/kv_blocks.py), so a burst of
+    long sessions queues up or backs off instead of exhausting memory.
+
+Inputs:
+    - `MAX_CONCURRENT_REQUESTS`, `MAX_QUEUED_REQUESTS`, `REQUEST_TIMEOUT_S`
+      env vars.
+    - Optionally a callable returning KV cache utilization (0-1), checked
+      against `KV_ADMISSION_UTILIZATION`.
+
+Outputs:
+    - `AdmissionController.acquire()`: a `Slot` with the request's cancel
+      event and remaining time budget; `release(slot)` cancels and frees it.
+    - `AdmissionRejected`: status code, message and Retry-After hint.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+from app.kv_blocks import KV_ADMISSION_UTILIZATION
+
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "16"))
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", "32"))
+REQUEST_TIMEOUT_S = float(os.environ.get("REQUEST_TIMEOUT_S", "120"))
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is refused before it starts generating.
+    """
+
+    def __init__(self, status_code: int, detail: str, retry_after: int = 1):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+@dataclass
+class Slot:
+    """
+    An admitted request: its deadline and the event that cancels it.
+    """
+
+    deadline: float
+    cancel: threading.Event = field(default_factory=threading.Event)
+    released: bool = False
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.perf_counter())
+
+
+class AdmissionController:
+    """
+    Bounded concurrency + bounded wait queue, shared by all endpoints.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+        max_queued: int = MAX_QUEUED_REQUESTS,
+        timeout: float = REQUEST_TIMEOUT_S,
+        kv_utilization: Callable[[], float] | None = None,
+        max_kv_utilization: float = KV_ADMISSION_UTILIZATION,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.kv_utilization = kv_utilization
+        self.max_kv_utilization = max_kv_utilization
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.kv_rejected = 0
+        self.timed_out = 0
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def _retry_after(self) -> int:
+        # Rough hint: one timeout's worth of work per full round of slots.
+        rounds = 1 + self.waiting // max(1, self.max_concurrent)
+        return max(1, int(rounds * self.timeout / 4))
+
+    async def acquire(self) -> Slot:
+        """
+        Wait for a generation slot, or raise AdmissionRejected.
+
+        The wait counts against the request's deadline; the returned slot
+        carries whatever time budget is left for generation.
+        """
+        # Created lazily so it binds to the server's running event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        slot = Slot(deadline=time.perf_counter() + self.timeout)
+        # Counted rather than asking the semaphore: `wait_for` acquires in a
+        # separate task, so a burst of requests would all see it unlocked.
+        if self.active + self.waiting >= self.max_concurrent + self.max_queued:
+            self.rejected += 1
+            raise AdmissionRejected(
+                429, "Server is busy, try again later", self._retry_after()
+            )
+        if (
+            self.kv_utilization is not None
+            and self.max_kv_utilization > 0
+            and self.kv_utilization() >= self.max_kv_utilization
+        ):
+            self.kv_rejected += 1
+            raise AdmissionRejected(
+                429, "KV cache is full, try again later", self._retry_after()
+            )
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise AdmissionRejected(
+                503, "Timed out waiting for a free slot", self._retry_after()
+            )
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return slot
+
+    def release(self, slot: Slot):
+        """
+        Cancel whatever is still generating for `slot` and free it.
+
+        Safe to call more than once.
+        """
+        slot.cancel.set()
+        if slot.released:
+            return
+        slot.released = True
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+            "rejected": self.rejected,
+            "kv_rejected": self.kv_rejected,
+            "timed_out": self.timed_out,
+        }
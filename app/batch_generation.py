@@ -0,0 +1,119 @@
+"""
+app/batch_generation.py
+
+Purpose:
+    Offline batched generation engine used by the benchmark. Prompts are
+    bucketed by length, left-padded into batches bounded by a row count and
+    a token budget, and decoded greedily or with a fixed seed so runs are
+    reproducible.
+
+Inputs:
+    - Tokenized prompts (lists of token ids).
+    - Batch size, token budget and decoding settings.
+
+Outputs:
+    - `make_batches`: lists of prompt indices, one list per batch.
+    - `generate_batch`: decoded responses plus generated-token counts.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Sequence
+from dataclasses import dataclass
+
+import torch
+
+
+@dataclass
+class BatchOutput:
+    texts: list[str]
+    token_counts: list[int]
+
+
+def make_batches(
+    lengths: Sequence[int],
+    batch_size: int,
+    max_tokens_per_batch: int | None = None,
+    max_new_tokens: int = 0,
+) -> list[list[int]]:
+    """
+    Group prompt indices into length-bucketed batches.
+
+    Indices are sorted by prompt length so each batch pads as little as
+    possible. A batch is closed once it holds `batch_size` rows or adding
+    another row would exceed `max_tokens_per_batch`, counted as
+    rows * (longest prompt + max_new_tokens), i.e. the KV-cache footprint of
+    the padded batch at the end of decoding.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches: list[list[int]] = []
+    current: list[int] = []
+    longest = 0
+    for index in order:
+        candidate = max(longest, lengths[index])
+        over_budget = (
+            max_tokens_per_batch is not None
+            and current
+            and (len(current) + 1) * (candidate + max_new_tokens) > max_tokens_per_batch
+        )
+        if current and (len(current) >= batch_size or over_budget):
+            batches.append(current)
+            current, candidate = [], lengths[index]
+        current.append(index)
+        longest = candidate
+    if current:
+        batches.append(current)
+    return batches
+
+
+def generate_batch(
+    model,
+    tokenizer,
+    prompts: Sequence[list[int]],
+    *,
+    max_new_tokens: int,
+    do_sample: bool = False,
+    seed: int | None = None,
+    **generate_kwargs,
+) -> BatchOutput:
+    """
+    Left-pad `prompts` into one batch and decode them together.
+    """
+    pad_id = tokenizer.pad_token_id
+    if pad_id is None:
+        pad_id = tokenizer.eos_token_id
+    width = max(len(ids) for ids in prompts)
+    input_ids = torch.full((len(prompts), width), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(prompts), width), dtype=torch.long)
+    for row, ids in enumerate(prompts):
+        input_ids[row, width - len(ids) :] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, width - len(ids) :] = 1
+
+    if seed is not None:
+        torch.manual_seed(seed)
+    if not do_sample:
+        # Greedy decoding ignores sampling knobs in generation_config.
+        generate_kwargs.update(temperature=None, top_p=None, top_k=None)
+
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids.to(model.device),
+            attention_mask=attention_mask.to(model.device),
+            max_new_tokens=max_new_tokens,
+            do_sample=do_sample,
+            pad_token_id=pad_id,
+            **generate_kwargs,
+        )
+
+    eos = model.generation_config.eos_token_id
+    stop_ids = set(eos if isinstance(eos, (list, tuple)) else [eos]) | {pad_id}
+    texts, token_counts = [], []
+    for row in outputs[:, width:].tolist():
+        count = len(row)
+        for position, token in enumerate(row):
+            if token in stop_ids:
+                count = position
+                break
+        texts.append(tokenizer.decode(row[:count], skip_special_tokens=True))
+        token_counts.append(count)
+    return BatchOutput(texts=texts, token_counts=token_counts)
@@ -0,0 +1,409 @@
+"""
+app/batch_infer.py
+
+Purpose:
+    Offline batch inference: answer every question in a JSONL file (for
+    example to pre-generate FAQ content) with the base model, the LoRA
+    adapter or both, tuned for throughput rather than latency.
+
+    Prompts are read in windows of `--window` lines. A background thread
+    renders and tokenizes the next window while the current one generates.
+    Within a window, prompts are sorted by length into batches bounded by
+    `--batch-size` rows and a `--max-tokens-per-batch` budget
+    (`app.batch_generation.make_batches`, as in the benchmark), so padding
+    and KV memory stay small. With both variants, every batch is decoded
+    once with the adapter disabled and once with it enabled, on one copy of
+    the base weights.
+
+    Answers are appended to a checkpoint file after every batch. A rerun
+    skips prompts already answered for the same text, variants and settings
+    (model, adapter, quantization, decoding, max new tokens, system prompt),
+    so an interrupted run resumes where it stopped. Once every prompt is answered,
+    the output is written in input order.
+
+Inputs:
+    - `--input` JSONL: one object per line. The question is read from
+      `--field` (default: the first of input / question / prompt / message /
+      instruction), and `id` is copied if present.
+    - Base model / adapter (`BASE_MODEL_PATH`, `LORA_ADAPTER_PATH`),
+      `--variants base|lora|both`, batching and decoding options.
+
+Outputs:
+    - `--output` JSONL (default batch_outputs.jsonl): one line per input
+      line, in input order:
+        {"index", "id", "input", "base", "base_tokens", "lora", "lora_tokens",
+         "run_config"}
+      (only the requested variants; `run_config` hashes the settings).
+    - `<output>.partial`: per-batch checkpoint, removed when the run completes.
+    - Throughput summary: prompts/s, generated tokens/s per variant and how
+      long generation waited for tokenization.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections.abc import Iterable, Iterator
+
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from app.batch_generation import generate_batch, make_batches
+from app.loading import load_pretrained
+from app.merge import BASE_MODEL_PATH, LORA_ADAPTER_PATH
+from app.prefix_cache import encode_chat
+from app.quantization import QUANT_MODES, QUANTIZATION
+
+OUTPUT_FILE = "batch_outputs.jsonl"
+PROMPT_FIELDS = ("input", "question", "prompt", "message", "instruction")
+VARIANTS = {"base": ("base",), "lora": ("lora",), "both": ("base", "lora")}
+SYSTEM_PROMPT = "你是一个专业的法律咨询助手。"
+DEFAULT_WINDOW = 1024
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_MAX_TOKENS_PER_BATCH = 16384
+MAX_NEW_TOKENS = 512
+
+
+def read_prompts(path: str, field: str | None = None) -> list[dict]:
+    """
+    One {"index", "id", "input"} dict per non-empty line of `path`.
+    """
+    prompts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON ({e})")
+            fields = [field] if field else PROMPT_FIELDS
+            text = next((record[name] for name in fields if record.get(name)), None)
+            if text is None:
+                raise ValueError(
+                    f"{path}:{line_number}: no prompt in field(s) {', '.join(fields)}"
+                )
+            index = len(prompts)
+            prompts.append(
+                {"index": index, "id": record.get("id", f"line-{index}"), "input": text}
+            )
+    return prompts
+
+
+def checkpoint_file(output_file: str) -> str:
+    return output_file + ".partial"
+
+
+def load_answered(path: str) -> dict[int, dict]:
+    """
+    Answered records from a checkpoint or output file, keyed by index.
+
+    A trailing partial line (e.g. from a crash mid-write) is ignored.
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "index" in record:
+                records[record["index"]] = record
+    return records
+
+
+def append_records(path: str, records: Iterable[dict]):
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in records
+        )
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run_config(args) -> str:
+    """
+    Short hash of the settings that shape the answers.
+    """
+    config = {
+        "model": os.path.normpath(BASE_MODEL_PATH),
+        "adapter": os.path.normpath(LORA_ADAPTER_PATH),
+        "quantization": args.quantization,
+        "decoding": args.decoding,
+        "seed": args.seed if args.decoding == "sample" else None,
+        "max_new_tokens": args.max_new_tokens,
+        "system_prompt": args.system_prompt,
+    }
+    payload = json.dumps(config, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def is_answered(record: dict | None, prompt: dict, variants, config: str) -> bool:
+    # A changed input file, variant set or setting makes old answers stale.
+    return (
+        record is not None
+        and record.get("input") == prompt["input"]
+        and record.get("run_config") == config
+        and all(variant in record for variant in variants)
+    )
+
+
+def tokenized_windows(
+    prompts: list[dict], tokenizer, window: int, system_prompt: str
+) -> Iterator[list[dict]]:
+    """
+    Chunks of `window` prompts, each with its chat-formatted `input_ids`.
+    """
+    for start in range(0, len(prompts), window):
+        chunk = prompts[start : start + window]
+        for prompt in chunk:
+            prompt["input_ids"], _ = encode_chat(
+                tokenizer, prompt["input"], system_prompt
+            )
+        yield chunk
+
+
+def prefetch(items: Iterator, depth: int = 1) -> Iterator:
+    """
+    Produce `items` on a background thread, up to `depth` ahead of the
+    consumer. Exceptions are re-raised in the consumer.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                buffer.put((item, None))
+        except Exception as exc:  # noqa: BLE001
+            buffer.put((None, exc))
+        buffer.put((done, None))
+
+    threading.Thread(target=produce, name="tokenize", daemon=True).start()
+    while True:
+        item, error = buffer.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+def generate_window(
+    model, tokenizer, samples: list[dict], variants, config: str, args, stats
+):
+    """
+    Answer one tokenized window batch by batch, checkpointing each batch.
+    """
+    batches = make_batches(
+        [len(sample["input_ids"]) for sample in samples],
+        args.batch_size,
+        args.max_tokens_per_batch,
+        args.max_new_tokens,
+    )
+    do_sample = args.decoding == "sample"
+    for batch in batches:
+        prompts = [samples[i]["input_ids"] for i in batch]
+        records = [
+            {key: samples[i][key] for key in ("index", "id", "input")} for i in batch
+        ]
+        for record in records:
+            record["run_config"] = config
+        for variant in variants:
+            # The base answer runs through the same PeftModel with the
+            # adapter switched off.
+            context = (
+                model.disable_adapter()
+                if variant == "base" and hasattr(model, "disable_adapter")
+                else contextlib.nullcontext()
+            )
+            with context:
+                output = generate_batch(
+                    model,
+                    tokenizer,
+                    prompts,
+                    max_new_tokens=args.max_new_tokens,
+                    do_sample=do_sample,
+                    seed=args.seed + next(stats["batches"]) if do_sample else None,
+                )
+            for record, text, count in zip(records, output.texts, output.token_counts):
+                record[variant] = text
+                record[f"{variant}_tokens"] = count
+            stats["tokens"][variant] += sum(output.token_counts)
+        append_records(checkpoint_file(args.output), records)
+        stats["progress"].update(len(batch))
+
+
+def write_ordered(output_file: str, answered: dict[int, dict], total: int):
+    """
+    Write the final output in input order (atomically replacing it).
+    """
+    tmp = output_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines(
+            json.dumps(answered[index], ensure_ascii=False) + "\n"
+            for index in range(total)
+        )
+    os.replace(tmp, output_file)
+
+
+def run(args):
+    variants = VARIANTS[args.variants]
+    prompts = read_prompts(args.input, args.field)
+    checkpoint = checkpoint_file(args.output)
+    if args.no_resume:
+        for path in (checkpoint, args.output):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Earlier answers: the checkpoint of an interrupted run, or a finished
+    # output (e.g. rerun after appending prompts to the input).
+    config = run_config(args)
+    earlier = load_answered(args.output)
+    earlier.update(load_answered(checkpoint))
+    answered = {
+        index: record
+        for index, record in earlier.items()
+        if index < len(prompts)
+        and is_answered(record, prompts[index], variants, config)
+    }
+    stale = sum(record.get("run_config") != config for record in earlier.values())
+    if stale:
+        print(f"[INFO] Regenerating {stale} answers made with other settings")
+    pending = [prompt for prompt in prompts if prompt["index"] not in answered]
+    print(
+        f"[INFO] {len(prompts)} prompts in {args.input}: {len(answered)} already "
+        f"answered, {len(pending)} to generate ({', '.join(variants)})"
+    )
+    if pending:
+        # The checkpoint appended to holds only the still-valid answers.
+        tmp = checkpoint + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        append_records(tmp, answered.values())
+        os.replace(tmp, checkpoint)
+
+    stats = {
+        "tokens": {variant: 0 for variant in variants},
+        "batches": itertools.count(),
+        "tokenize_wait": 0.0,
+    }
+    elapsed = 0.0
+    if pending:
+        # Separate tokenizer for the prefetch thread: it starts rendering
+        # prompts while the weights load, and never shares state with the
+        # decoding in the main thread.
+        prompt_tokenizer = AutoTokenizer.from_pretrained(
+            BASE_MODEL_PATH, trust_remote_code=True
+        )
+        windows = prefetch(
+            tokenized_windows(
+                pending, prompt_tokenizer, args.window, args.system_prompt
+            )
+        )
+        model, tokenizer = load_pretrained(
+            BASE_MODEL_PATH,
+            args.quantization,
+            adapter_path=LORA_ADAPTER_PATH if "lora" in variants else None,
+            component="batch",
+        )
+
+        stats["progress"] = tqdm(total=len(pending), unit="prompt")
+        start = time.perf_counter()
+        while True:
+            waited = time.perf_counter()
+            window = next(windows, None)
+            stats["tokenize_wait"] += time.perf_counter() - waited
+            if window is None:
+                break
+            generate_window(model, tokenizer, window, variants, config, args, stats)
+        elapsed = time.perf_counter() - start
+        stats["progress"].close()
+        answered.update(load_answered(checkpoint))
+
+    write_ordered(args.output, answered, len(prompts))
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    print("\n[RESULT] Batch inference complete.")
+    print(f"[RESULT] Prompts answered this run: {len(pending)}")
+    if elapsed > 0:
+        total_tokens = sum(stats["tokens"].values())
+        print(f"[RESULT] Wall time: {elapsed:.1f}s")
+        print(f"[RESULT] Throughput: {len(pending) / elapsed:.2f} prompts/s")
+        for variant, tokens in stats["tokens"].items():
+            print(f"[RESULT] {variant}: {tokens} tokens generated")
+        print(f"[RESULT] Throughput: {total_tokens / elapsed:.1f} tokens/s")
+        print(f"[RESULT] Waited for tokenization: {stats['tokenize_wait']:.2f}s")
+    print(f"[INFO] Answers saved to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Answer a JSONL file of questions offline, in batches"
+    )
+    parser.add_argument("--input", required=True, help="JSONL file of prompts")
+    parser.add_argument("--output", default=OUTPUT_FILE, help="JSONL file of answers")
+    parser.add_argument(
+        "--field",
+        default=None,
+        help=f"Prompt field (default: first of {', '.join(PROMPT_FIELDS)})",
+    )
+    parser.add_argument(
+        "--variants",
+        choices=list(VARIANTS),
+        default="lora",
+        help="Answer with the base model, the LoRA adapter, or both",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=DEFAULT_WINDOW,
+        help="Prompts tokenized and length-sorted together",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Maximum prompts decoded together",
+    )
+    parser.add_argument(
+        "--max-tokens-per-batch",
+        type=int,
+        default=DEFAULT_MAX_TOKENS_PER_BATCH,
+        help="Token budget per batch: rows * (longest prompt + max new tokens)",
+    )
+    parser.add_argument(
+        "--max-new-tokens", type=int, default=MAX_NEW_TOKENS, help="Tokens per answer"
+    )
+    parser.add_argument(
+        "--decoding",
+        choices=["greedy", "sample"],
+        default="greedy",
+        help="Greedy decoding, or sampling seeded with --seed",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Sampling seed")
+    parser.add_argument("--system-prompt", default=SYSTEM_PROMPT)
+    parser.add_argument(
+        "--quantization",
+        choices=QUANT_MODES,
+        default=QUANTIZATION,
+        help="Weight quantization (see app/quantization.py)",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Discard earlier answers instead of skipping them",
+    )
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -3,28 +3,65 @@ app/benchmark.py
 
 Purpose:
     Run benchmark on the model using a subset of the training/test data.
-    Evaluates using Rouge-L score.
+    Evaluates using Rouge-L score (character-level for Chinese, see
+    app/scoring.py) plus any other registered metrics.
+
+    Generation is batched: prompts are bucketed by length, left-padded and
+    decoded greedily (or sampled with a fixed seed) so scores are
+    reproducible. Samples/s and generated tokens/s are reported alongside
+    Rouge-L.
+
+    Scored results are appended to the output JSONL after every batch, and a
+    rerun skips sample ids already in the file. The file starts with a
+    `run_config` line (model, quantization, decoding, max new tokens); a
+    rerun with a different configuration refuses to mix its rows in. `--shard i/N` lets N worker
+    processes split the dataset; `--merge` combines their shard files and
+    computes the final aggregate.
+
+    `--quantization` benchmarks an int8/int4 model; `--quant-report` runs
+    every mode on the same subset and writes a quality-vs-speed table.
+    `--spec-report` decodes the subset through the serving scheduler with
+    and without speculative decoding and reports acceptance rate and speedup.
 """
 
-import os
-import json
 import argparse
-import datasets
+import functools
+import glob
+import json
+import os
+import time
+
+import numpy as np
 from tqdm import tqdm
-from rouge_score import rouge_scorer
-import torch
 
-from app.inference import get_model_and_tokenizer
+from app.batch_generation import generate_batch, make_batches
+from app.data_cache import load_or_build
+from app.inference import get_model_and_tokenizer, get_tokenizer
+from app.kv_cache import to_model_cache
+from app.prefix_cache import PrefixCache, prefill, prefix_length
+from app.quantization import QUANT_MODES, QUANTIZATION, model_nbytes
+from app.sampling import ReservoirSampler, source_prefix
+from app.scheduler import GenerationScheduler
+from app.scoring import METRICS, average, score_all
 
 # Configuration
 DEFAULT_LIMIT = 50
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_MAX_TOKENS_PER_BATCH = 16384
+MAX_NEW_TOKENS = 512
 OUTPUT_FILE = "benchmark_results.jsonl"
+SAMPLE_SEED = 42
 DATA_DIR = "app/data/train"  # Matches download.py
+SYSTEM_PROMPT = "你是一个法律助手。"
+DEFAULT_METRICS = "rouge_l,keyword_overlap"
+QUANT_REPORT_FILE = "quantization_report.md"
+SPEC_REPORT_FILE = "speculative_report.md"
 
 
-def load_local_dataset(data_dir):
+def load_local_dataset(data_dir, tokenizer):
     """
-    Load dataset from local directory. attempt to find json/jsonl/parquet files.
+    Load the jsonl files in a local directory through the pre-tokenized,
+    memory-mapped dataset cache (see app/data_cache.py).
     """
     try:
         # Explicitly look for jsonl files to avoid ambiguity
@@ -33,26 +70,185 @@ def load_local_dataset(data_dir):
             for f in os.listdir(data_dir)
             if f.endswith(".jsonl")
         ]
-        if files:
-            print(
-                f"[INFO] Found {len(files)} jsonl files: {[os.path.basename(f) for f in files]}"
-            )
-            return datasets.load_dataset("json", data_files=files, split="train")
-        else:
-            # Fallback to default if no jsonl (maybe parquet?)
-            return datasets.load_dataset("parquet", data_dir=data_dir, split="train")
+        if not files:
+            raise FileNotFoundError(f"No jsonl files found in '{data_dir}'")
+        print(
+            f"[INFO] Found {len(files)} jsonl files: {[os.path.basename(f) for f in files]}"
+        )
+        return load_or_build(tokenizer, files, SYSTEM_PROMPT)
     except Exception as e:
         print(f"[ERROR] Error loading dataset: {e}")
         raise e
 
 
-def compute_metrics(predictions, references):
-    scorer = rouge_scorer.RougeScorer(["rougeL"], use_stemmer=True)
-    scores = []
-    for pred, ref in zip(predictions, references):
-        score = scorer.score(ref, pred)
-        scores.append(score["rougeL"].fmeasure)
-    return sum(scores) / len(scores) if scores else 0.0
+def compute_metrics(predictions, references, metrics=("rouge_l",), **kwargs):
+    """
+    Average score per metric over all pairs.
+    """
+    return average(score_all(predictions, references, metrics, **kwargs))
+
+
+def parse_metrics(value):
+    metrics = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in metrics if name not in METRICS]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"Unknown metrics {unknown}; available: {sorted(METRICS)}"
+        )
+    return metrics
+
+
+def parse_shard(value):
+    """
+    Parse "i/N" into (i, N) with 0 <= i < N.
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected i/N, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index out of range: '{value}'")
+    return index, count
+
+
+def parse_quant_modes(value):
+    modes = [mode.strip() for mode in value.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in QUANT_MODES]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"Unknown quantization modes {unknown}; available: {list(QUANT_MODES)}"
+        )
+    return modes
+
+
+def shard_output_file(output_file, shard):
+    if shard is None:
+        return output_file
+    stem, ext = os.path.splitext(output_file)
+    return f"{stem}.shard{shard[0]}-of-{shard[1]}{ext}"
+
+
+def run_config(args):
+    """
+    Settings that shape the generated answers; results from runs that
+    differ in any of them must not share a file.
+    """
+    return {
+        "model_path": os.path.normpath(args.model_path),
+        "quantization": args.quantization,
+        "decoding": args.decoding,
+        "seed": args.seed if args.decoding == "sample" else None,
+        "max_new_tokens": args.max_new_tokens,
+        "system_prompt": SYSTEM_PROMPT,
+    }
+
+
+def load_run_config(path):
+    """
+    The `run_config` header of a results file, or None if it has none.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            return json.loads(f.readline()).get("run_config")
+        except (json.JSONDecodeError, AttributeError):
+            return None
+
+
+def write_results(path, records, config=None):
+    """
+    Rewrite `path` with an optional run-config header and `records`.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        if config is not None:
+            f.write(json.dumps({"run_config": config}, ensure_ascii=False) + "\n")
+        f.writelines(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in records
+        )
+
+
+def load_results(path):
+    """
+    Read scored records from a results file, keyed by sample id.
+
+    A trailing partial line (e.g. from a crash mid-write) is ignored.
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "id" in record:
+                records[record["id"]] = record
+    return records
+
+
+def append_results(path, records):
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in records
+        )
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def report(records):
+    names = [name for name in METRICS if records and name in records[0]]
+    averages = average([{name: r.get(name, 0.0) for name in names} for r in records])
+    print(f"[RESULT] Samples scored: {len(records)}")
+    for name, value in averages.items():
+        label = "Rouge-L" if name == "rouge_l" else name
+        print(f"[RESULT] Average {label}: {value:.4f}")
+    return averages
+
+
+def rescore_results(output_file, metrics, mode, workers):
+    """
+    Re-score an existing results file in parallel, e.g. after changing metrics.
+    """
+    records = list(load_results(output_file).values())
+    print(f"[INFO] Re-scoring {len(records)} samples in {output_file}...")
+    start = time.perf_counter()
+    scores = score_all(
+        [r["prediction"] for r in records],
+        [r["ground_truth"] for r in records],
+        metrics,
+        mode=mode,
+        workers=workers,
+    )
+    print(f"[INFO] Scored in {time.perf_counter() - start:.2f}s")
+    for record, score in zip(records, scores):
+        record.update(score)
+    write_results(output_file, records, load_run_config(output_file))
+    report(records)
+
+
+def merge_results(output_file):
+    """
+    Combine every shard file of `output_file` into it and report the aggregate.
+    """
+    stem, ext = os.path.splitext(output_file)
+    paths = sorted(glob.glob(f"{stem}.shard*-of-*{ext}"))
+    if not paths:
+        print(f"[ERROR] No shard files found for '{output_file}'")
+        return
+    configs = {path: load_run_config(path) for path in paths}
+    if len({json.dumps(config, sort_keys=True) for config in configs.values()}) > 1:
+        print(f"[ERROR] Shard files come from different run configurations: {configs}")
+        return
+    print(f"[INFO] Merging {len(paths)} shard files: {paths}")
+    merged = {}
+    for path in paths:
+        merged.update(load_results(path))
+    write_results(output_file, merged.values(), configs[paths[0]])
+    print("\n[RESULT] Merge Complete.")
+    report(list(merged.values()))
+    print(f"[INFO] Merged results saved to {output_file}")
 
 
 def main():
@@ -60,90 +256,444 @@ def main():
     parser.add_argument(
         "--limit", type=int, default=DEFAULT_LIMIT, help="Number of samples to evaluate"
     )
+    parser.add_argument(
+        "--stratify",
+        action="store_true",
+        help="Sample --limit records proportionally from each id source prefix",
+    )
     parser.add_argument(
         "--model_path", type=str, default="app/models/lora_output", help="Path to model"
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Maximum prompts decoded together",
+    )
+    parser.add_argument(
+        "--max-tokens-per-batch",
+        type=int,
+        default=DEFAULT_MAX_TOKENS_PER_BATCH,
+        help="Token budget per batch: rows * (longest prompt + max new tokens)",
+    )
+    parser.add_argument(
+        "--max-new-tokens", type=int, default=MAX_NEW_TOKENS, help="Tokens per answer"
+    )
+    parser.add_argument(
+        "--decoding",
+        choices=["greedy", "sample"],
+        default="greedy",
+        help="Greedy decoding, or sampling seeded with --seed",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Sampling/shuffle seed")
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Evaluate only shard i of N (e.g. 0/4); results go to a per-shard file",
+    )
+    parser.add_argument(
+        "--output", type=str, default=OUTPUT_FILE, help="Results JSONL file"
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Discard existing results instead of skipping already-scored samples",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge shard result files into --output and report the aggregate",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=parse_metrics,
+        default=parse_metrics(DEFAULT_METRICS),
+        help=f"Comma-separated metrics (default: {DEFAULT_METRICS})",
+    )
+    parser.add_argument(
+        "--tokenize",
+        choices=["char", "word"],
+        default="char",
+        help="Scoring units: characters, or jieba words",
+    )
+    parser.add_argument(
+        "--score-workers",
+        type=int,
+        default=0,
+        help="Scoring processes (0 = one per CPU)",
+    )
+    parser.add_argument(
+        "--rescore",
+        action="store_true",
+        help="Re-score --output with the selected metrics instead of generating",
+    )
+    parser.add_argument(
+        "--quantization",
+        choices=QUANT_MODES,
+        default=QUANTIZATION,
+        help="Weight quantization of the model under test (see app/quantization.py)",
+    )
+    parser.add_argument(
+        "--quant-report",
+        type=parse_quant_modes,
+        nargs="?",
+        const=list(QUANT_MODES),
+        default=None,
+        help="Benchmark each quantization mode (default: all) and write "
+        f"{QUANT_REPORT_FILE}",
+    )
+    parser.add_argument(
+        "--spec-report",
+        action="store_true",
+        help="Compare greedy serving-path decoding with and without n-gram "
+        f"speculative decoding and write {SPEC_REPORT_FILE}",
+    )
     args = parser.parse_args()
 
-    print(f"[INFO] Starting benchmark with limit={args.limit}...")
+    if args.merge:
+        merge_results(args.output)
+        return
+    if args.rescore:
+        rescore_results(args.output, args.metrics, args.tokenize, args.score_workers)
+        return
+    if args.quant_report:
+        quantization_report(args, args.quant_report)
+        return
+    if args.spec_report:
+        speculative_report(args)
+        return
+    run_benchmark(args)
 
-    # Load Model
-    model, tokenizer = get_model_and_tokenizer(args.model_path)
 
-    # Load Dataset
+def load_samples(args, tokenizer):
+    """
+    The benchmark subset selected by --limit/--stratify/--shard, as dicts
+    with id, input, ground truth, prompt ids and shared-prefix length.
+    Returns None if the dataset cannot be loaded.
+    """
     print(f"[INFO] Loading dataset from {DATA_DIR}...")
     try:
-        ds = load_local_dataset(DATA_DIR)
+        ds = load_local_dataset(DATA_DIR, tokenizer)
     except Exception as e:
         print(f"[ERROR] Failed to load dataset: {e}")
         # Fallback to downloading if empty (though make install should have done it)
         # For now, we assume it exists or we fail.
-        return
-
-    # Shuffle and select subset
-    if len(ds) > args.limit:
-        ds = ds.shuffle(seed=42).select(range(args.limit))
+        return None
 
-    results = []
-    predictions = []
-    references = []
-
-    print("[INFO] Generating responses...")
-    for item in tqdm(ds):
-        # DISC-Law-SFT format usually has 'input' and 'output' or 'instruction'
-        # Adjust based on actual columns. Common: 'input', 'output'
-        # We will inspect the item keys if needed, but assuming input/output for now.
-        system_prompt = "你是一个法律助手。"
-        user_input = item.get("input", item.get("instruction", ""))
-        ground_truth = item.get("output", "")
+    # Select subset: by default the same permutation as datasets'
+    # shuffle(seed=42); --stratify takes a per-source reservoir sample instead.
+    indices = range(len(ds))
+    if args.stratify:
+        sampler = ReservoirSampler(
+            args.limit, SAMPLE_SEED, stratify=lambda i: source_prefix(ds.text("id", i))
+        )
+        for index in range(len(ds)):
+            sampler.add(index)
+        indices = sampler.result()
+        print(f"[INFO] Stratified sample by source: {sampler.allocation()}")
+    elif len(ds) > args.limit:
+        indices = np.random.default_rng(SAMPLE_SEED).permutation(len(ds))[: args.limit]
 
+    # DISC-Law-SFT format usually has 'input' and 'output' or 'instruction'
+    # Adjust based on actual columns. Common: 'input', 'output'
+    # We will inspect the item keys if needed, but assuming input/output for now.
+    samples = []
+    for position, index in enumerate(indices):
+        if args.shard is not None and position % args.shard[1] != args.shard[0]:
+            continue
+        item = ds.record(int(index))
+        user_input = item["input"]
         if not user_input:
             continue
+        input_ids = ds.prompt_ids(int(index))
+        samples.append(
+            {
+                "id": item["id"] or f"sample-{position}",
+                "input": user_input,
+                "ground_truth": item["output"],
+                "input_ids": input_ids,
+                "prefix_len": prefix_length(tokenizer, input_ids, SYSTEM_PROMPT),
+            }
+        )
+    return samples
+
 
-        # Format prompt using chat template if available
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_input},
+def run_benchmark(args):
+    """
+    Generate and score one benchmark run. Returns a summary dict.
+    """
+    output_file = shard_output_file(args.output, args.shard)
+    print(f"[INFO] Starting benchmark with limit={args.limit}...")
+
+    # The tokenizer alone is enough to read/build the dataset cache.
+    tokenizer = get_tokenizer(args.model_path)
+    samples = load_samples(args, tokenizer)
+    if samples is None:
+        return None
+
+    if args.no_resume and os.path.exists(output_file):
+        os.remove(output_file)
+    config = run_config(args)
+    completed = load_results(output_file)
+    existing = load_run_config(output_file)
+    if existing != config:
+        if completed:
+            changed = sorted(
+                key
+                for key in config
+                if existing is None or existing.get(key) != config[key]
+            )
+            print(
+                f"[ERROR] {output_file} holds results of a different run "
+                f"configuration ({', '.join(changed)} differ). Use --no-resume to "
+                "start over or --output for a separate file."
+            )
+            return None
+        write_results(output_file, [], config)
+    if completed:
+        print(f"[INFO] Resuming: {len(completed)} samples already in {output_file}")
+    pending = [sample for sample in samples if sample["id"] not in completed]
+
+    generated_tokens = 0
+    elapsed = 0.0
+    scoring = 0.0
+    model_bytes = 0
+    if pending:
+        generated_tokens, elapsed, scoring, model_bytes = run_generation(
+            args, pending, output_file
+        )
+
+    print("\n[RESULT] Benchmark Complete.")
+    # Only this run's selection: the file may hold rows of a wider
+    # --limit/--stratify run over the same configuration.
+    completed = load_results(output_file)
+    summary = report(
+        [completed[sample["id"]] for sample in samples if sample["id"] in completed]
+    )
+    if elapsed > 0:
+        summary["samples_per_s"] = len(pending) / elapsed
+        summary["tokens_per_s"] = generated_tokens / elapsed
+        summary["generation_s"] = elapsed
+        summary["scoring_s"] = scoring
+        print(f"[RESULT] Throughput: {summary['samples_per_s']:.2f} samples/s")
+        print(f"[RESULT] Throughput: {summary['tokens_per_s']:.1f} tokens/s")
+        print(f"[RESULT] Generation time: {elapsed:.1f}s, scoring time: {scoring:.1f}s")
+    if model_bytes:
+        summary["model_mb"] = model_bytes / 2**20
+        print(f"[RESULT] Model weights: {summary['model_mb']:.1f} MB")
+    print(f"[INFO] Detailed results saved to {output_file}")
+    return summary
+
+
+def quantization_report(args, modes):
+    """
+    Run the benchmark once per quantization mode on the same subset and
+    write a markdown quality-vs-speed table to QUANT_REPORT_FILE.
+    """
+    stem, ext = os.path.splitext(args.output)
+    rows = []
+    for mode in modes:
+        print(f"\n[INFO] === Quantization mode: {mode} ===")
+        run_args = argparse.Namespace(**vars(args))
+        run_args.quantization = mode
+        run_args.output = f"{stem}.{mode}{ext}"
+        run_args.no_resume = True
+        summary = run_benchmark(run_args)
+        if summary is not None:
+            rows.append((mode, summary))
+    if not rows:
+        return
+
+    metrics = [name for name in args.metrics if name in rows[0][1]]
+    header = ["mode", *metrics, "samples/s", "tokens/s", "weights (MB)"]
+    lines = [
+        "# Quantization quality vs speed",
+        "",
+        (
+            f"Model: `{args.model_path}`, samples: {args.limit}, "
+            f"decoding: {args.decoding}, batch size: {args.batch_size}"
+        ),
+        "",
+        "| " + " | ".join(header) + " |",
+        "|" + "---|" * len(header),
+    ]
+    for mode, summary in rows:
+        cells = [mode, *(f"{summary[name]:.4f}" for name in metrics)]
+        cells += [
+            f"{summary.get('samples_per_s', 0):.2f}",
+            f"{summary.get('tokens_per_s', 0):.1f}",
+            f"{summary.get('model_mb', 0):.1f}",
         ]
+        lines.append("| " + " | ".join(cells) + " |")
+    with open(QUANT_REPORT_FILE, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n" + "\n".join(lines[4:]))
+    print(f"[INFO] Quantization report saved to {QUANT_REPORT_FILE}")
 
-        text = tokenizer.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
+
+def _decode_one_by_one(scheduler, samples, max_new_tokens):
+    """
+    Greedy-decode `samples` one request at a time (the latency-bound case
+    speculation targets). Returns (finished requests, elapsed seconds).
+    """
+    requests = []
+    start = time.perf_counter()
+    for sample in tqdm(samples):
+        request = scheduler.submit(
+            sample["input_ids"],
+            max_new_tokens=max_new_tokens,
+            label="spec-report",
+            prefix_len=sample["prefix_len"],
+            do_sample=False,
         )
+        while request.sink.get()[1] is not None:
+            pass
+        if request.error:
+            raise RuntimeError(request.error)
+        requests.append(request)
+    return requests, time.perf_counter() - start
 
-        inputs = tokenizer(text, return_tensors="pt").to(model.device)
 
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs, max_new_tokens=512, temperature=0.7, do_sample=True
-            )
+def speculative_report(args):
+    """
+    Decode the benchmark subset greedily through the serving scheduler with
+    speculation off and with n-gram drafting, then write acceptance rate,
+    throughput, speedup and output equality to SPEC_REPORT_FILE.
+    """
+    tokenizer = get_tokenizer(args.model_path)
+    samples = load_samples(args, tokenizer)
+    if not samples:
+        return
+    model, tokenizer = get_model_and_tokenizer(args.model_path, args.quantization)
 
-        # Extract response (slice off input prompt)
-        # Simple slicing: len(inputs.input_ids[0])
-        response_ids = outputs[0][len(inputs.input_ids[0]) :]
-        response_text = tokenizer.decode(response_ids, skip_special_tokens=True)
+    runs = {}
+    for mode in ("none", "ngram"):
+        print(f"\n[INFO] === Speculative decoding: {mode} ===")
+        scheduler = GenerationScheduler(
+            model, tokenizer, max_batch_size=1, speculative=mode
+        )
+        runs[mode] = _decode_one_by_one(scheduler, samples, args.max_new_tokens)
 
-        results.append(
-            {
-                "input": user_input,
-                "prediction": response_text,
-                "ground_truth": ground_truth,
-            }
+    base_requests, base_elapsed = runs["none"]
+    spec_requests, spec_elapsed = runs["ngram"]
+    identical = sum(
+        a.output_ids == b.output_ids for a, b in zip(base_requests, spec_requests)
+    )
+    drafted = sum(request.drafted for request in spec_requests)
+    accepted = sum(request.accepted for request in spec_requests)
+    header = ["mode", "tokens/s", "s/sample", "acceptance", "speedup"]
+    lines = [
+        "# Speculative decoding (n-gram prompt lookup)",
+        "",
+        (
+            f"Model: `{args.model_path}`, samples: {len(samples)}, "
+            f"max new tokens: {args.max_new_tokens}, greedy, one request at a time"
+        ),
+        "",
+        "| " + " | ".join(header) + " |",
+        "|" + "---|" * len(header),
+    ]
+    for mode, (requests, elapsed) in runs.items():
+        tokens = sum(len(request.output_ids) for request in requests)
+        acceptance = f"{accepted / drafted:.1%}" if mode == "ngram" and drafted else "-"
+        lines.append(
+            f"| {mode} | {tokens / elapsed:.1f} | {elapsed / len(samples):.2f} | "
+            f"{acceptance} | {base_elapsed / elapsed:.2f}x |"
         )
-        predictions.append(response_text)
-        references.append(ground_truth)
+    lines += [
+        "",
+        (
+            f"Identical outputs: {identical}/{len(samples)}; "
+            f"draft tokens accepted: {accepted}/{drafted}"
+        ),
+        (
+            f"Wall time: {base_elapsed:.1f}s without speculation, "
+            f"{spec_elapsed:.1f}s with it"
+        ),
+    ]
+    with open(SPEC_REPORT_FILE, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n" + "\n".join(lines[4:]))
+    print(f"[INFO] Speculative decoding report saved to {SPEC_REPORT_FILE}")
 
-    # Compute Score
-    print("[INFO] Computing Rouge-L...")
-    avg_rouge = compute_metrics(predictions, references)
 
-    print("\n[RESULT] Benchmark Complete.")
-    print(f"[RESULT] Average Rouge-L: {avg_rouge:.4f}")
+def run_generation(args, samples, output_file):
+    """
+    Generate, score and checkpoint `samples` batch by batch.
 
-    # Save Results
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        for res in results:
-            f.write(json.dumps(res, ensure_ascii=False) + "\n")
-    print(f"[INFO] Detailed results saved to {OUTPUT_FILE}")
+    Returns (generated tokens, generation seconds, scoring seconds, model
+    weight bytes); throughput is computed from generation time alone.
+    """
+    # Load Model
+    model, tokenizer = get_model_and_tokenizer(args.model_path, args.quantization)
+
+    batches = make_batches(
+        [len(sample["input_ids"]) for sample in samples],
+        args.batch_size,
+        args.max_tokens_per_batch,
+        args.max_new_tokens,
+    )
+    do_sample = args.decoding == "sample"
+    # Single-row batches can reuse the shared preamble's KV state; padded
+    # batches cannot, since each row's prefix sits at a different offset.
+    prefix_cache = PrefixCache()
+
+    print(
+        f"[INFO] Generating responses for {len(samples)} samples "
+        f"in {len(batches)} batches ({args.decoding})..."
+    )
+    generated_tokens = 0
+    generation = scoring = 0.0
+    for batch_index, batch in enumerate(tqdm(batches)):
+        started = time.perf_counter()
+        generate_kwargs = {}
+        if len(batch) == 1 and samples[batch[0]]["prefix_len"]:
+            sample = samples[batch[0]]
+            prefix_ids = sample["input_ids"][: sample["prefix_len"]]
+            past = prefix_cache.get_or_compute(
+                tuple(prefix_ids), functools.partial(prefill, model, prefix_ids)
+            )
+            generate_kwargs["past_key_values"] = to_model_cache(past)
+
+        output = generate_batch(
+            model,
+            tokenizer,
+            [samples[i]["input_ids"] for i in batch],
+            max_new_tokens=args.max_new_tokens,
+            do_sample=do_sample,
+            seed=args.seed + batch_index if do_sample else None,
+            **generate_kwargs,
+        )
+        generation += time.perf_counter() - started
+        started = time.perf_counter()
+        references = [samples[i]["ground_truth"] for i in batch]
+        scores = score_all(
+            output.texts,
+            references,
+            args.metrics,
+            mode=args.tokenize,
+            workers=args.score_workers,
+        )
+        scoring += time.perf_counter() - started
+        append_results(
+            output_file,
+            [
+                {
+                    "id": samples[i]["id"],
+                    "input": samples[i]["input"],
+                    "prediction": text,
+                    "ground_truth": samples[i]["ground_truth"],
+                    **score,
+                    "generated_tokens": count,
+                }
+                for i, text, score, count in zip(
+                    batch, output.texts, scores, output.token_counts
+                )
+            ],
+        )
+        generated_tokens += sum(output.token_counts)
+    return generated_tokens, generation, scoring, model_nbytes(model)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,15 @@
 # 法律QA模型对比测试 - 本地数据/权重版
+import time
 from pathlib import Path
-import json
-import random
-import re
 
+import numpy as np
 import torch
-from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from app.data_cache import load_or_build
+from app.loading import load_pretrained, peak_rss_mb
+from app.quantization import QUANTIZATION
+from app.sampling import sample_positions
+from app.scoring import calculate_similarity
 
 print("=" * 70)
 print("法律QA模型对比测试 - 本地数据/权重版")
@@ -18,105 +21,55 @@ BASE_MODEL = BASE_DIR / "models" / "base"
 LORA_MODEL = BASE_DIR / "models" / "law-qa-qwen-lora"
 DATA_FILE = BASE_DIR / "data" / "test-data.jsonl"
 NUM_SAMPLES = 5  # 测试样本数量
+SYSTEM_PROMPT = "你是一个专业的法律咨询助手。"
 
 
-def load_jsonl(path, limit=None):
-    """Load line-delimited JSON, optionally sampling a subset."""
-    records = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            records.append(json.loads(line))
-    if limit is not None and len(records) > limit:
-        random.seed(42)
-        records = random.sample(records, limit)
-    return records
-
+# ==================== 加载模型 ====================
+print("\n⏳ 加载模型...")
+
+# 基座权重只加载一份：LoRA 挂在同一个基座上，基座回答时用 disable_adapter() 关闭适配器。
+# 分词器与权重并行加载（见 app/loading.py）；量化模式由 QUANTIZATION 环境变量选择
+# （none / int8 / int4，见 app/quantization.py）。
+load_started = time.perf_counter()
+finetuned, tokenizer = load_pretrained(
+    str(BASE_MODEL), QUANTIZATION, adapter_path=str(LORA_MODEL), component="compare"
+)
+print(
+    f"✅ 加载完成: {time.perf_counter() - load_started:.1f}s, "
+    f"峰值内存 {peak_rss_mb():.0f} MB\n"
+)
 
 # ==================== 加载测试数据 ====================
-print("\n📖 加载测试数据...")
-data = load_jsonl(DATA_FILE)
+print("📖 加载测试数据...")
+# 预分词缓存（app/data_cache.py），首次运行后直接内存映射读取
+data = load_or_build(tokenizer, [str(DATA_FILE)], SYSTEM_PROMPT)
 print(f"✅ 数据集大小: {len(data):,} 条")
 
 # 提取问题和参考答案（适配 input/output 字段）
+valid = [
+    int(i)
+    for i in np.flatnonzero((data.lengths("input") > 0) & (data.lengths("output") > 0))
+]
+
+# 随机抽取样本（与 random.seed(42); random.sample(valid, n) 选出相同样本）
 test_cases = []
-for sample in data:
-    question = sample.get("input")
-    reference = sample.get("output")
-    if question and reference:
-        test_cases.append(
-            {
-                "question": question,
-                "reference": reference,
-                "source": sample.get("id", "unknown"),
-            }
-        )
-
-# 随机抽取样本
-random.seed(42)
-test_cases = random.sample(test_cases, min(NUM_SAMPLES, len(test_cases)))
+for position in sample_positions(len(valid), NUM_SAMPLES, seed=42):
+    index = valid[position]
+    record = data.record(index)
+    test_cases.append(
+        {
+            "question": record["input"],
+            "reference": record["output"],
+            "source": record["id"] or "unknown",
+            "input_ids": data.prompt_ids(index),
+        }
+    )
 
 print(f"✅ 有效测试用例: {len(test_cases)} 个\n")
 
 if not test_cases:
     raise SystemExit("没有可用的测试用例，请检查数据文件。")
 
-# ==================== 加载模型 ====================
-print("⏳ 加载模型...")
-tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, trust_remote_code=True)
-
-base = AutoModelForCausalLM.from_pretrained(
-    BASE_MODEL, torch_dtype=torch.float16, device_map="auto", trust_remote_code=True
-)
-
-finetuned_base = AutoModelForCausalLM.from_pretrained(
-    BASE_MODEL, torch_dtype=torch.float16, device_map="auto", trust_remote_code=True
-)
-
-finetuned = PeftModel.from_pretrained(finetuned_base, LORA_MODEL)
-
-print("✅ 加载完成\n")
-
-
-# ==================== 相似度计算函数 ====================
-def calculate_similarity(generated, reference):
-    """计算生成答案与参考答案的相似度"""
-
-    # 提取中文词汇（2字及以上）
-    gen_words = set(re.findall(r"[\u4e00-\u9fff]{2,}", generated))
-    ref_words = set(re.findall(r"[\u4e00-\u9fff]{2,}", reference))
-
-    # 词汇重叠率
-    if len(ref_words) > 0:
-        common = gen_words & ref_words
-        word_overlap = len(common) / len(ref_words)
-        common_count = len(common)
-    else:
-        word_overlap = 0
-        common_count = 0
-
-    # 关键短语覆盖（4字及以上）
-    ref_phrases = set(re.findall(r"[\u4e00-\u9fff]{4,}", reference))
-    if len(ref_phrases) > 0:
-        phrase_hits = sum(1 for phrase in ref_phrases if phrase in generated)
-        phrase_coverage = phrase_hits / len(ref_phrases)
-    else:
-        phrase_coverage = 0
-
-    # 综合得分
-    score = (word_overlap * 0.6 + phrase_coverage * 0.4) * 100
-
-    return {
-        "score": score,
-        "word_overlap": word_overlap,
-        "phrase_coverage": phrase_coverage,
-        "common_words": common_count,
-        "total_ref_words": len(ref_words),
-    }
-
-
 # ==================== 对比测试 ====================
 results = []
 
@@ -137,21 +90,15 @@ for i, test in enumerate(test_cases, 1):
     )
     print(ref_preview)
 
-    # 准备输入
-    messages = [
-        {"role": "system", "content": "你是一个专业的法律咨询助手。"},
-        {"role": "user", "content": test["question"]},
-    ]
-    text = tokenizer.apply_chat_template(
-        messages, tokenize=False, add_generation_prompt=True
-    )
-    inputs = tokenizer(text, return_tensors="pt").to(base.device)
+    # 准备输入（缓存中已套用对话模板并分词）
+    input_ids = torch.tensor([test["input_ids"]], device=finetuned.device)
+    inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
 
     # 基座模型生成
     print("\n【基座模型回答】")
     print("-" * 70)
-    with torch.no_grad():
-        out = base.generate(**inputs, max_new_tokens=200, temperature=0.7)
+    with torch.no_grad(), finetuned.disable_adapter():
+        out = finetuned.generate(**inputs, max_new_tokens=200, temperature=0.7)
     base_response = tokenizer.decode(
         out[0][inputs["input_ids"].shape[1] :], skip_special_tokens=True
     )
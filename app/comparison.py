@@ -11,26 +11,47 @@ Inputs:
 Outputs:
     - NDJSON stream with entries shaped as:
         {"model": "base" | "lora", "delta": "<text chunk>", "done": bool}
+      In the default "parallel" mode both variants are decoded together and
+      their deltas are interleaved as they are produced; "sequential" mode
+      streams the base answer to completion before the LoRA one.
+      `astream_compare` yields the same lines from an asyncio generator.
 """
 
 from __future__ import annotations
 
+import asyncio
+import functools
 import json
 import os
-from threading import Thread
-from typing import Generator, Iterable
+import queue
+import threading
+import time
+from collections.abc import AsyncIterator, Generator, Iterable
 
-import torch
-from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+from app.adapters import AdapterRegistry
+from app.detokenizer import StreamCoalescer, make_detokenizer
+from app.loading import WARMUP, load_pretrained
+from app.merge import BASE_MODEL_PATH, LORA_ADAPTER_PATH
+from app.prefix_cache import encode_chat
+from app.profiling import ProfileBusy, RequestProfiler
+from app.quantization import QUANTIZATION
+from app.scheduler import (
+    AsyncSink,
+    aiter_text,
+    get_scheduler,
+    iter_text,
+)
 
-
-BASE_MODEL_PATH = "app/models/base"
-LORA_ADAPTER_PATH = "app/models/law-qa-qwen-lora"
 MAX_NEW_TOKENS = int(os.environ.get("MAX_NEW_TOKENS", "512"))
+COMPARE_MODE = os.environ.get("COMPARE_MODE", "parallel")  # or "sequential"
+SYSTEM_PROMPT = "你是一个专业的法律咨询助手。"
+# Name the shipped adapter is registered under in the adapter registry.
+DEFAULT_ADAPTER = os.path.basename(LORA_ADAPTER_PATH)
 
 _SHARED_MODEL = None
 _SHARED_TOKENIZER = None
+_REGISTRY = None
+_SHARED_LOCK = threading.Lock()
 
 
 def _load_shared_model():
@@ -39,128 +60,450 @@ def _load_shared_model():
 
     The returned model is a PeftModel with the LoRA adapter attached.
     We toggle the adapter on/off during generation to produce both base
-    and LoRA outputs without loading two models into memory.
+    and LoRA outputs without loading two models into memory. More adapters
+    can be loaded onto it at runtime through `get_registry()`.
     """
-    global _SHARED_MODEL, _SHARED_TOKENIZER
-    if _SHARED_MODEL is None or _SHARED_TOKENIZER is None:
-        if not os.path.exists(BASE_MODEL_PATH):
-            raise FileNotFoundError(
-                f"Base model not found at '{BASE_MODEL_PATH}'. Please run 'make install'."
+    global _SHARED_MODEL, _SHARED_TOKENIZER, _REGISTRY
+    # Concurrent first requests must not load the model twice.
+    with _SHARED_LOCK:
+        if _SHARED_MODEL is None or _SHARED_TOKENIZER is None:
+            if not os.path.exists(BASE_MODEL_PATH):
+                raise FileNotFoundError(
+                    f"Base model not found at '{BASE_MODEL_PATH}'. Please run 'make install'."
+                )
+            if not os.path.exists(LORA_ADAPTER_PATH):
+                raise FileNotFoundError(
+                    f"LoRA adapter not found at '{LORA_ADAPTER_PATH}'. Please place the adapters or rerun training."
+                )
+
+            print(
+                f"[comparison] Loading shared model from '{BASE_MODEL_PATH}' with adapter '{LORA_ADAPTER_PATH}'..."
             )
-        if not os.path.exists(LORA_ADAPTER_PATH):
-            raise FileNotFoundError(
-                f"LoRA adapter not found at '{LORA_ADAPTER_PATH}'. Please place the adapters or rerun training."
+            peft_model, tokenizer = load_pretrained(
+                BASE_MODEL_PATH,
+                QUANTIZATION,
+                adapter_path=LORA_ADAPTER_PATH,
+                adapter_name=DEFAULT_ADAPTER,
+                component="compare",
             )
 
-        print(
-            f"[comparison] Loading shared model from '{BASE_MODEL_PATH}' with adapter '{LORA_ADAPTER_PATH}'..."
-        )
-        base_model = AutoModelForCausalLM.from_pretrained(
-            BASE_MODEL_PATH,
-            device_map="auto",
-            trust_remote_code=True,
-            torch_dtype=torch.float16,
-        )
-        peft_model = PeftModel.from_pretrained(base_model, LORA_ADAPTER_PATH)
-        peft_model.eval()
+            _REGISTRY = AdapterRegistry(
+                peft_model, get_scheduler(peft_model, tokenizer)
+            )
+            _REGISTRY.register(DEFAULT_ADAPTER, LORA_ADAPTER_PATH, loaded=True)
+            _SHARED_MODEL = peft_model
+            _SHARED_TOKENIZER = tokenizer
+
+    return _SHARED_MODEL, _SHARED_TOKENIZER
+
+
+def get_registry() -> AdapterRegistry:
+    """
+    The adapter registry of the shared model (loading it if needed).
+    """
+    _load_shared_model()
+    return _REGISTRY
 
-        tokenizer = AutoTokenizer.from_pretrained(
-            BASE_MODEL_PATH, trust_remote_code=True
+
+def _ndjson(label: str, delta: str, done: bool, tokens: int = 0) -> str:
+    # `tokens`: generated tokens behind `delta`; one line may carry several
+    # when tokens queued up while the stream was busy.
+    return (
+        json.dumps(
+            {"model": label, "delta": delta, "done": done, "tokens": tokens},
+            ensure_ascii=False,
         )
+        + "\n"
+    )
 
-        _SHARED_MODEL = peft_model
-        _SHARED_TOKENIZER = tokenizer
 
-    return _SHARED_MODEL, _SHARED_TOKENIZER
+def compare_error(exc) -> str:
+    """
+    Terminal error lines for both sides of a compare stream.
+    """
+    return "".join(
+        _ndjson(label, f"[ERROR] Failed to generate: {exc}", True)
+        for label in ("base", "lora")
+    )
+
+
+def _build_input_ids(prompt: str, tokenizer):
+    # Use a system prompt to align with the training/intended usage.
+    # Returns (input_ids, prefix_len, seconds): the prefix length lets the
+    # scheduler reuse the KV state of the template preamble + system prompt,
+    # and the tokenization time goes into the request's latency breakdown.
+    started = time.perf_counter()
+    input_ids, prefix_len = encode_chat(tokenizer, prompt, SYSTEM_PROMPT)
+    return input_ids, prefix_len, time.perf_counter() - started
+
+
+def _submit(
+    encoded,
+    *,
+    label: str,
+    adapter: str | None,
+    sink=None,
+    cancel: threading.Event | None = None,
+    deadline: float | None = None,
+):
+    input_ids, prefix_len, tokenize_s = encoded
+    return get_registry().submit(
+        adapter,
+        input_ids,
+        max_new_tokens=MAX_NEW_TOKENS,
+        label=label,
+        endpoint="compare",
+        tokenize_s=tokenize_s,
+        prefix_len=prefix_len,
+        sink=sink,
+        cancel=cancel,
+        timeout=_remaining(deadline),
+    )
 
 
 def _generate_stream_part(
     *,
     prompt: str,
     label: str,
-    model,
     tokenizer,
-    use_adapter: bool,
+    adapter: str | None,
+    cancel: threading.Event | None = None,
+    deadline: float | None = None,
 ) -> Iterable[str]:
     """
     Generate a stream for a single variant (base or LoRA) using the shared model.
     """
     try:
-        # Use a system prompt to align with the training/intended usage
-        messages = [
-            {"role": "system", "content": "你是一个专业的法律咨询助手。"},
-            {"role": "user", "content": prompt},
-        ]
-        text = tokenizer.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        inputs = tokenizer(text, return_tensors="pt").to(model.device)
-        streamer = TextIteratorStreamer(
-            tokenizer, skip_prompt=True, skip_special_tokens=True
+        request = _submit(
+            _build_input_ids(prompt, tokenizer),
+            label=label,
+            adapter=adapter,
+            cancel=cancel,
+            deadline=deadline,
         )
+        for delta, tokens in iter_text(request, tokenizer, with_tokens=True):
+            yield _ndjson(label, delta, False, tokens)
+
+        yield _ndjson(label, "", True)
 
-        def _run_generate():
-            generation_kwargs = dict(
-                inputs, streamer=streamer, max_new_tokens=MAX_NEW_TOKENS
+    except Exception as exc:  # noqa: BLE001
+        yield _ndjson(label, f"[ERROR] Failed to generate: {exc}", True)
+
+
+async def _agenerate_stream_part(
+    *,
+    prompt: str,
+    label: str,
+    tokenizer,
+    adapter: str | None,
+    cancel: threading.Event | None = None,
+    deadline: float | None = None,
+) -> AsyncIterator[str]:
+    try:
+        # Submitting may wait for the registry to reload an evicted adapter.
+        request = await asyncio.to_thread(
+            functools.partial(
+                _submit,
+                _build_input_ids(prompt, tokenizer),
+                label=label,
+                adapter=adapter,
+                sink=AsyncSink(),
+                cancel=cancel,
+                deadline=deadline,
             )
-            if use_adapter:
-                model.generate(**generation_kwargs)
-                return
-
-            # Disable adapters for base output
-            if hasattr(model, "disable_adapter"):
-                with model.disable_adapter():
-                    model.generate(**generation_kwargs)
-            else:
-                model.generate(**generation_kwargs)
-
-        thread = Thread(target=_run_generate)
-        thread.start()
-
-        for delta in streamer:
-            yield (
-                json.dumps(
-                    {"model": label, "delta": delta, "done": False}, ensure_ascii=False
-                )
-                + "\n"
+        )
+        async for delta, tokens in aiter_text(request, tokenizer, with_tokens=True):
+            yield _ndjson(label, delta, False, tokens)
+
+        yield _ndjson(label, "", True)
+
+    except Exception as exc:  # noqa: BLE001
+        yield _ndjson(label, f"[ERROR] Failed to generate: {exc}", True)
+
+
+def _submit_together(*, prompt: str, tokenizer, adapter: str, sink, cancel, deadline):
+    """
+    Queue base and LoRA on one sink; returns a text detokenizer per label.
+
+    Both requests are submitted at once so the scheduler places them in the
+    same mixed-adapter batch; wall-clock time is close to a single generation.
+    """
+    encoded = _build_input_ids(prompt, tokenizer)
+    decoders = {}
+    for label, variant in (("base", None), ("lora", adapter)):
+        try:
+            _submit(
+                encoded,
+                label=label,
+                adapter=variant,
+                sink=sink,
+                cancel=cancel,
+                deadline=deadline,
             )
+        except Exception:
+            # E.g. an unknown or busy adapter: stop the side already queued,
+            # which would otherwise generate for nobody.
+            cancel.set()
+            raise
+        decoders[label] = make_detokenizer(tokenizer)
+    return decoders
 
-        thread.join()
-        yield (
-            json.dumps({"model": label, "delta": "", "done": True}, ensure_ascii=False)
-            + "\n"
-        )
 
+def _generate_stream_together(
+    *,
+    prompt: str,
+    tokenizer,
+    adapter: str,
+    cancel: threading.Event | None = None,
+    deadline: float | None = None,
+) -> Iterable[str]:
+    """
+    Decode base and LoRA together and interleave their deltas.
+    """
+    cancel = cancel or threading.Event()
+    sink: queue.Queue = queue.Queue()
+    try:
+        decoders = _submit_together(
+            prompt=prompt,
+            tokenizer=tokenizer,
+            adapter=adapter,
+            sink=sink,
+            cancel=cancel,
+            deadline=deadline,
+        )
     except Exception as exc:  # noqa: BLE001
-        yield (
-            json.dumps(
-                {
-                    "model": label,
-                    "delta": f"[ERROR] Failed to generate: {exc}",
-                    "done": True,
-                },
-                ensure_ascii=False,
+        yield compare_error(exc)
+        return
+
+    texts = {label: StreamCoalescer() for label in decoders}
+    pending = len(decoders)
+    try:
+        while pending:
+            try:
+                event = sink.get(timeout=_wait_time(texts))
+            except queue.Empty:
+                yield from _due_lines(texts)
+                continue
+            lines, finished = _drain_events(sink, event, decoders, texts)
+            pending -= finished
+            yield from lines
+    finally:
+        # Stop both sequences if the consumer went away mid-stream.
+        cancel.set()
+
+
+async def _agenerate_stream_together(
+    *,
+    prompt: str,
+    tokenizer,
+    adapter: str,
+    cancel: threading.Event | None = None,
+    deadline: float | None = None,
+) -> AsyncIterator[str]:
+    cancel = cancel or threading.Event()
+    sink = AsyncSink()
+    try:
+        decoders = await asyncio.to_thread(
+            functools.partial(
+                _submit_together,
+                prompt=prompt,
+                tokenizer=tokenizer,
+                adapter=adapter,
+                sink=sink,
+                cancel=cancel,
+                deadline=deadline,
             )
-            + "\n"
         )
+    except Exception as exc:  # noqa: BLE001
+        yield compare_error(exc)
+        return
+
+    texts = {label: StreamCoalescer() for label in decoders}
+    pending = len(decoders)
+    try:
+        while pending:
+            wait = _wait_time(texts)
+            try:
+                if wait is None:
+                    event = await sink.get()
+                else:
+                    event = await asyncio.wait_for(sink.get(), wait)
+            except asyncio.TimeoutError:
+                for line in _due_lines(texts):
+                    yield line
+                continue
+            lines, finished = _drain_events(sink, event, decoders, texts)
+            pending -= finished
+            for line in lines:
+                yield line
+    finally:
+        cancel.set()
+
+
+def _wait_time(texts: dict[str, StreamCoalescer]) -> float | None:
+    waits = [w for w in (text.wait_time() for text in texts.values()) if w is not None]
+    return min(waits) if waits else None
+
 
+def _due_lines(texts: dict[str, StreamCoalescer]) -> list[str]:
+    lines = []
+    for label, text in texts.items():
+        if text.due():
+            delta, tokens = text.take_counted()
+            lines.append(_ndjson(label, delta, False, tokens))
+    return lines
 
-def stream_compare(prompt: str) -> Generator[str, None, None]:
+
+def _drain_events(sink, event, decoders, texts) -> tuple[list[str], int]:
+    """
+    Decode `event` and every event already queued behind it; returns the
+    NDJSON lines now due and how many sequences ended.
+
+    Tokens that piled up while the consumer was busy go out as one line per
+    variant (see app/detokenizer.py for the optional flush thresholds).
+    """
+    lines, finished = [], 0
+    while True:
+        request, token = event
+        lines += _event_lines(request, token, decoders, texts)
+        finished += token is None
+        try:
+            event = sink.get_nowait()
+        except queue.Empty:
+            break
+    return lines + _due_lines(texts), finished
+
+
+def _event_lines(request, token: int | None, decoders, texts) -> list[str]:
+    """
+    Feed one scheduler event of an interleaved compare stream; an ended
+    sequence flushes its text and gets its final line.
+    """
+    text = texts[request.label]
+    if token is not None:
+        text.add(decoders[request.label].push(token), tokens=1)
+        return []
+
+    lines = []
+    text.add(decoders[request.label].flush())
+    delta, tokens = text.take_counted()
+    if delta:
+        lines.append(_ndjson(request.label, delta, False, tokens))
+        tokens = 0
+    if request.error:
+        lines.append(
+            _ndjson(request.label, f"[ERROR] Failed to generate: {request.error}", True)
+        )
+    else:
+        lines.append(_ndjson(request.label, "", True, tokens))
+    return lines
+
+
+def _remaining(deadline: float | None) -> float | None:
+    return None if deadline is None else deadline - time.perf_counter()
+
+
+def _deadline(timeout: float | None) -> float | None:
+    return None if timeout is None else time.perf_counter() + timeout
+
+
+def _start_profiler(profile: str | None, model) -> RequestProfiler | None:
+    if not profile:
+        return None
+    profiler = RequestProfiler(profile, [model])
+    profiler.start()
+    return profiler
+
+
+def stream_compare(
+    prompt: str,
+    adapter: str | None = None,
+    cancel: threading.Event | None = None,
+    timeout: float | None = None,
+    profile: str | None = None,
+) -> Generator[str, None, None]:
     """
     Stream responses for both base and LoRA models as NDJSON lines.
+
+    `adapter` picks a registered adapter for the "lora" side (default: the
+    shipped law-qa-qwen-lora). Generation stops once `cancel` is set or
+    `timeout` seconds have passed for the request as a whole. With
+    `profile`, the request is profiled into `PROFILE_DIR/<profile>` (see
+    app/profiling.py).
     """
     model, tokenizer = _load_shared_model()
+    adapter = adapter or DEFAULT_ADAPTER
+    limits = {"cancel": cancel, "deadline": _deadline(timeout)}
+    try:
+        profiler = _start_profiler(profile, model)
+    except ProfileBusy as exc:
+        for label in ("base", "lora"):
+            yield _ndjson(label, f"[ERROR] {exc}", True)
+        return
+
+    try:
+        if COMPARE_MODE == "parallel":
+            yield from _generate_stream_together(
+                prompt=prompt, tokenizer=tokenizer, adapter=adapter, **limits
+            )
+            return
+
+        # Sequential generation: base first, then LoRA.
+        for chunk in _generate_stream_part(
+            prompt=prompt, label="base", tokenizer=tokenizer, adapter=None, **limits
+        ):
+            yield chunk
+
+        for chunk in _generate_stream_part(
+            prompt=prompt, label="lora", tokenizer=tokenizer, adapter=adapter, **limits
+        ):
+            yield chunk
+    finally:
+        if profiler is not None:
+            profiler.stop()
 
-    # Sequential generation to minimize memory footprint.
-    for chunk in _generate_stream_part(
-        prompt=prompt, label="base", model=model, tokenizer=tokenizer, use_adapter=False
-    ):
-        yield chunk
 
-    for chunk in _generate_stream_part(
-        prompt=prompt, label="lora", model=model, tokenizer=tokenizer, use_adapter=True
-    ):
-        yield chunk
+async def astream_compare(
+    prompt: str,
+    adapter: str | None = None,
+    cancel: threading.Event | None = None,
+    timeout: float | None = None,
+    profile: str | None = None,
+) -> AsyncIterator[str]:
+    """
+    Async `stream_compare`: tokens are awaited from the scheduler, so an
+    open stream holds no thread while it waits.
+    """
+    model, tokenizer = await asyncio.to_thread(_load_shared_model)
+    adapter = adapter or DEFAULT_ADAPTER
+    limits = {"cancel": cancel, "deadline": _deadline(timeout)}
+    try:
+        profiler = _start_profiler(profile, model)
+    except ProfileBusy as exc:
+        for label in ("base", "lora"):
+            yield _ndjson(label, f"[ERROR] {exc}", True)
+        return
+
+    try:
+        if COMPARE_MODE == "parallel":
+            async for chunk in _agenerate_stream_together(
+                prompt=prompt, tokenizer=tokenizer, adapter=adapter, **limits
+            ):
+                yield chunk
+            return
+
+        for label, variant in (("base", None), ("lora", adapter)):
+            async for chunk in _agenerate_stream_part(
+                prompt=prompt,
+                label=label,
+                tokenizer=tokenizer,
+                adapter=variant,
+                **limits,
+            ):
+                yield chunk
+    finally:
+        if profiler is not None:
+            profiler.stop()
 
 
 def load_models():
@@ -170,3 +513,22 @@ def load_models():
     print("[comparison] Pre-loading shared model...")
     _load_shared_model()
     print("[comparison] All models loaded successfully.")
+
+
+def load_models_in_background() -> threading.Thread:
+    """
+    Run `load_models` on a daemon thread so startup does not block; requests
+    that arrive meanwhile wait for the model, and `WARMUP` reports progress.
+    """
+    WARMUP.expect("compare")
+
+    def warm_up():
+        try:
+            load_models()
+        except Exception as e:  # noqa: BLE001
+            WARMUP.failed("compare", str(e))
+            print(f"[ERROR] Failed to load models: {e}")
+
+    thread = threading.Thread(target=warm_up, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
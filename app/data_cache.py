@@ -0,0 +1,250 @@
+"""
+app/data_cache.py
+
+Purpose:
+    Pre-tokenized, memory-mapped cache of DISC-Law-SFT style JSONL data.
+    The chat template and tokenizer run once per (tokenizer, template,
+    system prompt, source files); training, benchmarking and comparison then
+    read token ids straight from flat memory-mapped arrays, so start-up is
+    instant and RSS stays near zero regardless of dataset size.
+
+Inputs:
+    - A tokenizer, a system prompt and one or more JSONL files whose records
+      have "input" (or "instruction"), "output" and optionally "id".
+
+Outputs:
+    - A cache directory under `app/data/cache/<key>/` with one flat array
+      plus an offsets index per column:
+        prompt_ids  (int32)  chat-templated prompt incl. generation header
+        answer_ids  (int32)  answer + eos, for training labels
+        input / output / id  (utf-8 bytes)
+    - `TokenizedDataset`, a read-only view over that directory.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+CACHE_DIR = "app/data/cache"
+CACHE_VERSION = 1
+
+TOKEN_COLUMNS = ("prompt_ids", "answer_ids")
+TEXT_COLUMNS = ("input", "output", "id")
+
+
+def _tokenizer_fingerprint(tokenizer) -> str:
+    digest = hashlib.sha256()
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        digest.update(backend.to_str().encode("utf-8"))
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    digest.update(str(tokenizer.chat_template).encode("utf-8"))
+    digest.update(str(tokenizer.eos_token).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def cache_key(tokenizer, files: Sequence[str], system_prompt: str | None) -> str:
+    """
+    Hash of tokenizer, chat template, system prompt and source files.
+
+    Source files are identified by path, size and mtime rather than content
+    so multi-GB inputs don't have to be re-read to check the cache.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"v{CACHE_VERSION}".encode())
+    digest.update(_tokenizer_fingerprint(tokenizer).encode())
+    digest.update(json.dumps(system_prompt, ensure_ascii=False).encode("utf-8"))
+    for path in files:
+        stat = os.stat(path)
+        digest.update(
+            f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    return digest.hexdigest()[:16]
+
+
+class _ColumnWriter:
+    """
+    Append-only writer for one ragged column: data file + offsets index.
+    """
+
+    def __init__(self, path: str, dtype, file):
+        self.dtype = np.dtype(dtype)
+        self.offsets = [0]
+        self.path = path
+        self._file = file
+
+    def append(self, values):
+        array = np.asarray(values, dtype=self.dtype)
+        self._file.write(array.tobytes())
+        self.offsets.append(self.offsets[-1] + len(array))
+
+    def save_offsets(self):
+        np.save(self.path + ".offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+
+
+class TokenizedDataset:
+    """
+    Read-only, memory-mapped view of a built cache directory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self._data: dict[str, np.ndarray] = {}
+        self._offsets: dict[str, np.ndarray] = {}
+        for name, dtype in self.meta["columns"].items():
+            path = os.path.join(directory, name)
+            self._offsets[name] = np.load(path + ".offsets.npy", mmap_mode="r")
+            if os.path.getsize(path + ".bin"):
+                self._data[name] = np.memmap(path + ".bin", dtype=dtype, mode="r")
+            else:
+                self._data[name] = np.zeros(0, dtype=dtype)
+
+    def __len__(self) -> int:
+        return len(self._offsets["prompt_ids"]) - 1
+
+    def _slice(self, column: str, index: int) -> np.ndarray:
+        offsets = self._offsets[column]
+        return self._data[column][offsets[index] : offsets[index + 1]]
+
+    def lengths(self, column: str = "prompt_ids") -> np.ndarray:
+        return np.diff(self._offsets[column])
+
+    def prompt_ids(self, index: int) -> list[int]:
+        return self._slice("prompt_ids", index).tolist()
+
+    def answer_ids(self, index: int) -> list[int]:
+        return self._slice("answer_ids", index).tolist()
+
+    def text(self, column: str, index: int) -> str:
+        return self._slice(column, index).tobytes().decode("utf-8")
+
+    def record(self, index: int) -> dict[str, str]:
+        return {column: self.text(column, index) for column in TEXT_COLUMNS}
+
+
+def build_cache(
+    tokenizer,
+    files: Sequence[str],
+    system_prompt: str | None,
+    directory: str,
+) -> TokenizedDataset:
+    """
+    Stream `files` once, tokenizing every record into `directory`.
+
+    Written to a per-process temporary sibling directory and renamed into
+    place, so an interrupted build never leaves a half-written cache behind.
+    """
+    tmp_dir = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    columns = {name: np.int32 for name in TOKEN_COLUMNS}
+    columns.update({name: np.uint8 for name in TEXT_COLUMNS})
+    count = 0
+    # The stack closes every column file, also when the build fails half-way.
+    with contextlib.ExitStack() as stack:
+        writers = {}
+        for name, dtype in columns.items():
+            path = os.path.join(tmp_dir, name)
+            file = stack.enter_context(open(path + ".bin", "wb"))
+            writers[name] = _ColumnWriter(path, dtype, file)
+        for path in files:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    # Records with an empty question are kept so indices line up
+                    # with the source files; consumers filter on `lengths()`.
+                    item = json.loads(line)
+                    question = item.get("input", item.get("instruction", "")) or ""
+                    answer = item.get("output", "") or ""
+                    messages = [{"role": "user", "content": question}]
+                    if system_prompt is not None:
+                        messages.insert(0, {"role": "system", "content": system_prompt})
+                    prompt = tokenizer.apply_chat_template(
+                        messages, tokenize=False, add_generation_prompt=True
+                    )
+                    writers["prompt_ids"].append(tokenizer(prompt)["input_ids"])
+                    writers["answer_ids"].append(
+                        tokenizer(answer + tokenizer.eos_token)["input_ids"]
+                    )
+                    for name, value in (
+                        ("input", question),
+                        ("output", answer),
+                        ("id", str(item.get("id", ""))),
+                    ):
+                        writers[name].append(
+                            np.frombuffer(value.encode("utf-8"), np.uint8)
+                        )
+                    count += 1
+
+    for writer in writers.values():
+        writer.save_offsets()
+    meta = {
+        "version": CACHE_VERSION,
+        "files": [os.path.abspath(path) for path in files],
+        "system_prompt": system_prompt,
+        "records": count,
+        "columns": {name: np.dtype(dtype).name for name, dtype in columns.items()},
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_dir, directory)
+    return TokenizedDataset(directory)
+
+
+def load_or_build(
+    tokenizer,
+    files: Sequence[str],
+    system_prompt: str | None = None,
+    cache_dir: str = CACHE_DIR,
+) -> TokenizedDataset:
+    """
+    Open the cache for these inputs, building it on first use.
+    """
+    files = list(files)
+    directory = os.path.join(cache_dir, cache_key(tokenizer, files, system_prompt))
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        return TokenizedDataset(directory)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Concurrent callers (e.g. benchmark shards) wait on a lock file, so the
+    # cache is built once and the others reuse it.
+    with open(f"{directory}.lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(meta_path):
+            return TokenizedDataset(directory)
+        print(f"[INFO] Tokenizing {len(files)} files into cache '{directory}'...")
+        return build_cache(tokenizer, files, system_prompt, directory)
+
+
+def jsonl_files(data_path: str) -> list[str]:
+    """
+    A JSONL file, or every JSONL file in a directory (sorted by name).
+    """
+    if os.path.isdir(data_path):
+        return sorted(
+            os.path.join(data_path, f)
+            for f in os.listdir(data_path)
+            if f.endswith(".jsonl")
+        )
+    return [data_path]
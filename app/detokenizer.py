@@ -0,0 +1,242 @@
+"""
+app/detokenizer.py
+
+Purpose:
+    Turn streamed token ids into text deltas cheaply, and batch those
+    deltas into fewer, larger chunks.
+
+    `TextIteratorStreamer` (and the decoder this module replaces) re-decoded
+    the whole generated sequence after every token, so per-token cost grew
+    with the answer length. For byte-level BPE tokenizers (Qwen2, GPT-2
+    style) `IncrementalDetokenizer` instead maps each token id to its raw
+    bytes once, from a table built per tokenizer, and feeds those bytes to
+    an incremental UTF-8 decoder. The decoder holds back a partial
+    multi-byte character until its last byte arrives, so each token costs
+    O(1). Other tokenizers fall back to decoding a short window of recent
+    tokens.
+
+    `StreamCoalescer` merges deltas before they are sent. Tokens that are
+    already queued are always merged into one chunk, and
+    `STREAM_FLUSH_MS` / `STREAM_FLUSH_BYTES` can hold text back further.
+    Under load the server then writes, JSON-encodes and forwards fewer
+    chunks.
+
+Inputs:
+    - A HuggingFace tokenizer and token ids from app/scheduler.py.
+    - `STREAM_FLUSH_MS`: hold text for up to this long before flushing
+      (default 0: flush whenever the queue of tokens is drained).
+    - `STREAM_FLUSH_BYTES`: flush early once this much UTF-8 text is
+      buffered (default 0: no size trigger).
+
+Outputs:
+    - `make_detokenizer(tokenizer)`: object with `push(token_id) -> str`
+      and `flush() -> str`; the concatenated deltas equal
+      `tokenizer.decode(ids, skip_special_tokens=True)`.
+    - `StreamCoalescer`: buffered text, the number of tokens behind it and
+      when it is due.
+"""
+
+from __future__ import annotations
+
+import codecs
+import os
+import threading
+import time
+
+try:
+    from tokenizers.decoders import ByteLevel
+except ImportError:
+    ByteLevel = None
+
+STREAM_FLUSH_MS = float(os.environ.get("STREAM_FLUSH_MS", "0"))
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "0"))
+
+_BYTE_TABLES: dict[int, list[bytes | None] | None] = {}
+_BYTE_TABLES_LOCK = threading.Lock()
+
+
+def _unicode_to_bytes() -> dict[str, int]:
+    """
+    Inverse of GPT-2's byte -> printable character map used by ByteLevel.
+    """
+    printable = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    chars = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            chars.append(256 + extra)
+            extra += 1
+    return {chr(char): byte for byte, char in zip(printable, chars)}
+
+
+def _build_byte_table(tokenizer) -> list[bytes | None] | None:
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if ByteLevel is None or backend is None:
+        return None
+    if not isinstance(backend.decoder, ByteLevel):
+        return None
+    if getattr(tokenizer, "clean_up_tokenization_spaces", False):
+        # decode() would rewrite spaces around punctuation afterwards.
+        return None
+    byte_of = _unicode_to_bytes()
+    added = tokenizer.added_tokens_decoder
+    table: list[bytes | None] = []
+    for token_id, token in enumerate(
+        tokenizer.convert_ids_to_tokens(range(len(tokenizer)))
+    ):
+        if token_id in added:
+            # Added tokens decode to their literal content; special ones are
+            # skipped like `skip_special_tokens=True` does.
+            entry = added[token_id]
+            table.append(None if entry.special else entry.content.encode("utf-8"))
+        elif token is None:
+            table.append(b"")
+        else:
+            try:
+                table.append(bytes(byte_of[char] for char in token))
+            except KeyError:
+                return None
+    return table
+
+
+def byte_table(tokenizer) -> list[bytes | None] | None:
+    """
+    Raw bytes per token id (None for skipped special tokens), or None if
+    the tokenizer is not byte-level BPE. Built once per tokenizer.
+    """
+    key = id(tokenizer)
+    with _BYTE_TABLES_LOCK:
+        if key not in _BYTE_TABLES:
+            _BYTE_TABLES[key] = _build_byte_table(tokenizer)
+        return _BYTE_TABLES[key]
+
+
+class IncrementalDetokenizer:
+    """
+    O(1)-per-token text deltas for byte-level BPE tokenizers.
+    """
+
+    def __init__(self, tokenizer, table: list[bytes | None]):
+        self.tokenizer = tokenizer
+        self.table = table
+        self._utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def push(self, token_id: int) -> str:
+        if token_id < len(self.table):
+            data = self.table[token_id]
+        else:
+            data = self.tokenizer.decode([token_id], skip_special_tokens=True).encode()
+        return self._utf8.decode(data) if data else ""
+
+    def flush(self) -> str:
+        return self._utf8.decode(b"", final=True)
+
+
+class WindowDetokenizer:
+    """
+    Text deltas for other tokenizers: only the tokens since the last
+    printed boundary are re-decoded, not the whole sequence.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids: list[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, start: int, end: int | None = None) -> str:
+        return self.tokenizer.decode(
+            self.token_ids[start:end], skip_special_tokens=True
+        )
+
+    def push(self, token_id: int) -> str:
+        self.token_ids.append(token_id)
+        # Decoding from the last printed token on keeps spacing and merges
+        # at the boundary right.
+        prefix = self._decode(self.prefix_offset, self.read_offset)
+        text = self._decode(self.prefix_offset)
+        if len(text) <= len(prefix) or text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return text[len(prefix) :]
+
+    def flush(self) -> str:
+        prefix = self._decode(self.prefix_offset, self.read_offset)
+        text = self._decode(self.prefix_offset)
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return text[len(prefix) :]
+
+
+def make_detokenizer(tokenizer):
+    table = byte_table(tokenizer)
+    if table is None:
+        return WindowDetokenizer(tokenizer)
+    return IncrementalDetokenizer(tokenizer, table)
+
+
+class StreamCoalescer:
+    """
+    Text waiting to be sent, flushed by size or age.
+
+    With no thresholds every batch of drained tokens is flushed at once.
+    """
+
+    def __init__(
+        self, flush_ms: float = STREAM_FLUSH_MS, flush_bytes: int = STREAM_FLUSH_BYTES
+    ):
+        self.flush_s = flush_ms / 1000
+        self.flush_bytes = flush_bytes
+        self._parts: list[str] = []
+        self._size = 0
+        self._since: float | None = None
+        # Generated tokens behind the buffered text (a held-back partial
+        # character or skipped special token adds tokens but no text).
+        self._tokens = 0
+
+    def add(self, text: str, tokens: int = 0):
+        self._tokens += tokens
+        if not text:
+            return
+        if self._since is None:
+            self._since = time.perf_counter()
+        self._parts.append(text)
+        if self.flush_bytes:
+            self._size += len(text.encode("utf-8"))
+
+    def __bool__(self) -> bool:
+        return bool(self._parts)
+
+    def wait_time(self) -> float | None:
+        """
+        Seconds until buffered text is due by age, or None to wait for
+        more tokens.
+        """
+        if not self._parts or not self.flush_s:
+            return None
+        return max(0.0, self._since + self.flush_s - time.perf_counter())
+
+    def due(self) -> bool:
+        if not self._parts:
+            return False
+        if not self.flush_s and not self.flush_bytes:
+            return True
+        if self.flush_bytes and self._size >= self.flush_bytes:
+            return True
+        return bool(self.flush_s) and self.wait_time() == 0.0
+
+    def take(self) -> str:
+        return self.take_counted()[0]
+
+    def take_counted(self) -> tuple[str, int]:
+        """
+        The buffered text and how many tokens it covers.
+        """
+        text, tokens = "".join(self._parts), self._tokens
+        self._parts, self._size, self._since, self._tokens = [], 0, None, 0
+        return text, tokens
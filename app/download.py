@@ -12,6 +12,7 @@ Outputs:
 """
 
 import os
+
 from huggingface_hub import snapshot_download
 
 # In a real production environment, this should be stored securely (e.g. env var, secrets manager)
@@ -8,23 +8,46 @@ Purpose:
 Inputs:
     - Model path (merged or base + adapter)
     - Prompt
+    - `--profile [--compare]`: profile one chat (or base + LoRA compare)
+      request with app/profiling.py
 Outputs:
     - Generated text
+    - Profile traces under PROFILE_DIR (with --profile)
 """
 
+import argparse
+import asyncio
 import os
-import torch
-from threading import Thread
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+import threading
+import time
+from collections.abc import AsyncIterator
 
+from transformers import AutoTokenizer
 
-def get_model_and_tokenizer(model_path: str = "app/models/lora_output"):
+from app.loading import load_pretrained
+from app.merge import (
+    BASE_MODEL_PATH,
+    CHAT_MODEL_PATH,
+    is_adapter,
+    is_merged_current,
+    merged_model_path,
+)
+from app.prefix_cache import encode_chat
+from app.profiling import RequestProfiler, new_profile_name, profile_dir
+from app.quantization import QUANTIZATION
+from app.scheduler import AsyncSink, aiter_text, get_scheduler, iter_text
+
+
+def resolve_model_path(model_path: str = CHAT_MODEL_PATH) -> str:
     """
-    Load model and tokenizer.
+    Return `model_path`, or the base model if it does not exist.
+
+    A LoRA adapter directory resolves to its merged checkpoint
+    (`<adapter>-merged`, built by app/merge.py) when that is up to date.
     """
     # Check if model exists, fallback to base if not
     if not os.path.exists(model_path):
-        base_path = "app/models/base"
+        base_path = BASE_MODEL_PATH
         if os.path.exists(base_path):
             print(
                 f"[INFO] Model not found at '{model_path}', falling back to base model at '{base_path}'"
@@ -34,90 +57,210 @@ def get_model_and_tokenizer(model_path: str = "app/models/lora_output"):
             raise FileNotFoundError(
                 f"Model not found at '{model_path}' and base model not found at '{base_path}'. Please run 'make install'."
             )
+    if is_adapter(model_path) and is_merged_current(model_path):
+        model_path = merged_model_path(model_path)
+    return model_path
+
+
+def _tokenizer_path(model_path: str) -> str:
+    if os.path.exists(os.path.join(model_path, "tokenizer_config.json")):
+        return model_path
+    return BASE_MODEL_PATH
+
+
+def get_tokenizer(model_path: str = CHAT_MODEL_PATH):
+    """
+    Load only the tokenizer (cheap; no model weights).
+    """
+    model_path = resolve_model_path(model_path)
+    return AutoTokenizer.from_pretrained(
+        _tokenizer_path(model_path), trust_remote_code=True
+    )
+
+
+def get_model_and_tokenizer(
+    model_path: str = CHAT_MODEL_PATH,
+    quantization: str = QUANTIZATION,
+    component: str | None = None,
+):
+    """
+    Load model and tokenizer, optionally quantized (see app/quantization.py).
+
+    Adapters without a current merged checkpoint are merged into the base
+    weights in memory, so generation never runs through the PEFT wrapper.
+    The tokenizer loads concurrently with the weights (app/loading.py).
+    """
+    model_path = resolve_model_path(model_path)
 
     print(f"[INFO] Loading model from '{model_path}'...")
-    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(
+    if is_adapter(model_path):
+        print(
+            f"[INFO] No merged checkpoint for '{model_path}', merging in memory "
+            "(run 'make merge' to skip this step)"
+        )
+        return load_pretrained(
+            BASE_MODEL_PATH,
+            quantization,
+            adapter_path=model_path,
+            merge=True,
+            tokenizer_path=_tokenizer_path(model_path),
+            component=component,
+        )
+    return load_pretrained(
         model_path,
-        device_map="auto",
-        trust_remote_code=True,
-        torch_dtype=torch.float16,
+        quantization,
+        tokenizer_path=_tokenizer_path(model_path),
+        component=component,
     )
-    return model, tokenizer
 
 
 # Global cache for model/tokenizer to avoid reloading on every request in "dev" mode
 # In a real prod app, you might manage this differently.
 _MODEL = None
 _TOKENIZER = None
+_MODEL_LOCK = threading.Lock()
+
+CHAT_MAX_NEW_TOKENS = 4096
 
 
 def _ensure_model_loaded():
     global _MODEL, _TOKENIZER
-    if _MODEL is None or _TOKENIZER is None:
-        _MODEL, _TOKENIZER = get_model_and_tokenizer()
+    # Concurrent first requests must not load the model twice.
+    with _MODEL_LOCK:
+        if _MODEL is None or _TOKENIZER is None:
+            _MODEL, _TOKENIZER = get_model_and_tokenizer(
+                CHAT_MODEL_PATH, component="chat"
+            )
     return _MODEL, _TOKENIZER
 
 
+def _submit_chat(
+    prompt: str,
+    cancel: threading.Event | None = None,
+    timeout: float | None = None,
+    sink=None,
+):
+    model, tokenizer = _ensure_model_loaded()
+
+    started = time.perf_counter()
+    input_ids, prefix_len = encode_chat(tokenizer, prompt)
+    tokenize_s = time.perf_counter() - started
+
+    # The shared scheduler batches this request with any other in-flight ones.
+    request = get_scheduler(model, tokenizer).submit(
+        input_ids,
+        max_new_tokens=CHAT_MAX_NEW_TOKENS,
+        label="chat",
+        endpoint="chat",
+        tokenize_s=tokenize_s,
+        prefix_len=prefix_len,
+        sink=sink,
+        cancel=cancel,
+        timeout=timeout,
+    )
+    return request, tokenizer
+
+
 def generate_response(prompt: str) -> str:
     """
     Non-streaming generation (legacy).
     """
     try:
-        model, tokenizer = _ensure_model_loaded()
-
-        messages = [{"role": "user", "content": prompt}]
-        text = tokenizer.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        inputs = tokenizer(text, return_tensors="pt").to(model.device)
-
         print("[INFO] Generating response...")
-        outputs = model.generate(**inputs, max_new_tokens=4096)
-
-        # Decode only the new tokens
-        response = tokenizer.decode(
-            outputs[0][inputs.input_ids.shape[1] :], skip_special_tokens=True
-        )
-        return response
+        request, tokenizer = _submit_chat(prompt)
+        return "".join(iter_text(request, tokenizer))
     except Exception as e:
         return f"[ERROR] Failed to run inference: {e}"
 
 
-def stream_response(prompt: str):
+def stream_response(
+    prompt: str,
+    cancel: threading.Event | None = None,
+    timeout: float | None = None,
+):
     """
     Generator that streams the response token by token.
+
+    Generation stops once `cancel` is set (e.g. the client disconnected) or
+    after `timeout` seconds.
     """
     try:
-        model, tokenizer = _ensure_model_loaded()
-
-        messages = [{"role": "user", "content": prompt}]
-        text = tokenizer.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        inputs = tokenizer(text, return_tensors="pt").to(model.device)
+        request, tokenizer = _submit_chat(prompt, cancel, timeout)
+        for new_text in iter_text(request, tokenizer):
+            yield new_text
 
-        streamer = TextIteratorStreamer(
-            tokenizer, skip_prompt=True, skip_special_tokens=True
-        )
-        generation_kwargs = dict(inputs, streamer=streamer, max_new_tokens=4096)
+    except Exception as e:
+        yield f"[ERROR] Failed to stream inference: {e}"
 
-        thread = Thread(target=model.generate, kwargs=generation_kwargs)
-        thread.start()
 
-        for new_text in streamer:
+async def astream_response(
+    prompt: str,
+    cancel: threading.Event | None = None,
+    timeout: float | None = None,
+) -> AsyncIterator[str]:
+    """
+    Async `stream_response`: tokens are awaited from the scheduler, so an
+    open stream holds no thread while it waits.
+    """
+    try:
+        sink = AsyncSink()
+        # Loading the model (first request) and queueing may block briefly.
+        request, tokenizer = await asyncio.to_thread(
+            _submit_chat, prompt, cancel, timeout, sink
+        )
+        async for new_text in aiter_text(request, tokenizer):
             yield new_text
 
-    except Exception as e:
+    except Exception as e:  # noqa: BLE001
         yield f"[ERROR] Failed to stream inference: {e}"
 
 
-if __name__ == "__main__":
-    # Test run
-    print("Testing non-streaming:")
-    print(generate_response("酒驾撞人怎么判刑？"))
+def profile_request(prompt: str, compare: bool = False) -> str:
+    """
+    Stream one chat (or compare) request under app/profiling.py and return
+    the trace directory.
+    """
+    name = new_profile_name("compare" if compare else "chat")
+    if compare:
+        from app.comparison import stream_compare
 
-    print("\nTesting streaming:")
-    for chunk in stream_response("酒驾撞人怎么判刑？"):
-        print(chunk, end="", flush=True)
+        for line in stream_compare(prompt, profile=name):
+            print(line, end="", flush=True)
+        return profile_dir(name)
+
+    model, _ = _ensure_model_loaded()
+    with RequestProfiler(name, [model]) as profiler:
+        for chunk in stream_response(prompt):
+            print(chunk, end="", flush=True)
     print()
+    return profiler.path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test inference on the chat model")
+    parser.add_argument("--prompt", type=str, default="酒驾撞人怎么判刑？")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile one request; traces go to PROFILE_DIR (app/data/traces)",
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="With --profile: profile the base + LoRA compare path instead",
+    )
+    args = parser.parse_args()
+
+    if args.profile:
+        print(
+            f"[RESULT] Profile written to '{profile_request(args.prompt, args.compare)}'"
+        )
+    else:
+        # Test run
+        print("Testing non-streaming:")
+        print(generate_response(args.prompt))
+
+        print("\nTesting streaming:")
+        for chunk in stream_response(args.prompt):
+            print(chunk, end="", flush=True)
+        print()
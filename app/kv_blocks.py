@@ -0,0 +1,154 @@
+"""
+app/kv_blocks.py
+
+Purpose:
+    Fixed memory budget for the KV caches of concurrent streams. The budget
+    (`KV_CACHE_BUDGET_MB`) is split into fixed-size blocks of
+    `KV_BLOCK_SIZE` token positions. The scheduler takes blocks from the
+    free list as a sequence's cache grows and returns them when it shrinks
+    or finishes. A request whose prompt does not fit waits in the scheduler
+    queue instead of being prefilled, and a running sequence that cannot
+    grow is preempted and recomputed later. Cache memory therefore stays
+    within the budget however many sessions are open, and `utilization()`
+    tells admission control how full it is.
+
+    Blocks are an accounting unit, not separate storage. The running batch
+    keeps one left-padded tensor per layer, because the attention kernels
+    need contiguous keys/values. Each row is charged for the padded batch
+    length, which is the memory it really occupies. The model's temporary
+    copies during a forward pass are not counted.
+
+Inputs:
+    - `KV_CACHE_BUDGET_MB`: KV cache budget per model (default 1024).
+    - `KV_BLOCK_SIZE`: token positions per block (default 16).
+    - `KV_ADMISSION_UTILIZATION`: utilization (0-1) at which the server
+      rejects new requests with 429 (default 0.95, 0 disables the check).
+
+Outputs:
+    - `KVBlockManager`: per-sequence block tables, utilization and stats.
+    - `combine_stats`: totals over several managers / worker processes.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from collections import deque
+from collections.abc import Iterable
+
+import torch
+
+KV_CACHE_BUDGET_MB = int(os.environ.get("KV_CACHE_BUDGET_MB", "1024"))
+KV_BLOCK_SIZE = int(os.environ.get("KV_BLOCK_SIZE", "16"))
+KV_ADMISSION_UTILIZATION = float(os.environ.get("KV_ADMISSION_UTILIZATION", "0.95"))
+
+
+def kv_bytes_per_token(config, dtype: torch.dtype) -> int:
+    """
+    Bytes of keys + values one token position takes across all layers.
+    """
+    heads = config.num_attention_heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+    element = torch.tensor([], dtype=dtype).element_size()
+    return 2 * config.num_hidden_layers * kv_heads * head_dim * element
+
+
+class KVBlockManager:
+    """
+    Free list of KV blocks plus a block table per sequence.
+    """
+
+    def __init__(
+        self,
+        bytes_per_token: int,
+        budget_mb: int = KV_CACHE_BUDGET_MB,
+        block_size: int = KV_BLOCK_SIZE,
+    ):
+        self.block_size = block_size
+        self.block_bytes = bytes_per_token * block_size
+        self.num_blocks = max(1, budget_mb * 2**20 // self.block_bytes)
+        self.preempted = 0
+        self._free = deque(range(self.num_blocks))
+        self._tables: dict[int, list[int]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_model(cls, model, **kwargs) -> KVBlockManager:
+        return cls(kv_bytes_per_token(model.config, model.dtype), **kwargs)
+
+    def blocks_for(self, tokens: int) -> int:
+        return -(-tokens // self.block_size)
+
+    @property
+    def capacity_tokens(self) -> int:
+        return self.num_blocks * self.block_size
+
+    def reserve(self, sizes: dict[int, int]) -> bool:
+        """
+        Resize the tables of several sequences to {seq_id: tokens} at once.
+
+        All or nothing: returns False, changing nothing, if the growth does
+        not fit in the free blocks. Shrinking always succeeds.
+        """
+        with self._lock:
+            growth = sum(
+                max(0, self.blocks_for(tokens) - len(self._tables.get(seq_id, ())))
+                for seq_id, tokens in sizes.items()
+            )
+            if growth > len(self._free):
+                return False
+            for seq_id, tokens in sizes.items():
+                needed = self.blocks_for(tokens)
+                table = self._tables.setdefault(seq_id, [])
+                while len(table) < needed:
+                    table.append(self._free.popleft())
+                while len(table) > needed:
+                    self._free.append(table.pop())
+                if not table:
+                    del self._tables[seq_id]
+            return True
+
+    def free(self, seq_id: int):
+        with self._lock:
+            self._free.extend(self._tables.pop(seq_id, ()))
+
+    def used_blocks(self) -> int:
+        with self._lock:
+            return self.num_blocks - len(self._free)
+
+    def utilization(self) -> float:
+        return self.used_blocks() / self.num_blocks
+
+    def stats(self) -> dict:
+        with self._lock:
+            used = self.num_blocks - len(self._free)
+            sequences = len(self._tables)
+        return {
+            "block_size": self.block_size,
+            "block_bytes": self.block_bytes,
+            "blocks_total": self.num_blocks,
+            "blocks_used": used,
+            "utilization": used / self.num_blocks,
+            "sequences": sequences,
+            "preempted": self.preempted,
+        }
+
+
+def combine_stats(stats: Iterable[dict]) -> dict:
+    """
+    Sum block counts over managers; utilization is that of the fullest one,
+    since that is the one that starts deferring requests first.
+    """
+    combined = {
+        "blocks_total": 0,
+        "blocks_used": 0,
+        "utilization": 0.0,
+        "sequences": 0,
+        "preempted": 0,
+    }
+    for entry in stats:
+        for key in ("blocks_total", "blocks_used", "sequences", "preempted"):
+            combined[key] += entry[key]
+        combined["utilization"] = max(combined["utilization"], entry["utilization"])
+    return combined
@@ -0,0 +1,70 @@
+"""
+app/kv_cache.py
+
+Purpose:
+    Helpers for the legacy KV-cache layout shared by the scheduler, the
+    prefix cache and the benchmark: conversion to/from `DynamicCache`,
+    left padding along the time axis and memory accounting.
+
+Inputs:
+    - past_key_values as returned by a HuggingFace causal LM forward pass.
+
+Outputs:
+    - `PastKeyValues` tuples: one (key, value) pair per layer, each shaped
+      [batch, kv_heads, time, head_dim].
+"""
+
+from __future__ import annotations
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # Older transformers only understand legacy tuples.
+    DynamicCache = None
+
+
+PastKeyValues = tuple[tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def to_model_cache(past: PastKeyValues | None):
+    """
+    Wrap legacy tuples for the model. Tensors are shared, not copied; the
+    model concatenates new keys/values into fresh tensors, so `past` itself
+    is never modified and can be reused across requests.
+    """
+    if past is None or DynamicCache is None:
+        return past
+    return DynamicCache.from_legacy_cache(past)
+
+
+def to_legacy(past) -> PastKeyValues:
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return past
+
+
+def left_pad(past: PastKeyValues, length: int) -> PastKeyValues:
+    """
+    Left-pad every layer's keys/values with zeros up to `length` positions.
+    """
+    padded = []
+    for key, value in past:
+        pad = length - key.shape[2]
+        if pad:
+            key = F.pad(key, (0, 0, pad, 0))
+            value = F.pad(value, (0, 0, pad, 0))
+        padded.append((key, value))
+    return tuple(padded)
+
+
+def past_length(past: PastKeyValues) -> int:
+    return past[0][0].shape[2]
+
+
+def past_nbytes(past: PastKeyValues) -> int:
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in past
+    )
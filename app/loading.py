@@ -0,0 +1,218 @@
+"""
+app/loading.py
+
+Purpose:
+    Model loading for fast cold starts. The tokenizer loads on a second
+    thread while the weights load. Weights go through transformers'
+    low-memory safetensors path: the file is memory-mapped and each tensor
+    is materialized once, straight into the model, with no randomly
+    initialized copy first. An adapter is attached to the already loaded
+    base instead of loading the base a second time. With `SHARED_WEIGHTS=1`
+    the base weights are mapped from one file shared by every process on
+    the host instead (app/shared_weights.py). `WARMUP` tracks what is
+    loading, so the server can answer readiness probes while it warms
+    up instead of blocking startup.
+
+Inputs:
+    - Model / adapter / tokenizer paths and the quantization mode.
+
+Outputs:
+    - `load_pretrained`: (model, tokenizer), optionally with a LoRA adapter
+      attached (or merged) and quantized.
+    - `WARMUP.snapshot()`: per-component status, load time, peak RSS and
+      current RSS / PSS (served by `GET /api/ready`).
+"""
+
+from __future__ import annotations
+
+import glob
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from app.quantization import QUANTIZATION, model_load_kwargs, quantize_model
+from app.shared_weights import SHARED_WEIGHTS, load_shared_model, unsupported_reason
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process so far, in MB (0 if unknown).
+    """
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes.
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def memory_mb() -> dict[str, float]:
+    """
+    Current RSS and PSS of this process in MB (Linux only, else empty).
+
+    PSS splits pages shared with other processes (such as mapped shared
+    weights) between them, so summing it over workers gives their real
+    footprint; RSS counts shared pages in full in every process.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return {}
+    return {
+        f"{name.lower()}_mb": int(fields[name].split()[0]) / 1024
+        for name in ("Rss", "Pss")
+        if name in fields
+    }
+
+
+class Warmup:
+    """
+    Load progress of named model components ("compare", "chat", ...).
+    """
+
+    def __init__(self):
+        self._components: dict[str, dict] = {}
+        self._expected = set()
+        self._lock = threading.Lock()
+
+    def expect(self, name: str):
+        """
+        Mark `name` as required before the process reports ready.
+        """
+        with self._lock:
+            self._expected.add(name)
+            self._components.setdefault(name, {"status": "pending"})
+
+    def stage(self, name: str, stage: str):
+        with self._lock:
+            component = self._components.setdefault(name, {})
+            component.setdefault("started", time.perf_counter())
+            component.update(status="loading", stage=stage)
+
+    def ready(self, name: str):
+        with self._lock:
+            component = self._components.setdefault(name, {})
+            seconds = time.perf_counter() - component.get(
+                "started", time.perf_counter()
+            )
+            component.update(
+                status="ready", stage=None, seconds=seconds, peak_rss_mb=peak_rss_mb()
+            )
+
+    def failed(self, name: str, error: str):
+        with self._lock:
+            self._components.setdefault(name, {}).update(status="failed", error=error)
+
+    def snapshot(self) -> dict:
+        now = time.perf_counter()
+        with self._lock:
+            components = {}
+            for name, component in self._components.items():
+                entry = {k: v for k, v in component.items() if k != "started"}
+                if component.get("status") == "loading":
+                    entry["seconds"] = now - component["started"]
+                components[name] = entry
+            ready = all(
+                self._components[name].get("status") == "ready"
+                for name in self._expected
+            )
+        return {
+            "ready": ready,
+            "components": components,
+            "peak_rss_mb": peak_rss_mb(),
+            **memory_mb(),
+        }
+
+
+WARMUP = Warmup()
+
+
+def weights_kwargs(model_path: str, quantization: str = QUANTIZATION) -> dict:
+    """
+    `from_pretrained` kwargs for a fast, single-copy load.
+    """
+    kwargs = {
+        "trust_remote_code": True,
+        "low_cpu_mem_usage": True,
+        **model_load_kwargs(quantization),
+    }
+    if glob.glob(os.path.join(model_path, "*.safetensors")):
+        kwargs["use_safetensors"] = True
+    return kwargs
+
+
+def _load_weights(model_path: str, quantization: str, shared: bool):
+    if shared:
+        reason = unsupported_reason(model_path, quantization)
+        if reason is None:
+            return load_shared_model(model_path, quantization)
+        print(f"[INFO] Not sharing weights of '{model_path}': {reason}")
+    return AutoModelForCausalLM.from_pretrained(
+        model_path, **weights_kwargs(model_path, quantization)
+    )
+
+
+def load_pretrained(
+    model_path: str,
+    quantization: str = QUANTIZATION,
+    *,
+    adapter_path: str | None = None,
+    adapter_name: str = "default",
+    merge: bool = False,
+    tokenizer_path: str | None = None,
+    component: str | None = None,
+):
+    """
+    Load weights from `model_path` and the tokenizer (default: same path)
+    concurrently, attach (or merge) a LoRA adapter and quantize.
+
+    Progress is reported to `WARMUP` under `component`. Unless the adapter
+    is merged (which writes into the base weights), `SHARED_WEIGHTS` maps
+    the weights from the host-wide shared copy.
+    """
+    component = component or model_path
+    started = time.perf_counter()
+    try:
+        WARMUP.stage(component, "weights")
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenizer") as pool:
+            tokenizer_future = pool.submit(
+                AutoTokenizer.from_pretrained,
+                tokenizer_path or model_path,
+                trust_remote_code=True,
+            )
+            model = _load_weights(
+                model_path, quantization, SHARED_WEIGHTS and not merge
+            )
+            tokenizer = tokenizer_future.result()
+        if adapter_path:
+            WARMUP.stage(component, "adapter")
+            model = PeftModel.from_pretrained(
+                model, adapter_path, adapter_name=adapter_name
+            )
+            if merge:
+                model = model.merge_and_unload()
+        if quantization != "none":
+            WARMUP.stage(component, "quantize")
+        # Quantize after attaching: PEFT wraps plain nn.Linear targets, and
+        # the LoRA A/B matrices stay in float.
+        model = quantize_model(model, quantization)
+        model.eval()
+    except Exception as e:
+        WARMUP.failed(component, str(e))
+        raise
+    WARMUP.ready(component)
+    print(
+        f"[INFO] Loaded '{component}' in {time.perf_counter() - started:.1f}s "
+        f"(peak RSS {peak_rss_mb():.0f} MB)"
+    )
+    return model, tokenizer
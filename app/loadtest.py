@@ -0,0 +1,496 @@
+"""
+app/loadtest.py
+
+Purpose:
+    Load generator and latency benchmark for the HTTP endpoints. Drives
+    `/api/chat` and/or `/api/compare` of a running server at a fixed
+    concurrency (closed loop) or a Poisson arrival rate (open loop), with
+    prompts sampled from the local dataset, and parses the streamed
+    text/NDJSON responses as they arrive. Uses only the standard library
+    HTTP-over-asyncio, so it runs anywhere the app does, including against
+    the tiny stand-in model (app/tiny_model.py).
+
+Inputs:
+    - `--url`: server base URL (default http://localhost:8234).
+    - `--endpoints`: "chat", "compare" or "chat,compare" (random mix).
+    - `--requests`, `--concurrency`, `--rate` (req/s, 0 = closed loop).
+    - Prompts: `--data-dir` JSONL files ("input"/"instruction"), sampled
+      with `--seed`; a few built-in questions if none are found.
+
+Outputs:
+    - A table of p50/p95/p99 time-to-first-token, inter-token latency and
+      end-to-end latency per endpoint (and per compare variant), error
+      counts by status and aggregate streamed tokens/s.
+    - `--output` JSON with the same numbers plus the run configuration;
+      `--baseline` prints the change against an earlier JSON result.
+
+    Streamed deltas can carry several tokens: tokens that queue up while a
+    stream is busy are sent as one chunk (app/detokenizer.py). Compare
+    NDJSON lines report their count in "tokens". The plain-text chat stream
+    cannot, so its chunks are re-tokenized with `--tokenizer` (one token per
+    chunk if no tokenizer can be loaded). A chunk of k tokens that arrived g
+    seconds after the previous one counts as k inter-token gaps of g / k.
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+from collections.abc import AsyncIterator, Callable
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+from app.metrics import percentile
+from app.sampling import sample_jsonl
+
+DEFAULT_URL = "http://localhost:8234"
+DEFAULT_TOKENIZER = os.environ.get("BASE_MODEL_PATH", "app/models/base")
+DATA_DIR = "app/data/train"  # Matches download.py
+OUTPUT_FILE = "loadtest_results.json"
+PERCENTILES = (50, 95, 99)
+FALLBACK_PROMPTS = [
+    "酒驾撞人怎么判刑？",
+    "劳动合同到期不续签有补偿吗？",
+    "借钱不还可以起诉吗？需要哪些证据？",
+    "离婚时夫妻共同财产如何分割？",
+    "交通事故对方全责，我可以要求哪些赔偿？",
+]
+
+
+@dataclass
+class VariantStream:
+    """
+    Timing of one streamed answer (the chat answer or one compare side).
+    """
+
+    first_token: float | None = None
+    last_token: float | None = None
+    finished: float | None = None
+    tokens: int = 0
+    gaps: list[float] = field(default_factory=list)
+    error: str | None = None
+
+    def token(self, now: float, count: int = 1):
+        """
+        Record a chunk of `count` tokens arriving at `now`.
+        """
+        if count <= 0:
+            return
+        if self.first_token is None:
+            self.first_token = now
+        else:
+            self.gaps.extend([(now - self.last_token) / count] * count)
+        self.last_token = now
+        self.tokens += count
+
+
+@dataclass
+class RequestResult:
+    endpoint: str
+    scheduled: float
+    status: int = 0
+    error: str | None = None
+    finished: float | None = None
+    variants: dict[str, VariantStream] = field(default_factory=dict)
+
+
+def load_prompts(data_dir: str, count: int, seed: int) -> list[str]:
+    """
+    `count` questions sampled from the JSONL files in `data_dir`.
+    """
+    files = sorted(glob.glob(os.path.join(data_dir, "*.jsonl")))
+    prompts = []
+    if files:
+        for record in sample_jsonl(files, count, seed):
+            prompt = record.get("input", record.get("instruction", "")) or ""
+            if prompt.strip():
+                prompts.append(prompt)
+    if not prompts:
+        print(f"[INFO] No prompts found in '{data_dir}', using built-in questions")
+        prompts = list(FALLBACK_PROMPTS)
+    return prompts
+
+
+class _Response:
+    """
+    Minimal streaming HTTP/1.1 response reader (chunked or sized body).
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.status = 0
+        self.headers: dict[str, str] = {}
+
+    async def read_head(self):
+        status_line = await self.reader.readline()
+        self.status = int(status_line.split()[1])
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").strip()
+            if not line:
+                return
+            name, _, value = line.partition(":")
+            self.headers[name.strip().lower()] = value.strip()
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        if self.headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    return
+                chunk = await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+                yield chunk
+        elif "content-length" in self.headers:
+            yield await self.reader.readexactly(int(self.headers["content-length"]))
+        else:
+            while True:
+                chunk = await self.reader.read(65536)
+                if not chunk:
+                    return
+                yield chunk
+
+    def close(self):
+        self.writer.close()
+
+
+async def _post(url: str, path: str, payload: dict, headers: dict) -> _Response:
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port, ssl=parts.scheme == "https" or None
+    )
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = [
+        f"POST {parts.path.rstrip('/')}{path} HTTP/1.1",
+        f"Host: {parts.netloc}",
+        "Content-Type: application/json",
+        f"Content-Length: {len(body)}",
+        "Connection: close",
+        *(f"{name}: {value}" for name, value in headers.items()),
+    ]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("utf-8") + body)
+    await writer.drain()
+    response = _Response(reader, writer)
+    await response.read_head()
+    return response
+
+
+def load_token_counter(tokenizer_path: str) -> Callable[[str], int]:
+    """
+    Count the tokens in a chunk of streamed text with the model's tokenizer,
+    or one per chunk if it cannot be loaded.
+    """
+    try:
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(
+            tokenizer_path, trust_remote_code=True
+        )
+    except (ImportError, OSError, ValueError) as e:
+        print(
+            f"[INFO] No tokenizer at '{tokenizer_path}' ({e}); counting one token "
+            f"per chat chunk"
+        )
+        return lambda text: 1
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+async def _read_chat(
+    response: _Response, result: RequestResult, count_tokens: Callable[[str], int]
+):
+    stream = result.variants.setdefault("chat", VariantStream())
+    async for chunk in response.chunks():
+        text = chunk.decode("utf-8", errors="replace")
+        if "[ERROR]" in text:
+            stream.error = text.strip()
+        elif text:
+            stream.token(time.perf_counter(), max(1, count_tokens(text)))
+    stream.finished = time.perf_counter()
+
+
+async def _read_compare(
+    response: _Response, result: RequestResult, count_tokens: Callable[[str], int]
+):
+    buffer = b""
+    async for chunk in response.chunks():
+        now = time.perf_counter()
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            stream = result.variants.setdefault(event["model"], VariantStream())
+            delta = event.get("delta", "")
+            if delta.startswith("[ERROR]"):
+                stream.error = delta
+            elif "tokens" in event:
+                stream.token(now, event["tokens"])
+            elif delta:
+                stream.token(now, max(1, count_tokens(delta)))
+            if event.get("done"):
+                stream.finished = now
+
+
+async def run_request(
+    url: str,
+    endpoint: str,
+    prompt: str,
+    scheduled: float,
+    headers: dict,
+    count_tokens: Callable[[str], int],
+) -> RequestResult:
+    """
+    Send one request and time its stream. Latencies are measured from
+    `scheduled` (the intended send time), so client-side queueing under an
+    arrival rate counts against the server like real users would see it.
+    """
+    result = RequestResult(endpoint=endpoint, scheduled=scheduled)
+    try:
+        response = await _post(url, f"/api/{endpoint}", {"message": prompt}, headers)
+        try:
+            result.status = response.status
+            if response.status != 200:
+                result.error = f"HTTP {response.status}"
+                return result
+            if endpoint == "chat":
+                await _read_chat(response, result, count_tokens)
+            else:
+                await _read_compare(response, result, count_tokens)
+        finally:
+            response.close()
+    except (OSError, ValueError, asyncio.IncompleteReadError) as exc:
+        result.error = f"{type(exc).__name__}: {exc}"
+    finally:
+        result.finished = time.perf_counter()
+    errors = [stream.error for stream in result.variants.values() if stream.error]
+    if result.error is None and errors:
+        result.error = errors[0]
+    return result
+
+
+async def run_load(
+    url: str,
+    endpoints: list[str],
+    prompts: list[str],
+    requests: int,
+    concurrency: int,
+    rate: float,
+    seed: int,
+    headers: dict,
+    count_tokens: Callable[[str], int],
+) -> tuple[list[RequestResult], float]:
+    """
+    Fire `requests` requests; returns their results and the wall time.
+
+    With `rate` > 0 arrivals are Poisson at `rate` req/s (open loop) and at
+    most `concurrency` are in flight; otherwise `concurrency` clients send
+    back to back (closed loop).
+    """
+    rng = random.Random(seed)
+    jobs = [(rng.choice(endpoints), prompts[i % len(prompts)]) for i in range(requests)]
+    slots = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+
+    async def one(endpoint: str, prompt: str, scheduled: float | None):
+        async with slots:
+            # Closed loop: a request's clock starts when it gets a client.
+            scheduled = scheduled or time.perf_counter()
+            return await run_request(
+                url, endpoint, prompt, scheduled, headers, count_tokens
+            )
+
+    tasks = []
+    arrival = started
+    for endpoint, prompt in jobs:
+        scheduled = None
+        if rate > 0:
+            arrival += rng.expovariate(rate)
+            await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+            scheduled = arrival
+        tasks.append(asyncio.create_task(one(endpoint, prompt, scheduled)))
+    results = await asyncio.gather(*tasks)
+    return list(results), time.perf_counter() - started
+
+
+def _distribution(values: list[float]) -> dict[str, float]:
+    summary = {f"p{q}": percentile(values, q) for q in PERCENTILES}
+    summary["mean"] = sum(values) / len(values) if values else 0.0
+    return summary
+
+
+def summarize(results: list[RequestResult], wall: float) -> dict:
+    """
+    Latency percentiles (seconds) per group ("chat", "compare:base",
+    "compare:lora", ...) plus totals.
+    """
+    groups: dict[str, dict[str, list]] = {}
+    errors: dict[str, int] = {}
+    for result in results:
+        if result.error:
+            kind = f"HTTP {result.status}" if result.status != 200 else "stream"
+            errors[kind] = errors.get(kind, 0) + 1
+            continue
+        for variant, stream in result.variants.items():
+            name = result.endpoint if variant == "chat" else f"compare:{variant}"
+            group = groups.setdefault(
+                name, {"ttft": [], "itl": [], "e2e": [], "tokens": []}
+            )
+            if stream.first_token is not None:
+                group["ttft"].append(stream.first_token - result.scheduled)
+            group["itl"].extend(stream.gaps)
+            group["e2e"].append((stream.finished or result.finished) - result.scheduled)
+            group["tokens"].append(stream.tokens)
+
+    tokens = sum(sum(group["tokens"]) for group in groups.values())
+    ok = sum(1 for result in results if not result.error)
+    return {
+        "requests": len(results),
+        "ok": ok,
+        "errors": errors,
+        "wall_s": wall,
+        "requests_per_s": ok / wall if wall > 0 else 0.0,
+        "tokens": tokens,
+        "tokens_per_s": tokens / wall if wall > 0 else 0.0,
+        "groups": {
+            name: {
+                "streams": len(group["e2e"]),
+                "ttft": _distribution(group["ttft"]),
+                "itl": _distribution(group["itl"]),
+                "e2e": _distribution(group["e2e"]),
+                "tokens_per_stream": (
+                    sum(group["tokens"]) / len(group["tokens"])
+                    if group["tokens"]
+                    else 0
+                ),
+            }
+            for name, group in sorted(groups.items())
+        },
+    }
+
+
+def print_summary(summary: dict, baseline: dict | None = None):
+    print(
+        f"[RESULT] {summary['ok']}/{summary['requests']} ok in "
+        f"{summary['wall_s']:.1f}s: {summary['requests_per_s']:.2f} req/s, "
+        f"{summary['tokens_per_s']:.1f} tokens/s"
+        + (f", errors={summary['errors']}" if summary["errors"] else "")
+    )
+    header = "| Group | Metric | " + " | ".join(f"p{q} ms" for q in PERCENTILES)
+    print(header + (" | vs baseline p50 |" if baseline else " |"))
+    print("|" + "---|" * (len(PERCENTILES) + 2 + bool(baseline)))
+    for name, group in summary["groups"].items():
+        for metric in ("ttft", "itl", "e2e"):
+            values = " | ".join(
+                f"{group[metric][f'p{q}'] * 1000:.1f}" for q in PERCENTILES
+            )
+            row = f"| {name} | {metric} | {values} |"
+            old = (baseline or {}).get("groups", {}).get(name, {}).get(metric)
+            if baseline:
+                new_p50, old_p50 = group[metric]["p50"], (old or {}).get("p50")
+                row += f" {(new_p50 - old_p50) / old_p50:+.1%} |" if old_p50 else " - |"
+            print(row)
+    if baseline:
+        old = baseline.get("tokens_per_s") or 0
+        if old:
+            change = (summary["tokens_per_s"] - old) / old
+            print(f"[RESULT] tokens/s vs baseline: {change:+.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-test /api/chat and /api/compare of a running server"
+    )
+    parser.add_argument("--url", default=DEFAULT_URL, help="Server base URL")
+    parser.add_argument(
+        "--endpoints",
+        default="chat,compare",
+        help="Comma-separated endpoints to mix: chat, compare",
+    )
+    parser.add_argument("--requests", type=int, default=50, help="Total requests")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Max requests in flight"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="Poisson arrival rate in req/s (0 = closed loop at --concurrency)",
+    )
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Prompt JSONL directory")
+    parser.add_argument("--seed", type=int, default=42, help="Prompt/mix seed")
+    parser.add_argument(
+        "--tokenizer",
+        default=DEFAULT_TOKENIZER,
+        help="Tokenizer for counting tokens in chat chunks",
+    )
+    parser.add_argument(
+        "--admin-token",
+        default=os.environ.get("ADMIN_TOKEN"),
+        help="X-Admin-Token to send (only needed with --header X-Profile:1)",
+    )
+    parser.add_argument(
+        "--header",
+        action="append",
+        default=[],
+        help="Extra request header 'Name:value' (repeatable)",
+    )
+    parser.add_argument("--output", default=OUTPUT_FILE, help="Results JSON file")
+    parser.add_argument(
+        "--baseline", default=None, help="Earlier results JSON to compare with"
+    )
+    args = parser.parse_args()
+
+    endpoints = [name.strip() for name in args.endpoints.split(",") if name.strip()]
+    unknown = [name for name in endpoints if name not in ("chat", "compare")]
+    if unknown or not endpoints:
+        parser.error(f"Unknown endpoints {unknown}; use chat and/or compare")
+    headers = {
+        name.strip(): value.strip()
+        for name, _, value in (header.partition(":") for header in args.header)
+    }
+    if args.admin_token:
+        headers["X-Admin-Token"] = args.admin_token
+
+    prompts = load_prompts(args.data_dir, args.requests, args.seed)
+    count_tokens = (
+        load_token_counter(args.tokenizer) if "chat" in endpoints else (lambda text: 1)
+    )
+    mode = f"{args.rate:g} req/s" if args.rate > 0 else "closed loop"
+    print(
+        f"[INFO] {args.requests} requests to {args.url} ({','.join(endpoints)}), "
+        f"concurrency={args.concurrency}, {mode}, {len(prompts)} prompts"
+    )
+    results, wall = asyncio.run(
+        run_load(
+            args.url,
+            endpoints,
+            prompts,
+            args.requests,
+            args.concurrency,
+            args.rate,
+            args.seed,
+            headers,
+            count_tokens,
+        )
+    )
+    summary = summarize(results, wall)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+
+    config = {key: value for key, value in vars(args).items() if key != "admin_token"}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"config": config, **summary}, f, indent=2, ensure_ascii=False)
+    print(f"[INFO] Results written to '{args.output}'")
+
+
+if __name__ == "__main__":
+    main()
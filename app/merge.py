@@ -0,0 +1,143 @@
+"""
+app/merge.py
+
+Purpose:
+    Model Merger: fold a LoRA adapter into the base weights ahead of time and
+    save a standalone checkpoint. Serving the merged model avoids PEFT's
+    extra low-rank matmuls on every adapted projection at every decode step.
+
+Inputs:
+    - Base model path (default app/models/base, env BASE_MODEL_PATH)
+    - LoRA adapter path (default: the adapter the chat endpoint serves,
+      `CHAT_MODEL_PATH`, which defaults to `LORA_ADAPTER_PATH`,
+      app/models/law-qa-qwen-lora)
+    - Output dtype
+Outputs:
+    - `<adapter>-merged/`: safetensors weights, config, generation config and
+      tokenizer, loadable with `AutoModelForCausalLM.from_pretrained`
+"""
+
+import argparse
+import json
+import os
+
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# Overridable so the whole app can run on a stand-in model (app/tiny_model.py).
+BASE_MODEL_PATH = os.environ.get("BASE_MODEL_PATH", "app/models/base")
+LORA_ADAPTER_PATH = os.environ.get("LORA_ADAPTER_PATH", "app/models/law-qa-qwen-lora")
+# The chat endpoint's model (app/inference.py): a full model, or a LoRA
+# adapter served from its merged checkpoint when one is up to date.
+CHAT_MODEL_PATH = os.environ.get("CHAT_MODEL_PATH", LORA_ADAPTER_PATH)
+MERGE_INFO_FILE = "merge_info.json"
+ADAPTER_WEIGHT_FILES = ("adapter_model.safetensors", "adapter_model.bin")
+
+
+def is_adapter(path: str) -> bool:
+    """
+    True if `path` is a PEFT adapter directory rather than a full model.
+    """
+    return os.path.exists(os.path.join(path, "adapter_config.json")) and not (
+        os.path.exists(os.path.join(path, "config.json"))
+    )
+
+
+def merged_model_path(adapter_path: str) -> str:
+    """
+    Where the merged checkpoint for `adapter_path` lives.
+    """
+    return os.path.normpath(adapter_path) + "-merged"
+
+
+def _adapter_weights(adapter_path: str):
+    for name in ADAPTER_WEIGHT_FILES:
+        path = os.path.join(adapter_path, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_merged_current(adapter_path: str) -> bool:
+    """
+    True if a merged checkpoint exists and was built from the adapter's
+    current weights (same size and mtime).
+    """
+    info_path = os.path.join(merged_model_path(adapter_path), MERGE_INFO_FILE)
+    if not os.path.exists(info_path):
+        return False
+    with open(info_path, "r", encoding="utf-8") as f:
+        info = json.load(f)
+    weights = _adapter_weights(adapter_path)
+    if weights is None:
+        return True
+    stat = os.stat(weights)
+    return info.get("adapter_weights") == [stat.st_size, stat.st_mtime_ns]
+
+
+def merge_adapter(
+    base_model_path: str = BASE_MODEL_PATH,
+    adapter_path: str = LORA_ADAPTER_PATH,
+    output_dir: str | None = None,
+    dtype: str = "float16",
+) -> str:
+    """
+    Merge `adapter_path` into `base_model_path` and save it to `output_dir`.
+
+    The merge itself runs in float32 on CPU so rounding happens once, when
+    the merged weights are cast to `dtype` for saving.
+    """
+    output_dir = output_dir or merged_model_path(adapter_path)
+    weights = _adapter_weights(adapter_path)
+    if weights is None:
+        raise FileNotFoundError(f"No adapter weights found in '{adapter_path}'")
+
+    print(f"[INFO] Loading base model from '{base_model_path}'...")
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model_path, torch_dtype=torch.float32, trust_remote_code=True
+    )
+    print(f"[INFO] Merging adapter '{adapter_path}'...")
+    model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+    model = model.to(getattr(torch, dtype))
+
+    tokenizer_path = adapter_path
+    if not os.path.exists(os.path.join(adapter_path, "tokenizer_config.json")):
+        tokenizer_path = base_model_path
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, trust_remote_code=True)
+
+    print(f"[INFO] Saving merged model to '{output_dir}'...")
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    tokenizer.save_pretrained(output_dir)
+    stat = os.stat(weights)
+    with open(os.path.join(output_dir, MERGE_INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "base_model": os.path.abspath(base_model_path),
+                "adapter": os.path.abspath(adapter_path),
+                "adapter_weights": [stat.st_size, stat.st_mtime_ns],
+                "dtype": dtype,
+            },
+            f,
+            indent=2,
+        )
+    print("[INFO] Merge complete.")
+    return output_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base_model", default=BASE_MODEL_PATH)
+    # By default, merge the adapter chat serves so it picks up the result.
+    parser.add_argument(
+        "--adapter",
+        default=CHAT_MODEL_PATH if is_adapter(CHAT_MODEL_PATH) else LORA_ADAPTER_PATH,
+    )
+    parser.add_argument("--output", default=None, help="Defaults to '<adapter>-merged'")
+    parser.add_argument(
+        "--dtype", default="float16", choices=["float16", "bfloat16", "float32"]
+    )
+    args = parser.parse_args()
+
+    merge_adapter(args.base_model, args.adapter, args.output, args.dtype)
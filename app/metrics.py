@@ -0,0 +1,279 @@
+"""
+app/metrics.py
+
+Purpose:
+    Minimal Prometheus-style metrics for the serving path (no extra
+    dependency). The scheduler records a latency breakdown for every
+    finished request -- queue wait, tokenization/chat template, prefill,
+    time-to-first-token, inter-token latency, generated tokens and tokens/s
+    -- labelled by endpoint and variant, so a slowdown can be pinned on
+    queueing, prefill or decode.
+
+Inputs:
+    - `GenerationRequest`s finished by app/scheduler.py.
+    - Snapshots from model-worker processes (SERVE_WORKERS > 0).
+
+Outputs:
+    - `METRICS.render()`: Prometheus text exposition format for `/metrics`.
+    - `METRICS.snapshot()` / `merge_snapshots`: plain dicts for combining
+      the metrics of several processes.
+"""
+
+from __future__ import annotations
+
+import bisect
+import json
+import math
+import threading
+from collections.abc import Iterable, Sequence
+
+# Seconds; covers sub-millisecond inter-token gaps up to long queue waits.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _label_key(labelnames: Sequence[str], labels: dict[str, str]) -> str:
+    return json.dumps([str(labels.get(name, "")) for name in labelnames])
+
+
+def _format_labels(labelnames: Sequence[str], key: str, extra: str = "") -> str:
+    values = json.loads(key)
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.kind = "counter"
+        self._values: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def lines(self, series: dict) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {value:g}"
+            for key, value in sorted(series.items())
+        ]
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.kind = "histogram"
+        self.buckets = tuple(buckets)
+        self._values: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        self.observe_many([value], **labels)
+
+    def observe_many(self, values: Iterable[float], **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            series = self._values.setdefault(
+                key, {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            )
+            for value in values:
+                series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+                series["sum"] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                key: {"counts": list(series["counts"]), "sum": series["sum"]}
+                for key, series in self._values.items()
+            }
+
+    def lines(self, series: dict) -> list[str]:
+        lines = []
+        for key, value in sorted(series.items()):
+            cumulative = 0
+            bounds = [*(f"{bound:g}" for bound in self.buckets), "+Inf"]
+            for bound, count in zip(bounds, value["counts"]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {value['sum']:g}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def _merge_series(kind: str, into: dict, series: dict):
+    for key, value in series.items():
+        if kind == "counter":
+            into[key] = into.get(key, 0.0) + value
+        elif key not in into:
+            into[key] = {"counts": list(value["counts"]), "sum": value["sum"]}
+        else:
+            into[key]["counts"] = [
+                a + b for a, b in zip(into[key]["counts"], value["counts"])
+            ]
+            into[key]["sum"] += value["sum"]
+
+
+def merge_snapshots(snapshots: Iterable[dict]) -> dict:
+    """
+    Sum the series of several `MetricsRegistry.snapshot()` results.
+    """
+    merged: dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, (kind, series) in snapshot.items():
+            _merge_series(kind, merged.setdefault(name, (kind, {}))[1], series)
+    return merged
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._metrics.setdefault(
+            name, Histogram(name, help, labelnames, buckets)
+        )
+
+    def snapshot(self) -> dict[str, tuple[str, dict]]:
+        return {
+            name: (metric.kind, metric.snapshot())
+            for name, metric in self._metrics.items()
+        }
+
+    def render(
+        self,
+        snapshot: dict | None = None,
+        extra: dict[str, tuple[str, str, float]] | None = None,
+    ) -> str:
+        """
+        Prometheus text format for `snapshot` (default: this process) plus
+        unlabelled point-in-time values ({name: (type, help, value)}).
+        """
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.lines(snapshot.get(name, (metric.kind, {}))[1]))
+        for name, (kind, help, value) in (extra or {}).items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+_LABELS = ("endpoint", "variant")
+REQUESTS = METRICS.counter(
+    "law_generation_requests_total",
+    "Finished generation requests by outcome.",
+    (*_LABELS, "status"),
+)
+GENERATED_TOKENS = METRICS.counter(
+    "law_generated_tokens_total", "Tokens generated.", _LABELS
+)
+QUEUE_WAIT = METRICS.histogram(
+    "law_queue_wait_seconds", "Time from submission to prefill start.", _LABELS
+)
+TOKENIZE = METRICS.histogram(
+    "law_tokenize_seconds", "Chat template rendering and tokenization.", _LABELS
+)
+PREFILL = METRICS.histogram(
+    "law_prefill_seconds", "Prompt prefill forward pass(es).", _LABELS
+)
+TTFT = METRICS.histogram(
+    "law_time_to_first_token_seconds", "Time from submission to first token.", _LABELS
+)
+INTER_TOKEN = METRICS.histogram(
+    "law_inter_token_seconds",
+    "Gap between consecutive decode steps that streamed tokens (a speculative "
+    "step that accepts several tokens counts once).",
+    _LABELS,
+)
+TOKENS_PER_S = METRICS.histogram(
+    "law_decode_tokens_per_second",
+    "Per-request generated tokens per second of generation time.",
+    _LABELS,
+    RATE_BUCKETS,
+)
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """
+    Nearest-rank percentile (q in [0, 100]); 0.0 for no values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def record_request(request) -> dict[str, float]:
+    """
+    Record a finished scheduler request; returns its latency breakdown.
+    """
+    labels = {"endpoint": request.endpoint or "-", "variant": request.label or "-"}
+    stats = request.stats()
+    if request.error is None:
+        status = "ok"
+    elif request.error in ("cancelled", "deadline exceeded"):
+        status = request.error.replace(" ", "_")
+    else:
+        status = "error"
+    REQUESTS.inc(status=status, **labels)
+    GENERATED_TOKENS.inc(stats["tokens"], **labels)
+    QUEUE_WAIT.observe(stats["queue_wait"], **labels)
+    TOKENIZE.observe(stats["tokenize"], **labels)
+    if request.first_token_at is not None:
+        PREFILL.observe(stats["prefill"], **labels)
+        TTFT.observe(stats["ttft"], **labels)
+    INTER_TOKEN.observe_many(request.token_gaps, **labels)
+    if stats["tokens"]:
+        TOKENS_PER_S.observe(stats["tokens_per_s"], **labels)
+    return stats
@@ -0,0 +1,161 @@
+"""
+app/prefix_cache.py
+
+Purpose:
+    Reuse the KV state of the fixed chat-template preamble and system prompt
+    across requests. The shared prefix is prefilled once per model/adapter
+    variant; later requests only prefill their own suffix.
+
+Inputs:
+    - Tokenizer + system prompt (to find the shared prefix of every prompt).
+    - A callable that prefills the prefix on a cache miss.
+
+Outputs:
+    - `encode_chat`: prompt token ids plus the length of the cacheable prefix.
+    - `PrefixCache`: memory-bounded LRU of prefix KV states, with hit/miss
+      counters.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+
+import torch
+
+from app.kv_cache import PastKeyValues, past_nbytes, to_legacy
+
+PREFIX_CACHE_MB = int(os.environ.get("PREFIX_CACHE_MB", "64"))
+
+_PREFIX_IDS: dict[tuple[int, str | None], list[int]] = {}
+
+
+def _render(tokenizer, system_prompt: str | None, prompt: str) -> list[int]:
+    messages = []
+    if system_prompt is not None:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    text = tokenizer.apply_chat_template(
+        messages, tokenize=False, add_generation_prompt=True
+    )
+    return tokenizer(text)["input_ids"]
+
+
+def chat_prefix_ids(tokenizer, system_prompt: str | None) -> list[int]:
+    """
+    Token ids every rendered prompt with this system prompt starts with.
+
+    Found as the common prefix of two renderings that differ only in the
+    user message, so it covers the template preamble, the system prompt
+    and the user-turn header.
+    """
+    key = (id(tokenizer), system_prompt)
+    if key not in _PREFIX_IDS:
+        first = _render(tokenizer, system_prompt, "甲")
+        second = _render(tokenizer, system_prompt, "乙")
+        length = 0
+        while length < min(len(first), len(second)) and first[length] == second[length]:
+            length += 1
+        _PREFIX_IDS[key] = first[:length]
+    return _PREFIX_IDS[key]
+
+
+def encode_chat(
+    tokenizer, prompt: str, system_prompt: str | None = None
+) -> tuple[list[int], int]:
+    """
+    Render and tokenize a single-turn chat.
+
+    Returns the input ids and how many leading tokens are the shared,
+    cacheable prefix (0 if the tokenizer merged across the boundary).
+    """
+    input_ids = _render(tokenizer, system_prompt, prompt)
+    return input_ids, prefix_length(tokenizer, input_ids, system_prompt)
+
+
+def prefix_length(
+    tokenizer, input_ids: list[int], system_prompt: str | None = None
+) -> int:
+    """
+    Length of the shared prefix at the start of already-tokenized `input_ids`.
+    """
+    prefix = chat_prefix_ids(tokenizer, system_prompt)
+    if len(prefix) < len(input_ids) and input_ids[: len(prefix)] == prefix:
+        return len(prefix)
+    return 0
+
+
+def prefill(model, prefix_ids: list[int]) -> PastKeyValues:
+    """
+    Run the model over `prefix_ids` and return the resulting KV state.
+    """
+    input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=model.device)
+    with torch.no_grad():
+        out = model(input_ids=input_ids, use_cache=True)
+    return to_legacy(out.past_key_values)
+
+
+class PrefixCache:
+    """
+    LRU cache of prefix KV states bounded by total tensor bytes.
+
+    Keys are `(adapter, tuple(prefix_ids))`, so base and LoRA (or different
+    adapters) never share an entry.
+    """
+
+    def __init__(self, max_bytes: int = PREFIX_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries: OrderedDict[Hashable, tuple[PastKeyValues, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(
+        self, key: Hashable, compute: Callable[[], PastKeyValues]
+    ) -> PastKeyValues:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        past = compute()
+        self._put(key, past)
+        return past
+
+    def _put(self, key: Hashable, past: PastKeyValues):
+        size = past_nbytes(past)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            while self._bytes + size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+            self._entries[key] = (past, size)
+            self._bytes += size
+
+    def discard(self, match: Callable[[Hashable], bool]):
+        """
+        Remove every entry whose key satisfies `match`.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                _, size = self._entries.pop(key)
+                self._bytes -= size
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,356 @@
+"""
+app/profiling.py
+
+Purpose:
+    Opt-in profiling of a single generation request, to see where a slow
+    compare/chat request spends its time: chat template, tokenizer, PEFT
+    adapter path, attention, the rest of the base model, sampling or
+    detokenization. While a `RequestProfiler` is running it captures
+
+    - a torch profiler trace of every thread (the scheduler thread runs the
+      forward passes), with each LoRA A/B matmul wrapped in a
+      `lora:<adapter>` range so adapter cost can be told apart from the
+      base weights;
+    - a Python sampling profile of all threads (collapsed stacks for
+      flamegraph.pl / speedscope).
+
+    Other requests sharing the batch during the window show up too, so
+    profile on an otherwise idle server.
+
+Inputs:
+    - `PROFILE_DIR`: where traces are written (default app/data/traces).
+    - `PROFILE_SAMPLE_INTERVAL_S`: Python sampling interval (default 5 ms).
+
+Outputs:
+    - `<PROFILE_DIR>/<name>/`:
+        torch_trace.json      chrome://tracing / Perfetto trace
+        torch_ops.txt         per-operator table (self CPU time)
+        python_stacks.folded  collapsed Python stacks
+        summary.md            adapter vs base split, time by category,
+                              top operators and Python functions
+"""
+
+from __future__ import annotations
+
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Sequence
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "app/data/traces")
+PROFILE_SAMPLE_INTERVAL_S = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_S", "0.005"))
+
+# The torch profiler is process-wide: one profiled request at a time.
+_PROFILE_LOCK = threading.Lock()
+_PROFILE_IDS = itertools.count(1)
+
+# Leaf frames of threads that are blocked waiting for work, not running it.
+_IDLE_FILES = ("threading.py", "queue.py", "selectors.py", "connection.py")
+_IDLE_FRAMES = (("thread.py", "_worker"),)
+
+# First match wins, checked from the innermost frame outwards.
+_CATEGORIES = (
+    ("chat template", lambda path, name: "jinja2" in path or "chat_template" in name),
+    (
+        "detokenize",
+        lambda path, name: "tokenization" in path and "decode" in name,
+    ),
+    ("tokenizer", lambda path, name: "tokenization" in path or "tokenizers" in path),
+    ("attention", lambda path, name: "attention" in name.lower()),
+    # LoRA-wrapped projections: base weights and adapter delta together (the
+    # torch profile's lora:* ranges split them).
+    ("PEFT-wrapped layers", lambda path, name: "/peft/" in path),
+    ("model forward", lambda path, name: "/transformers/models/" in path),
+    ("sampling", lambda path, name: "logits_process" in path),
+    ("scheduler", lambda path, name: path.endswith("app/scheduler.py")),
+)
+
+
+class ProfileBusy(RuntimeError):
+    """
+    Raised when another request is already being profiled.
+    """
+
+
+def new_profile_name(kind: str) -> str:
+    """
+    A unique trace directory name, e.g. "20250101-120000-compare-4242-1".
+    """
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-{os.getpid()}-{next(_PROFILE_IDS)}"
+
+
+def profile_dir(name: str) -> str:
+    return os.path.join(PROFILE_DIR, name)
+
+
+def _frame_label(code) -> str:
+    path = code.co_filename
+    marker = "site-packages" + os.sep
+    if marker in path:
+        path = path.split(marker, 1)[1]
+    elif path.startswith(os.getcwd()):
+        path = os.path.relpath(path)
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({path})"
+
+
+def _category(frames: Sequence) -> str:
+    for code in frames:
+        path = code.co_filename.replace(os.sep, "/")
+        name = getattr(code, "co_qualname", code.co_name)
+        for category, matches in _CATEGORIES:
+            if matches(path, name):
+                return category
+    return "other"
+
+
+class StackSampler:
+    """
+    Sample the Python stacks of all other threads at a fixed interval.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL_S):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.leaves: Counter = Counter()
+        self.categories: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._sample(names.get(ident, str(ident)), frame)
+
+    def _sample(self, thread: str, frame):
+        frames = []
+        while frame is not None:
+            frames.append(frame.f_code)
+            frame = frame.f_back
+        leaf = frames[0]
+        leaf_file = os.path.basename(leaf.co_filename)
+        if leaf_file in _IDLE_FILES or (leaf_file, leaf.co_name) in _IDLE_FRAMES:
+            return
+        self.samples += 1
+        labels = [_frame_label(code) for code in reversed(frames)]
+        self.stacks[";".join([thread, *labels])] += 1
+        self.leaves[labels[-1]] += 1
+        self.categories[_category(frames)] += 1
+
+
+def _lora_modules(models: Sequence) -> list[tuple[str, torch.nn.Module]]:
+    """
+    (adapter name, module) for every LoRA A/B projection of PEFT `models`.
+    """
+    found = []
+    for model in models:
+        for name, module in model.named_modules():
+            parts = name.split(".")
+            if len(parts) >= 2 and parts[-2] in ("lora_A", "lora_B"):
+                found.append((parts[-1], module))
+    return found
+
+
+class RequestProfiler:
+    """
+    Torch + Python sampling profile of one request, written on `stop()`.
+
+    Usable as a context manager; `start()` raises ProfileBusy if another
+    request is being profiled.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        models: Sequence = (),
+        directory: str = PROFILE_DIR,
+        interval: float = PROFILE_SAMPLE_INTERVAL_S,
+    ):
+        self.name = name
+        self.models = [model for model in models if model is not None]
+        self.path = os.path.join(directory, name)
+        self.interval = interval
+        self._torch: profile | None = None
+        self._sampler: StackSampler | None = None
+        self._hooks = []
+        self._ranges = threading.local()
+        self._started = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _enter_range(self, label: str):
+        stack = self._ranges.__dict__.setdefault("stack", [])
+        scope = record_function(label)
+        scope.__enter__()
+        stack.append(scope)
+
+    def _exit_range(self):
+        stack = getattr(self._ranges, "stack", None)
+        if stack:
+            stack.pop().__exit__(None, None, None)
+
+    def _hook_lora(self):
+        for adapter, module in _lora_modules(self.models):
+            label = f"lora:{adapter}"
+            self._hooks.append(
+                module.register_forward_pre_hook(
+                    lambda *_, label=label: self._enter_range(label)
+                )
+            )
+            self._hooks.append(
+                module.register_forward_hook(lambda *_: self._exit_range())
+            )
+
+    def start(self):
+        if not _PROFILE_LOCK.acquire(blocking=False):
+            raise ProfileBusy("Another request is being profiled, try again later")
+        try:
+            self._hook_lora()
+            self._torch = profile(
+                activities=[ProfilerActivity.CPU],
+                record_shapes=True,
+                **_all_threads_config(),
+            )
+            self._torch.start()
+            self._sampler = StackSampler(self.interval)
+            self._sampler.start()
+            self._started = time.perf_counter()
+        except Exception:
+            self._unhook()
+            _PROFILE_LOCK.release()
+            raise
+
+    def _unhook(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def stop(self) -> str:
+        """
+        Stop profiling and write the trace directory; returns its path.
+        """
+        if self._torch is None:
+            return self.path
+        wall = time.perf_counter() - self._started
+        try:
+            self._sampler.stop()
+            self._torch.stop()
+            self._unhook()
+            self._write(wall)
+        finally:
+            self._torch = None
+            _PROFILE_LOCK.release()
+        print(f"[INFO] Profile of '{self.name}' written to '{self.path}'")
+        return self.path
+
+    def _write(self, wall: float):
+        os.makedirs(self.path, exist_ok=True)
+        self._torch.export_chrome_trace(os.path.join(self.path, "torch_trace.json"))
+        events = self._torch.key_averages()
+        with open(os.path.join(self.path, "torch_ops.txt"), "w") as f:
+            f.write(events.table(sort_by="self_cpu_time_total", row_limit=50))
+        with open(os.path.join(self.path, "python_stacks.folded"), "w") as f:
+            f.writelines(
+                f"{stack} {count}\n"
+                for stack, count in self._sampler.stacks.most_common()
+            )
+        with open(os.path.join(self.path, "summary.md"), "w") as f:
+            f.write(self._summary(wall, events))
+
+    def _summary(self, wall: float, events) -> str:
+        ranges: dict[str, float] = {}
+        for event in events:
+            if event.key.startswith(("scheduler.", "lora:")):
+                ranges[event.key] = event.cpu_time_total / 1000
+        forward_ms = ranges.get("scheduler.prefill", 0.0) + ranges.get(
+            "scheduler.decode", 0.0
+        )
+        lora_ms = sum(ms for key, ms in ranges.items() if key.startswith("lora:"))
+
+        lines = [
+            f"# Profile: {self.name}",
+            "",
+            f"- Wall time: {wall:.3f}s",
+            (
+                f"- Python samples: {self._sampler.samples} "
+                f"(every {self.interval * 1000:g} ms, idle threads skipped)"
+            ),
+            "",
+            "## Adapter vs base (torch profiler, CPU time)",
+            "",
+            "| Range | ms | Share of forward |",
+            "|-------|---:|-----------------:|",
+        ]
+        for key, ms in sorted(ranges.items()):
+            share = f"{ms / forward_ms:.1%}" if forward_ms else "-"
+            lines.append(f"| {key} | {ms:.1f} | {share} |")
+        if forward_ms:
+            lines.append(
+                f"| base model + overhead | {forward_ms - lora_ms:.1f} | "
+                f"{(forward_ms - lora_ms) / forward_ms:.1%} |"
+            )
+
+        lines += ["", "## Python samples by category", ""]
+        lines += ["| Category | Samples | Share |", "|----------|--------:|------:|"]
+        total = max(1, self._sampler.samples)
+        for category, count in self._sampler.categories.most_common():
+            lines.append(f"| {category} | {count} | {count / total:.1%} |")
+
+        lines += ["", "## Top operators (self CPU)", ""]
+        lines += ["| Operator | Calls | Self ms | Total ms |"]
+        lines += ["|----------|------:|--------:|---------:|"]
+        top = sorted(events, key=lambda e: e.self_cpu_time_total, reverse=True)
+        for event in top[:15]:
+            lines.append(
+                f"| {event.key} | {event.count} | "
+                f"{event.self_cpu_time_total / 1000:.1f} | "
+                f"{event.cpu_time_total / 1000:.1f} |"
+            )
+
+        lines += ["", "## Top Python functions (self samples)", ""]
+        lines += ["| Function | Samples |", "|----------|--------:|"]
+        for leaf, count in self._sampler.leaves.most_common(15):
+            lines.append(f"| {leaf} | {count} |")
+        return "\n".join(lines) + "\n"
+
+
+def _all_threads_config() -> dict:
+    """
+    Profiler kwargs that also record ops run by other threads (the
+    scheduler thread), on torch versions that support it.
+    """
+    config = getattr(torch.profiler, "_ExperimentalConfig", None)
+    if config is None:
+        return {}
+    try:
+        return {"experimental_config": config(profile_all_threads=True)}
+    except TypeError:
+        print(
+            "[INFO] This torch version only profiles the calling thread; "
+            "torch_trace.json will miss the scheduler's forward passes"
+        )
+        return {}
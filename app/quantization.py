@@ -0,0 +1,149 @@
+"""
+app/quantization.py
+
+Purpose:
+    CPU-first weight quantization for inference. The base model's linear
+    layers are swapped for int8 dynamically-quantized layers (fbgemm/qnnpack
+    kernels) or weight-only int4 layers (packed nibbles + per-group scales,
+    dequantized on the fly). LoRA A/B matrices are left in float, so an
+    attached adapter keeps working; merged checkpoints quantize like any
+    other model.
+
+Inputs:
+    - `QUANTIZATION` env var / `--quantization`: "none" (default), "int8"
+      or "int4".
+    - A loaded (optionally PEFT-wrapped or merged) causal LM.
+
+Outputs:
+    - `model_load_kwargs`: dtype/device arguments for `from_pretrained`.
+    - `quantize_model`: the model with its base linear layers quantized.
+    - `model_nbytes`: parameter + buffer bytes, for the quality/speed report.
+"""
+
+from __future__ import annotations
+
+import os
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+QUANT_MODES = ("none", "int8", "int4")
+QUANTIZATION = os.environ.get("QUANTIZATION", "none")
+INT4_GROUP_SIZE = int(os.environ.get("INT4_GROUP_SIZE", "128"))
+
+# Module names never quantized: LoRA matrices (tiny, and PEFT reads their
+# float weights) and the output head (most sensitive to rounding).
+_SKIP = ("lora_", "lm_head")
+
+
+def model_load_kwargs(mode: str = QUANTIZATION) -> dict:
+    """
+    `from_pretrained` kwargs for a quantization mode.
+
+    Quantized modes load float32 weights on CPU, which is what the int8
+    kernels and the int4 packer expect; "none" keeps fp16 with
+    `device_map="auto"`.
+    """
+    if mode not in QUANT_MODES:
+        raise ValueError(
+            f"Unknown quantization mode '{mode}'; use one of {QUANT_MODES}"
+        )
+    if mode == "none":
+        return {"device_map": "auto", "torch_dtype": torch.float16}
+    return {"torch_dtype": torch.float32}
+
+
+class Int4Linear(nn.Module):
+    """
+    Weight-only int4 linear layer with asymmetric per-group quantization.
+
+    Two 4-bit codes are packed per byte; each group of `group_size` input
+    columns has its own float scale and minimum.
+    """
+
+    def __init__(self, linear: nn.Linear, group_size: int = INT4_GROUP_SIZE):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        if self.in_features % group_size or group_size % 2:
+            group_size = self.in_features
+        self.group_size = group_size
+
+        weight = linear.weight.detach().float()
+        groups = weight.reshape(self.out_features, -1, group_size)
+        low = groups.amin(dim=-1, keepdim=True)
+        scale = (groups.amax(dim=-1, keepdim=True) - low).clamp(min=1e-8) / 15
+        codes = torch.round((groups - low) / scale).clamp(0, 15).to(torch.uint8)
+        codes = codes.reshape(self.out_features, -1)
+        self.register_buffer("packed", codes[:, 0::2] | (codes[:, 1::2] << 4))
+        self.register_buffer("scale", scale.squeeze(-1))
+        self.register_buffer("low", low.squeeze(-1))
+        bias = linear.bias.detach().float() if linear.bias is not None else None
+        self.register_buffer("bias", bias)
+
+    def dequantize(self) -> torch.Tensor:
+        codes = torch.stack((self.packed & 0xF, self.packed >> 4), dim=-1)
+        groups = codes.reshape(self.out_features, -1, self.group_size).float()
+        weight = groups * self.scale.unsqueeze(-1) + self.low.unsqueeze(-1)
+        return weight.reshape(self.out_features, self.in_features)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        weight = self.dequantize().to(x.dtype)
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, weight, bias)
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"group_size={self.group_size}"
+        )
+
+
+def _quantizable(model: nn.Module) -> list[str]:
+    return [
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and not any(s in name for s in _SKIP)
+    ]
+
+
+def quantize_model(model: nn.Module, mode: str = QUANTIZATION) -> nn.Module:
+    """
+    Quantize the base linear layers of `model` in place and return it.
+
+    Call after attaching (or merging) a LoRA adapter: PEFT only wraps plain
+    `nn.Linear` targets, and the adapter's own A/B layers stay in float.
+    """
+    if mode == "none":
+        return model
+    if mode not in QUANT_MODES:
+        raise ValueError(
+            f"Unknown quantization mode '{mode}'; use one of {QUANT_MODES}"
+        )
+    names = _quantizable(model)
+    print(f"[INFO] Quantizing {len(names)} linear layers to {mode}...")
+    model.float().eval()
+    if mode == "int8":
+        return torch.ao.quantization.quantize_dynamic(
+            model, set(names), dtype=torch.qint8, inplace=True
+        )
+    for name in names:
+        parent_name, _, child = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child, Int4Linear(getattr(parent, child)))
+    return model
+
+
+def model_nbytes(model: nn.Module) -> int:
+    """
+    Bytes held by parameters and buffers, including packed quantized weights.
+    """
+    total = sum(t.numel() * t.element_size() for t in model.parameters())
+    total += sum(t.numel() * t.element_size() for t in model.buffers())
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            total += module.weight().int_repr().numel()
+            bias = module.bias()
+            total += bias.numel() * bias.element_size() if bias is not None else 0
+    return total
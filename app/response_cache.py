@@ -0,0 +1,275 @@
+"""
+app/response_cache.py
+
+Purpose:
+    Cache complete answers to repeated questions in front of `/api/chat` and
+    `/api/compare`. Prompts are normalized (Unicode NFKC, whitespace, case,
+    trailing punctuation) so "酒驾撞人怎么判刑？" and "酒驾撞人怎么判刑?"
+    share an entry. Keys also cover the model/adapter, quantization and
+    decoding parameters, plus a fingerprint (size/mtime) of the weight
+    files, so a retrained adapter or re-merged checkpoint at the same path
+    gets new entries. Only deterministic (greedy) decoding is cached:
+    a sampled answer is one draw, not the answer.
+
+Inputs:
+    - `RESPONSE_CACHE_SIZE`: max entries (default 1024, 0 disables).
+    - `RESPONSE_CACHE_TTL_S`: entry lifetime in seconds (default 86400).
+    - `RESPONSE_CACHE_DB`: optional SQLite file; entries then survive
+      restarts and are shared by every process using the same file.
+
+Outputs:
+    - `ResponseCache.get` / `put`: the full streamed body of a finished
+      response, replayed in one chunk on a hit.
+    - `ResponseCache.stats`: hit/miss counters for sizing.
+"""
+
+from __future__ import annotations
+
+import functools
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+
+from transformers import GenerationConfig
+
+from app.scheduler import sampling_defaults
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL_S = float(os.environ.get("RESPONSE_CACHE_TTL_S", "86400"))
+RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB", "")
+
+_WHITESPACE = re.compile(r"\s+")
+# After NFKC, full-width "？！。" etc. are ASCII or plain CJK punctuation.
+_TRAILING_PUNCT = re.compile(r"[\s?!.。,，;；:：~…]+$")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Canonical form of a question for cache lookups.
+    """
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    text = _WHITESPACE.sub(" ", text).strip()
+    return _TRAILING_PUNCT.sub("", text)
+
+
+WEIGHT_PATTERNS = ("*.safetensors", "*.bin", "*.pt")
+
+
+def weights_fingerprint(*model_paths: str | None) -> str:
+    """
+    Hash of the name, size and mtime of every weight file in `model_paths`
+    (directories that do not exist are skipped).
+    """
+    digest = hashlib.sha256()
+    for model_path in model_paths:
+        if not model_path or not os.path.isdir(model_path):
+            continue
+        digest.update(os.path.realpath(model_path).encode("utf-8"))
+        files = sorted(
+            path
+            for pattern in WEIGHT_PATTERNS
+            for path in glob.glob(os.path.join(model_path, pattern))
+        )
+        for path in files:
+            stat = os.stat(path)
+            digest.update(
+                f"|{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+            )
+    return digest.hexdigest()[:16]
+
+
+@functools.cache
+def decoding_params(*model_paths: str) -> dict[str, object]:
+    """
+    The sampling settings a model decodes with, read from the first of
+    `model_paths` that has a generation config (adapters fall back to the
+    base model's).
+    """
+    config = GenerationConfig()
+    for path in model_paths:
+        try:
+            config = GenerationConfig.from_pretrained(path)
+            break
+        except (OSError, ValueError):
+            continue
+    return sampling_defaults(config)
+
+
+def cache_key(kind: str, prompt: str, **identity) -> str:
+    """
+    Hash of the endpoint, normalized prompt and everything that shapes the
+    answer (model, adapter, quantization, decoding parameters...).
+    """
+    payload = json.dumps(
+        {"kind": kind, "prompt": normalize_prompt(prompt), **identity},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _MemoryStore:
+    def __init__(self):
+        self._entries: OrderedDict[str, tuple[str, str, float]] = OrderedDict()
+
+    def get(self, key: str) -> tuple[str, float] | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def put(self, key: str, tag: str, body: str, max_entries: int):
+        self._entries[key] = (tag, body, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: str | None = None, tag: str | None = None):
+        if key is not None:
+            self._entries.pop(key, None)
+        else:
+            for k in [k for k, e in self._entries.items() if tag in (None, e[0])]:
+                del self._entries[k]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class _SQLiteStore:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, tag TEXT, body TEXT, "
+            "created REAL, accessed REAL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> tuple[str, float] | None:
+        row = self._db.execute(
+            "SELECT body, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            self._db.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+        return row
+
+    def put(self, key: str, tag: str, body: str, max_entries: int):
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, tag, body, now, now),
+        )
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+            "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (max_entries,),
+        )
+        self._db.commit()
+
+    def delete(self, key: str | None = None, tag: str | None = None):
+        if key is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+        elif tag is not None:
+            self._db.execute("DELETE FROM responses WHERE tag = ?", (tag,))
+        else:
+            self._db.execute("DELETE FROM responses")
+        self._db.commit()
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class ResponseCache:
+    """
+    LRU + TTL cache of finished response bodies, in memory or in SQLite.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_SIZE,
+        ttl: float = RESPONSE_CACHE_TTL_S,
+        path: str = RESPONSE_CACHE_DB,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._store = _SQLiteStore(path) if path else _MemoryStore()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                self._store.delete(key=key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, body: str, tag: str = ""):
+        with self._lock:
+            self._store.put(key, tag, body, self.max_entries)
+
+    def invalidate(self, tag: str | None = None):
+        """
+        Drop entries stored under `tag` (e.g. an adapter that was reloaded),
+        or everything.
+        """
+        with self._lock:
+            self._store.delete(tag=tag)
+
+    async def record(
+        self, key: str, chunks: AsyncIterator[str], tag: str = ""
+    ) -> AsyncIterator[str]:
+        """
+        Pass `chunks` through and store the body once it completes cleanly.
+
+        Streams that fail or are cut short (client gone, deadline) are not
+        cached.
+        """
+        parts = []
+        async for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        body = "".join(parts)
+        if body and "[ERROR]" not in body:
+            self.put(key, body, tag)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "sqlite" if self.path else "memory",
+                "entries": len(self._store),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
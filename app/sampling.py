@@ -0,0 +1,180 @@
+"""
+app/sampling.py
+
+Purpose:
+    Draw seeded evaluation subsets from large JSONL datasets without loading
+    them into memory. Records are streamed one at a time and at most `k` of
+    them (per stratum) are ever held, so memory stays flat no matter how
+    many GB of data are read.
+
+Inputs:
+    - One or many JSONL files (or a population size, for index-based data
+      such as the pre-tokenized cache).
+    - Sample size `k`, a seed and optionally stratification by the `id`
+      source prefix (e.g. "judicial_examination" of "judicial_examination_3").
+
+Outputs:
+    - `sample_positions`: the same positions `random.sample` picks today.
+    - `ReservoirSampler`: single-pass (optionally stratified) reservoir.
+    - `sample_jsonl`: a sampled list of records.
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import re
+from collections.abc import Callable, Hashable, Iterable, Iterator
+
+_ID_SUFFIX = re.compile(r"[_\-]?\d+$")
+
+
+def iter_jsonl(paths: Iterable[str]) -> Iterator[dict]:
+    """
+    Stream records from one or many JSONL files, skipping blank lines.
+    """
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def count_jsonl(paths: Iterable[str]) -> int:
+    """
+    Number of non-blank lines, counted without parsing JSON.
+    """
+    total = 0
+    for path in paths:
+        with open(path, "rb") as f:
+            total += sum(1 for line in f if line.strip())
+    return total
+
+
+def source_prefix(record_id: str) -> str:
+    """
+    Dataset/source part of a record id: "legal_question_answering_12" ->
+    "legal_question_answering".
+    """
+    return _ID_SUFFIX.sub("", record_id or "") or "unknown"
+
+
+def sample_positions(population: int, k: int, seed: int = 42) -> list[int]:
+    """
+    Positions chosen by `random.seed(seed); random.sample(items, k)`.
+
+    Sampling from a lazy `range` consumes the RNG exactly like sampling from
+    a list of the same length, so callers that know the population size get
+    today's subset while holding only `k` integers.
+    """
+    return random.Random(seed).sample(range(population), min(k, population))
+
+
+class ReservoirSampler:
+    """
+    Seeded single-pass reservoir sample (Algorithm R) of a stream.
+
+    With `stratify`, one reservoir of size `k` is kept per stratum and `k`
+    is split across strata in proportion to how often each was seen, so
+    small sources are not crowded out by large ones.
+    """
+
+    def __init__(
+        self,
+        k: int,
+        seed: int = 42,
+        stratify: Callable[[object], Hashable] | None = None,
+    ):
+        self.k = k
+        self.seed = seed
+        self.stratify = stratify
+        self.seen = 0
+        self._counts: dict[Hashable, int] = {}
+        self._reservoirs: dict[Hashable, list[tuple[int, object]]] = {}
+        self._rngs: dict[Hashable, random.Random] = {}
+
+    def add(self, item):
+        stratum = self.stratify(item) if self.stratify else None
+        if stratum not in self._reservoirs:
+            self._counts[stratum] = 0
+            self._reservoirs[stratum] = []
+            # String seeds are hashed deterministically (unlike hash()).
+            self._rngs[stratum] = random.Random(f"{self.seed}:{stratum}")
+        seen = self._counts[stratum]
+        reservoir = self._reservoirs[stratum]
+        if seen < self.k:
+            reservoir.append((self.seen, item))
+        else:
+            slot = self._rngs[stratum].randrange(seen + 1)
+            if slot < self.k:
+                reservoir[slot] = (self.seen, item)
+        self._counts[stratum] = seen + 1
+        self.seen += 1
+
+    def allocation(self) -> dict[Hashable, int]:
+        """
+        Per-stratum sample sizes (largest remainder, proportional to counts).
+        """
+        total = sum(self._counts.values())
+        k = min(self.k, total)
+        if not total:
+            return {}
+        quotas = {s: k * count / total for s, count in self._counts.items()}
+        sizes = {s: int(quota) for s, quota in quotas.items()}
+        by_remainder = sorted(quotas, key=lambda s: (sizes[s] - quotas[s], str(s)))
+        for stratum in by_remainder[: k - sum(sizes.values())]:
+            sizes[stratum] += 1
+        return sizes
+
+    def result(self) -> list:
+        """
+        Sampled items, in the order they appeared in the stream.
+        """
+        chosen: list[tuple[int, object]] = []
+        for stratum, size in self.allocation().items():
+            reservoir = self._reservoirs[stratum]
+            if size < len(reservoir):
+                reservoir = random.Random(f"{self.seed}:{stratum}:pick").sample(
+                    reservoir, size
+                )
+            chosen.extend(reservoir)
+        return [item for _, item in sorted(chosen, key=lambda entry: entry[0])]
+
+
+def sample_jsonl(
+    paths: Iterable[str],
+    k: int | None,
+    seed: int = 42,
+    stratify_by_source: bool = False,
+) -> list[dict]:
+    """
+    Sample `k` records from JSONL files with bounded memory.
+
+    Without stratification the result matches the old "load everything,
+    then `random.sample`" behaviour exactly: a cheap line count fixes the
+    population size, then one parsing pass keeps only the chosen records.
+    With stratification a single reservoir pass is made.
+    """
+    paths = list(paths)
+    if k is None:
+        return list(iter_jsonl(paths))
+    if stratify_by_source:
+        sampler = ReservoirSampler(
+            k, seed, stratify=lambda record: source_prefix(str(record.get("id", "")))
+        )
+        for record in iter_jsonl(paths):
+            sampler.add(record)
+        return sampler.result()
+
+    population = count_jsonl(paths)
+    if population <= k:
+        return list(iter_jsonl(paths))
+    positions = sample_positions(population, k, seed)
+    order = {position: rank for rank, position in enumerate(positions)}
+    chosen: list[dict | None] = [None] * len(positions)
+    for position, record in enumerate(iter_jsonl(paths)):
+        rank = order.get(position)
+        if rank is not None:
+            chosen[rank] = record
+    return chosen
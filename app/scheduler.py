@@ -0,0 +1,871 @@
+"""
+app/scheduler.py
+
+Purpose:
+    Continuous-batching generation scheduler shared by `/api/chat` and
+    `/api/compare`. A single background thread owns the model and runs one
+    decode loop: new requests are prefilled and join the running batch at
+    token boundaries, and every sequence's tokens are fanned back out to its
+    own streaming response.
+
+Inputs:
+    - Tokenized prompts submitted through `GenerationScheduler.submit`.
+    - Sampling defaults taken from the model's `generation_config`.
+
+Outputs:
+    - Per-request sink queues of `(request, token_id | None)` events
+      (`None` marks the end of a sequence): a `queue.Queue` for threaded
+      consumers (`iter_text`) or an `AsyncSink` for asyncio ones
+      (`aiter_text`), so async streams hold no thread while they wait.
+    - Per-request latency breakdown (tokenize, queue wait, prefill, ttft,
+      inter-token percentiles) and tokens/s, printed when a request finishes,
+      recorded in app/metrics.py and available via `GenerationRequest.stats()`.
+    - KV cache block usage against the memory budget (app/kv_blocks.py):
+      `GenerationScheduler.kv_blocks` and `kv_stats()`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import AsyncIterator, Iterator
+from dataclasses import dataclass, field
+
+import torch
+import torch.nn.functional as F
+from torch.profiler import record_function
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from app.detokenizer import StreamCoalescer, byte_table, make_detokenizer
+from app.kv_blocks import KVBlockManager, combine_stats
+from app.kv_cache import PastKeyValues, left_pad, to_legacy, to_model_cache
+from app.metrics import percentile, record_request
+from app.prefix_cache import PrefixCache
+from app.speculative import (
+    NUM_SPECULATIVE_TOKENS,
+    SPECULATIVE_DECODING,
+    SPECULATIVE_MAX_BATCH,
+    SPECULATIVE_MODES,
+    ngram_draft,
+)
+
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+# Decode base and LoRA rows in one forward pass via PEFT's per-row `adapter_names`.
+MIXED_ADAPTER_BATCH = os.environ.get("MIXED_ADAPTER_BATCH", "1") == "1"
+# Adapter name PEFT reserves for "no adapter" in a mixed-adapter batch.
+BASE_ADAPTER_NAME = "__base__"
+# Decode greedily regardless of the model's generation_config (deterministic
+# output, which also lets app/response_cache.py serve repeated questions).
+GREEDY_DECODING = os.environ.get("GREEDY_DECODING", "0") == "1"
+SAMPLING_FIELDS = ("do_sample", "temperature", "top_k", "top_p", "repetition_penalty")
+
+_REQUEST_IDS = itertools.count(1)
+
+
+def sampling_defaults(generation_config) -> dict[str, object]:
+    """
+    Sampling settings requests inherit from a model's generation config.
+    """
+    defaults = {
+        name: getattr(generation_config, name, None) for name in SAMPLING_FIELDS
+    }
+    if GREEDY_DECODING:
+        defaults["do_sample"] = False
+    return defaults
+
+
+@dataclass
+class GenerationRequest:
+    """
+    A single sequence tracked by the scheduler.
+    """
+
+    input_ids: list[int]
+    max_new_tokens: int
+    adapter: str | None = None
+    label: str = ""
+    prefix_len: int = 0
+    do_sample: bool | None = None
+    temperature: float | None = None
+    top_k: int | None = None
+    top_p: float | None = None
+    repetition_penalty: float | None = None
+    # Set by the caller (e.g. on client disconnect) to stop generation.
+    cancel: threading.Event = field(default_factory=threading.Event, repr=False)
+    deadline: float | None = None
+    sink: queue.Queue = field(default_factory=queue.Queue)
+    request_id: int = field(default_factory=lambda: next(_REQUEST_IDS))
+    output_ids: list[int] = field(default_factory=list)
+    # Speculative decoding: draft tokens proposed / accepted by the model.
+    drafted: int = 0
+    accepted: int = 0
+    # Times the KV budget forced this request out of the running batch.
+    preemptions: int = 0
+    # Latency breakdown (see app/metrics.py): "chat" / "compare", time spent
+    # rendering + tokenizing the prompt before submission, and the gaps
+    # between consecutive decode steps that streamed tokens.
+    endpoint: str = ""
+    tokenize_s: float = 0.0
+    last_token_at: float | None = None
+    token_gaps: list[float] = field(default_factory=list, repr=False)
+    error: str | None = None
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    started_at: float | None = None
+    first_token_at: float | None = None
+    finished_at: float | None = None
+    processors: LogitsProcessorList = field(
+        default_factory=LogitsProcessorList, repr=False
+    )
+
+    def stop_reason(self) -> str | None:
+        """
+        Why this request must stop early, or None to keep going.
+        """
+        if self.cancel.is_set():
+            return "cancelled"
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            return "deadline exceeded"
+        return None
+
+    def stats(self) -> dict[str, float]:
+        """
+        Latency breakdown in seconds (tokenize, queue wait, prefill, ttft,
+        inter-token percentiles) and decode throughput.
+        """
+        end = self.finished_at or time.perf_counter()
+        start = self.started_at or end
+        duration = end - start
+        return {
+            "tokenize": self.tokenize_s,
+            "queue_wait": start - self.enqueued_at,
+            "prefill": (self.first_token_at or end) - start,
+            "ttft": (self.first_token_at or end) - self.enqueued_at,
+            "itl_p50": percentile(self.token_gaps, 50),
+            "itl_p90": percentile(self.token_gaps, 90),
+            "itl_p99": percentile(self.token_gaps, 99),
+            "duration": duration,
+            "tokens": len(self.output_ids),
+            "tokens_per_s": len(self.output_ids) / duration if duration > 0 else 0.0,
+        }
+
+
+class _Batch:
+    """
+    Running batch: left-padded KV cache + attention mask, one row per request.
+    """
+
+    def __init__(self):
+        self.requests: list[GenerationRequest] = []
+        self.past: PastKeyValues | None = None
+        self.attention_mask: torch.Tensor | None = None
+        self.next_tokens: torch.Tensor | None = None
+
+    @property
+    def length(self) -> int:
+        return 0 if self.attention_mask is None else self.attention_mask.shape[1]
+
+    def add(self, request: GenerationRequest, past: PastKeyValues, token: int):
+        device = past[0][0].device
+        length = past[0][0].shape[2]
+        mask = torch.ones(1, length, dtype=torch.long, device=device)
+        next_token = torch.tensor([[token]], dtype=torch.long, device=device)
+
+        if self.past is None:
+            self.past, self.attention_mask, self.next_tokens = past, mask, next_token
+        else:
+            total = max(self.length, length)
+            old_past = left_pad(self.past, total)
+            new_past = left_pad(past, total)
+            self.past = tuple(
+                (torch.cat([ok, nk]), torch.cat([ov, nv]))
+                for (ok, ov), (nk, nv) in zip(old_past, new_past)
+            )
+            self.attention_mask = torch.cat(
+                [
+                    F.pad(self.attention_mask, (total - self.length, 0)),
+                    F.pad(mask, (total - length, 0)),
+                ]
+            )
+            self.next_tokens = torch.cat([self.next_tokens, next_token])
+        self.requests.append(request)
+
+    def retain(self, keep: list[int]):
+        """
+        Drop finished rows and trim padding columns no remaining row needs.
+        """
+        if not keep:
+            self.__init__()
+            return
+        if len(keep) == len(self.requests):
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        mask = self.attention_mask.index_select(0, index)
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self.attention_mask = mask[:, start:]
+        self.past = tuple(
+            (
+                key.index_select(0, index)[:, :, start:],
+                value.index_select(0, index)[:, :, start:],
+            )
+            for key, value in self.past
+        )
+        self.next_tokens = self.next_tokens.index_select(0, index)
+        self.requests = [self.requests[i] for i in keep]
+
+    def trim(self):
+        """
+        Drop trailing columns masked out in every row (rejected draft tokens).
+
+        Slicing keeps views, so this costs no copy; holes before a row's
+        last real token stay masked instead.
+        """
+        used = (self.attention_mask.sum(dim=0) > 0).nonzero()
+        end = int(used[-1]) + 1 if len(used) else 0
+        if end < self.length:
+            self.attention_mask = self.attention_mask[:, :end]
+            self.past = tuple(
+                (key[:, :, :end], value[:, :, :end]) for key, value in self.past
+            )
+
+
+class GenerationScheduler:
+    """
+    Merge in-flight requests for one model into a single decode loop.
+
+    For a PeftModel, rows for the base model and for any loaded adapter
+    share one mixed-adapter batch: the base weights are applied to every row
+    and each LoRA delta only to the rows that requested it. With
+    `mixed_adapters=False` every adapter gets its own batch and the base
+    batch runs under `disable_adapter()`.
+
+    `model_lock` is held around every forward pass so adapters can be loaded
+    and unloaded (see app/adapters.py) between decode steps.
+
+    KV cache memory is charged against `kv_blocks` (app/kv_blocks.py). A
+    request is only prefilled once its blocks are free; until then it
+    waits at the head of the queue. When a decode step cannot get the
+    blocks it needs, draft tokens are dropped first, then the newest rows
+    are preempted: their cache is discarded and they are prefilled again,
+    prompt plus tokens so far, once blocks free up.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        mixed_adapters: bool = MIXED_ADAPTER_BATCH,
+        speculative: str = SPECULATIVE_DECODING,
+        num_speculative_tokens: int = NUM_SPECULATIVE_TOKENS,
+    ):
+        if speculative not in SPECULATIVE_MODES:
+            raise ValueError(
+                f"Unknown speculative mode '{speculative}'; use one of "
+                f"{SPECULATIVE_MODES}"
+            )
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.mixed_adapters = mixed_adapters and hasattr(model, "peft_config")
+        self.num_speculative_tokens = (
+            num_speculative_tokens if speculative != "none" else 0
+        )
+        self.prefix_cache = PrefixCache()
+        self.model_lock = threading.Lock()
+        # Unfinished requests per adapter, so adapters are never unloaded
+        # under a queued, prefilling or decoding request.
+        self._adapter_refs: Counter = Counter()
+        self._refs_lock = threading.Lock()
+        self._waiting: queue.Queue[GenerationRequest] = queue.Queue()
+        # Deferred and preempted requests, admitted before new ones.
+        self._pending: deque[GenerationRequest] = deque()
+        self._admitting: GenerationRequest | None = None
+        self.kv_blocks = KVBlockManager.for_model(model)
+        self._batches: dict[object, _Batch] = {}
+
+        eos = model.generation_config.eos_token_id
+        if eos is None:
+            eos = tokenizer.eos_token_id
+        self._eos_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+
+        self._thread = threading.Thread(
+            target=self._run, name="generation-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        input_ids: list[int],
+        *,
+        max_new_tokens: int,
+        adapter: str | None = None,
+        label: str = "",
+        prefix_len: int = 0,
+        sink: queue.Queue | None = None,
+        timeout: float | None = None,
+        cancel: threading.Event | None = None,
+        endpoint: str = "",
+        tokenize_s: float = 0.0,
+        **sampling,
+    ) -> GenerationRequest:
+        """
+        Queue a prompt for generation. Tokens arrive on `request.sink`.
+
+        `adapter` names a loaded LoRA adapter; None decodes with the base
+        weights. The first `prefix_len` tokens are a shared preamble (see
+        `app.prefix_cache.encode_chat`) whose KV state is cached and reused.
+        Generation stops early, with `request.error` set, once `cancel` is
+        set or `timeout` seconds have passed since submission. `endpoint`,
+        `label` and `tokenize_s` feed the metrics in app/metrics.py.
+        """
+        request = GenerationRequest(
+            input_ids=list(input_ids),
+            max_new_tokens=max_new_tokens,
+            adapter=adapter,
+            label=label,
+            prefix_len=prefix_len,
+            endpoint=endpoint,
+            tokenize_s=tokenize_s,
+            **sampling,
+        )
+        if cancel is not None:
+            request.cancel = cancel
+        if timeout is not None:
+            request.deadline = request.enqueued_at + timeout
+        if sink is not None:
+            request.sink = sink
+        self._configure_sampling(request)
+        if adapter is not None:
+            with self._refs_lock:
+                self._adapter_refs[adapter] += 1
+        self._waiting.put(request)
+        return request
+
+    def _configure_sampling(self, request: GenerationRequest):
+        defaults = sampling_defaults(self.model.generation_config)
+        for name in SAMPLING_FIELDS:
+            if getattr(request, name) is None:
+                setattr(request, name, defaults[name])
+
+        processors = LogitsProcessorList()
+        if request.repetition_penalty and request.repetition_penalty != 1.0:
+            processors.append(
+                RepetitionPenaltyLogitsProcessor(request.repetition_penalty)
+            )
+        if request.do_sample:
+            if request.temperature and request.temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(request.temperature))
+            if request.top_k:
+                processors.append(TopKLogitsWarper(request.top_k))
+            if request.top_p is not None and request.top_p < 1.0:
+                processors.append(TopPLogitsWarper(request.top_p))
+        request.processors = processors
+
+    def _active(self) -> int:
+        return sum(len(batch.requests) for batch in self._batches.values())
+
+    def adapters_in_use(self) -> set[str]:
+        """
+        Adapters referenced by unfinished requests.
+        """
+        with self._refs_lock:
+            return {name for name, count in self._adapter_refs.items() if count}
+
+    def forget_adapter(self, name: str):
+        """
+        Drop cached prefix KV states computed with adapter `name`.
+        """
+        self.prefix_cache.discard(lambda key: key[0] == name)
+
+    def _run(self):
+        while True:
+            # Idle: block until work arrives instead of spinning.
+            first = None if self._active() or self._pending else self._waiting.get()
+            try:
+                self._admit(first)
+                for batch in list(self._batches.values()):
+                    if batch.requests:
+                        # Named ranges for app/profiling.py traces.
+                        with record_function("scheduler.decode"):
+                            self._decode_step(batch)
+            except Exception as exc:  # noqa: BLE001
+                # The loop thread must survive: its streams would otherwise
+                # wait forever while the server keeps accepting work.
+                print(f"[ERROR] Scheduler step failed: {exc!r}")
+                self._fail_all(f"scheduler error: {exc}")
+
+    def _fail_all(self, error: str):
+        """
+        Finish every request the loop holds (running, pending and the one
+        being admitted) with `error` and drop their batches.
+        """
+        requests = [
+            request for batch in self._batches.values() for request in batch.requests
+        ]
+        requests.extend(self._pending)
+        if self._admitting is not None:
+            requests.append(self._admitting)
+        self._batches.clear()
+        self._pending.clear()
+        self._admitting = None
+        for request in requests:
+            if request.finished_at is not None:
+                continue
+            try:
+                self._finish(request, error=error)
+            except Exception:  # noqa: BLE001
+                # Still end the stream even if logging/metrics fail.
+                request.error = error
+                request.finished_at = time.perf_counter()
+                request.sink.put((request, None))
+
+    def _batch_key(self, request: GenerationRequest) -> object:
+        return "mixed" if self.mixed_adapters else request.adapter
+
+    def _forward(
+        self, requests: list[GenerationRequest], last_only: bool = True, **kwargs
+    ):
+        with self.model_lock:
+            context = contextlib.nullcontext()
+            adapter = requests[0].adapter
+            if self.mixed_adapters:
+                kwargs["adapter_names"] = [
+                    request.adapter or BASE_ADAPTER_NAME for request in requests
+                ]
+            elif adapter is None and hasattr(self.model, "disable_adapter"):
+                context = self.model.disable_adapter()
+            elif adapter is not None and self.model.active_adapter != adapter:
+                self.model.set_adapter(adapter)
+
+            with torch.no_grad(), context:
+                past = to_model_cache(kwargs.pop("past_key_values", None))
+                out = self.model(past_key_values=past, use_cache=True, **kwargs)
+        logits = out.logits[:, -1, :] if last_only else out.logits
+        return logits.float(), to_legacy(out.past_key_values)
+
+    def _admit(self, request: GenerationRequest | None = None):
+        """
+        Prefill waiting requests and join them to the running batch.
+        """
+        while self._active() < self.max_batch_size:
+            if request is None and self._pending:
+                request = self._pending.popleft()
+            if request is None:
+                try:
+                    request = self._waiting.get_nowait()
+                except queue.Empty:
+                    return
+            # Held here so `_fail_all` reaches it while it is in no queue.
+            self._admitting = request
+            if request.stop_reason() is None and not self._reserve_prefill(request):
+                self._pending.appendleft(request)
+                self._admitting = None
+                return
+            with record_function("scheduler.prefill"):
+                self._prefill(request)
+            self._admitting = request = None
+
+    def _reserve_prefill(self, request: GenerationRequest) -> bool:
+        """
+        Reserve blocks for `request` joining its batch (which pads every row
+        to the longer of the batch and the prompt). False: wait for blocks.
+        """
+        tokens = len(request.input_ids) + len(request.output_ids)
+        if self.kv_blocks.blocks_for(tokens + 1) > self.kv_blocks.num_blocks:
+            # Could never fit; _prefill reports it.
+            return True
+        batch = self._batches.get(self._batch_key(request))
+        rows = batch.requests if batch is not None else []
+        length = max(tokens, batch.length if batch is not None else 0)
+        sizes = {row.request_id: length for row in rows}
+        sizes[request.request_id] = length
+        return self.kv_blocks.reserve(sizes)
+
+    def _sync_blocks(self, batch: _Batch):
+        """
+        Release blocks beyond the batch's current (padded) length.
+        """
+        self.kv_blocks.reserve({row.request_id: batch.length for row in batch.requests})
+
+    def _prefill(self, request: GenerationRequest):
+        if request.started_at is None:
+            request.started_at = time.perf_counter()
+        reason = request.stop_reason()
+        if reason:
+            self._finish(request, error=reason)
+            return
+        # A preempted request resumes from its prompt plus what it generated.
+        ids = request.input_ids + request.output_ids
+        if self.kv_blocks.blocks_for(len(ids) + 1) > self.kv_blocks.num_blocks:
+            self._finish(
+                request,
+                error=f"prompt needs more than the KV cache budget "
+                f"({self.kv_blocks.capacity_tokens} tokens)",
+            )
+            return
+        try:
+            input_ids = torch.tensor([ids], dtype=torch.long, device=self.model.device)
+            past, start = None, 0
+            if 0 < request.prefix_len < len(ids):
+                start = request.prefix_len
+
+                def prefill_prefix():
+                    return self._forward([request], input_ids=input_ids[:, :start])[1]
+
+                key = (request.adapter, tuple(request.input_ids[:start]))
+                past = self.prefix_cache.get_or_compute(key, prefill_prefix)
+            logits, past = self._forward(
+                [request], input_ids=input_ids[:, start:], past_key_values=past
+            )
+            token = self._next_token(request, logits)
+        except Exception as exc:  # noqa: BLE001
+            self._finish(request, error=str(exc))
+            return
+        batch = self._batches.setdefault(self._batch_key(request), _Batch())
+        if self._emit(request, token):
+            batch.add(request, past, token)
+        self._sync_blocks(batch)
+
+    def _reserve_decode(
+        self, batch: _Batch, drafts: list[list[int]]
+    ) -> list[list[int]]:
+        """
+        Reserve blocks for the next decode step, dropping drafts and then
+        preempting the newest rows until it fits. Returns the drafts to use.
+        """
+        while batch.requests:
+            width = max(map(len, drafts))
+            length = batch.length + 1 + width
+            if self.kv_blocks.reserve(
+                {row.request_id: length for row in batch.requests}
+            ):
+                return drafts
+            if width:
+                drafts = [[] for _ in drafts]
+                continue
+            if len(batch.requests) == 1:
+                self._finish(batch.requests[0], error="KV cache budget exceeded")
+                batch.retain([])
+                break
+            self._preempt(batch.requests[-1])
+            batch.retain(list(range(len(batch.requests) - 1)))
+            drafts = drafts[:-1]
+            self._sync_blocks(batch)
+        return []
+
+    def _preempt(self, request: GenerationRequest):
+        self.kv_blocks.free(request.request_id)
+        self.kv_blocks.preempted += 1
+        request.preemptions += 1
+        self._pending.appendleft(request)
+
+    def _decode_step(self, batch: _Batch):
+        # Drop cancelled / timed-out rows before spending a forward pass on them.
+        keep = []
+        for row, request in enumerate(batch.requests):
+            reason = request.stop_reason()
+            if reason:
+                self._finish(request, error=reason)
+            else:
+                keep.append(row)
+        batch.retain(keep)
+        if not batch.requests:
+            return
+
+        drafts = self._reserve_decode(batch, self._drafts(batch))
+        if not batch.requests:
+            return
+        width = max(map(len, drafts))
+        rows = len(batch.requests)
+        device = batch.attention_mask.device
+        input_ids = batch.next_tokens
+        new_mask = torch.ones(rows, 1, dtype=torch.long, device=device)
+        if width:
+            # Each row verifies its draft (right-padded, padding masked out)
+            # in the same forward pass as its next token.
+            draft_ids = torch.zeros(rows, width, dtype=torch.long, device=device)
+            draft_mask = torch.zeros(rows, width, dtype=torch.long, device=device)
+            for row, draft in enumerate(drafts):
+                draft_ids[row, : len(draft)] = torch.tensor(draft)
+                draft_mask[row, : len(draft)] = 1
+            input_ids = torch.cat([input_ids, draft_ids], dim=1)
+            new_mask = torch.cat([new_mask, draft_mask], dim=1)
+        attention_mask = torch.cat([batch.attention_mask, new_mask], dim=1)
+        position_ids = batch.attention_mask.sum(dim=1, keepdim=True) + torch.arange(
+            1 + width, device=device
+        )
+        try:
+            logits, past = self._forward(
+                batch.requests,
+                last_only=False,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=batch.past,
+            )
+        except Exception as exc:  # noqa: BLE001
+            for request in batch.requests:
+                self._finish(request, error=str(exc))
+            batch.retain([])
+            return
+
+        start = batch.length + 1
+        keep = []
+        for row, request in enumerate(batch.requests):
+            draft = drafts[row]
+            accepted = 0
+            for position in range(len(draft) + 1):
+                token = self._next_token(request, logits[row, position : position + 1])
+                alive = self._emit(request, token, new_step=position == 0)
+                if not alive or position == len(draft) or token != draft[position]:
+                    break
+                accepted += 1
+            # Rejected draft tokens stay in the KV cache but are never attended.
+            attention_mask[row, start + accepted :] = 0
+            request.drafted += len(draft)
+            request.accepted += accepted
+            if alive:
+                batch.next_tokens[row, 0] = token
+                keep.append(row)
+        batch.past, batch.attention_mask = past, attention_mask
+        if width:
+            batch.trim()
+        batch.retain(keep)
+        self._sync_blocks(batch)
+
+    def _drafts(self, batch: _Batch) -> list[list[int]]:
+        """
+        Draft tokens per row; empty for sampled rows or when not speculating.
+        """
+        rows = len(batch.requests)
+        if not self.num_speculative_tokens or rows > SPECULATIVE_MAX_BATCH:
+            return [[] for _ in range(rows)]
+        drafts = []
+        for row, request in enumerate(batch.requests):
+            budget = min(
+                self.num_speculative_tokens,
+                request.max_new_tokens - len(request.output_ids) - 1,
+            )
+            if request.do_sample or budget <= 0:
+                drafts.append([])
+                continue
+            # The pending next token is the last output id already emitted.
+            drafts.append(ngram_draft(request.input_ids + request.output_ids, budget))
+        return drafts
+
+    def _next_token(self, request: GenerationRequest, logits: torch.Tensor) -> int:
+        if request.processors:
+            ids = torch.tensor(
+                [request.input_ids + request.output_ids], device=logits.device
+            )
+            logits = request.processors(ids, logits)
+        if request.do_sample:
+            probs = torch.softmax(logits, dim=-1)
+            return int(torch.multinomial(probs, num_samples=1)[0, 0])
+        return int(torch.argmax(logits, dim=-1)[0])
+
+    def _emit(
+        self, request: GenerationRequest, token: int, new_step: bool = True
+    ) -> bool:
+        """
+        Deliver a token. Returns False once the request has finished.
+
+        Only the first token of a decode step records an inter-token gap;
+        accepted draft tokens arrive in the same step, and ~0 s gaps for them
+        would drag the ITL distribution down.
+        """
+        now = time.perf_counter()
+        if request.first_token_at is None:
+            request.first_token_at = now
+        elif new_step:
+            request.token_gaps.append(now - request.last_token_at)
+        request.last_token_at = now
+        if token in self._eos_ids:
+            self._finish(request)
+            return False
+        request.output_ids.append(token)
+        request.sink.put((request, token))
+        if len(request.output_ids) >= request.max_new_tokens:
+            self._finish(request)
+            return False
+        return True
+
+    def _finish(self, request: GenerationRequest, error: str | None = None):
+        request.error = error
+        request.finished_at = time.perf_counter()
+        self.kv_blocks.free(request.request_id)
+        if request.adapter is not None:
+            with self._refs_lock:
+                self._adapter_refs[request.adapter] -= 1
+        request.sink.put((request, None))
+        stats = record_request(request)
+        print(
+            f"[scheduler] request #{request.request_id} {request.label or '-'}: "
+            f"tokenize={stats['tokenize']:.3f}s "
+            f"queue_wait={stats['queue_wait']:.3f}s prefill={stats['prefill']:.3f}s "
+            f"ttft={stats['ttft']:.3f}s itl_p50={stats['itl_p50'] * 1000:.1f}ms "
+            f"itl_p99={stats['itl_p99'] * 1000:.1f}ms "
+            f"tokens={stats['tokens']} tokens/s={stats['tokens_per_s']:.1f}"
+            + (
+                f" accepted={request.accepted}/{request.drafted}"
+                if request.drafted
+                else ""
+            )
+            + (f" preempted={request.preemptions}" if request.preemptions else "")
+            + (f" error={error}" if error else "")
+        )
+
+
+class AsyncSink:
+    """
+    Sink that hands scheduler events to a coroutine on an asyncio loop.
+
+    The scheduler thread calls `put`; the event is queued on the consumer's
+    loop with `call_soon_threadsafe`. Create it from the consuming loop.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # The consumer's loop is gone; nobody is left to read the event.
+            pass
+
+    async def get(self):
+        return await self._queue.get()
+
+    def get_nowait(self):
+        """
+        Next event if one is queued, else raise `queue.Empty`.
+        """
+        try:
+            return self._queue.get_nowait()
+        except asyncio.QueueEmpty:
+            raise queue.Empty from None
+
+
+def _drain(request: GenerationRequest, token: int | None, decoder, text) -> bool:
+    """
+    Decode `token` and every event already queued behind it into `text`;
+    returns True once the end of the sequence was reached.
+    """
+    while token is not None:
+        text.add(decoder.push(token), tokens=1)
+        try:
+            _, token = request.sink.get_nowait()
+        except queue.Empty:
+            return False
+    text.add(decoder.flush())
+    return True
+
+
+def iter_text(
+    request: GenerationRequest, tokenizer, with_tokens: bool = False
+) -> Iterator[str]:
+    """
+    Yield text deltas for a request submitted with its own sink.
+
+    Tokens queued while the consumer was busy come out as one delta, and
+    `STREAM_FLUSH_MS` / `STREAM_FLUSH_BYTES` coalesce further (see
+    app/detokenizer.py). With `with_tokens`, yields (delta, tokens) pairs
+    instead, counting the generated tokens behind each delta. Raises
+    RuntimeError if generation failed. Closing the iterator early cancels
+    the request.
+    """
+    decoder = make_detokenizer(tokenizer)
+    text = StreamCoalescer()
+    take = text.take_counted if with_tokens else text.take
+    finished = False
+    try:
+        while not finished:
+            try:
+                _, token = request.sink.get(timeout=text.wait_time())
+            except queue.Empty:
+                yield take()
+                continue
+            finished = _drain(request, token, decoder, text)
+            if text.due():
+                yield take()
+    finally:
+        if request.finished_at is None:
+            request.cancel.set()
+    if text:
+        yield take()
+    if request.error:
+        raise RuntimeError(request.error)
+
+
+async def aiter_text(
+    request: GenerationRequest, tokenizer, with_tokens: bool = False
+) -> AsyncIterator[str]:
+    """
+    Async `iter_text` for a request submitted with an `AsyncSink`.
+    """
+    decoder = make_detokenizer(tokenizer)
+    text = StreamCoalescer()
+    take = text.take_counted if with_tokens else text.take
+    finished = False
+    try:
+        while not finished:
+            wait = text.wait_time()
+            try:
+                if wait is None:
+                    _, token = await request.sink.get()
+                else:
+                    _, token = await asyncio.wait_for(request.sink.get(), wait)
+            except asyncio.TimeoutError:
+                yield take()
+                continue
+            finished = _drain(request, token, decoder, text)
+            if text.due():
+                yield take()
+    finally:
+        if request.finished_at is None:
+            request.cancel.set()
+    if text:
+        yield take()
+    if request.error:
+        raise RuntimeError(request.error)
+
+
+_SCHEDULERS: dict[int, GenerationScheduler] = {}
+_SCHEDULERS_LOCK = threading.Lock()
+
+
+def get_scheduler(model, tokenizer) -> GenerationScheduler:
+    """
+    Return the scheduler that owns `model`, creating it on first use.
+    """
+    with _SCHEDULERS_LOCK:
+        scheduler = _SCHEDULERS.get(id(model))
+        if scheduler is None:
+            scheduler = GenerationScheduler(model, tokenizer)
+            _SCHEDULERS[id(model)] = scheduler
+            # Build the detokenizer's byte table now, not on the first request.
+            byte_table(tokenizer)
+        return scheduler
+
+
+def kv_stats() -> dict:
+    """
+    KV block usage of every scheduler in this process (app/kv_blocks.py).
+    """
+    with _SCHEDULERS_LOCK:
+        schedulers = list(_SCHEDULERS.values())
+    return combine_stats(scheduler.kv_blocks.stats() for scheduler in schedulers)
@@ -0,0 +1,201 @@
+"""
+app/scoring.py
+
+Purpose:
+    Score generated answers against references for the benchmark and the
+    comparison script. Text is tokenized at the character or word level so
+    Chinese answers are scored meaningfully, Rouge-L uses a bit-parallel LCS,
+    and large result sets are scored across a process pool.
+
+Inputs:
+    - Predictions and references (lists of str).
+    - Metric names from `METRICS`; register more with `register_metric`.
+    - Tokenization mode: "char" (default) or "word" (requires `jieba`).
+
+Outputs:
+    - One dict of metric name -> score in [0, 1] per pair (`score_all`).
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from collections.abc import Callable, Sequence
+from concurrent.futures import ProcessPoolExecutor
+
+Metric = Callable[[str, str, str], float]
+
+METRICS: dict[str, Metric] = {}
+
+# Below this many pairs the process pool costs more than it saves.
+PARALLEL_THRESHOLD = 256
+
+_CHAR_TOKEN = re.compile(r"[\u4e00-\u9fff]|[a-z]+|\d+")
+_WORD_TOKEN = re.compile(r"[\u4e00-\u9fffa-z\d]")
+
+
+def register_metric(name: str):
+    """
+    Decorator adding `fn(prediction, reference, tokenize_mode) -> float`.
+    """
+
+    def decorator(fn: Metric) -> Metric:
+        METRICS[name] = fn
+        return fn
+
+    return decorator
+
+
+def tokenize(text: str, mode: str = "char") -> list[str]:
+    """
+    Split text into scoring units.
+
+    "char": every CJK character is a token; Latin words and digit runs are
+    kept whole; punctuation and whitespace are dropped.
+    "word": Chinese word segmentation with jieba, dropping punctuation.
+    """
+    text = text.lower()
+    if mode == "char":
+        return _CHAR_TOKEN.findall(text)
+    if mode == "word":
+        try:
+            import jieba
+        except ImportError as exc:
+            raise ImportError(
+                "Word-level scoring needs jieba: `uv pip install jieba`."
+            ) from exc
+        return [word for word in jieba.lcut(text) if _WORD_TOKEN.search(word)]
+    raise ValueError(f"Unknown tokenize mode '{mode}'")
+
+
+def lcs_length(a: Sequence[str], b: Sequence[str]) -> int:
+    """
+    Length of the longest common subsequence of two token sequences.
+
+    Bit-parallel (Hyyro 2004): each row of the DP table is one Python int,
+    so the cost is O(len(a) * len(b) / word size).
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return 0
+    masks: dict[str, int] = {}
+    for i, token in enumerate(a):
+        masks[token] = masks.get(token, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    row = full
+    for token in b:
+        matches = row & masks.get(token, 0)
+        row = ((row + matches) | (row - matches)) & full
+    return len(a) - row.bit_count()
+
+
+@register_metric("rouge_l")
+def rouge_l(prediction: str, reference: str, mode: str = "char") -> float:
+    """
+    Rouge-L F1 over `tokenize(..., mode)` tokens.
+    """
+    pred_tokens = tokenize(prediction, mode)
+    ref_tokens = tokenize(reference, mode)
+    if not pred_tokens or not ref_tokens:
+        return 0.0
+    lcs = lcs_length(pred_tokens, ref_tokens)
+    if lcs == 0:
+        return 0.0
+    precision = lcs / len(pred_tokens)
+    recall = lcs / len(ref_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def calculate_similarity(generated, reference):
+    """计算生成答案与参考答案的相似度"""
+
+    # 提取中文词汇（2字及以上）
+    gen_words = set(re.findall(r"[\u4e00-\u9fff]{2,}", generated))
+    ref_words = set(re.findall(r"[\u4e00-\u9fff]{2,}", reference))
+
+    # 词汇重叠率
+    if len(ref_words) > 0:
+        common = gen_words & ref_words
+        word_overlap = len(common) / len(ref_words)
+        common_count = len(common)
+    else:
+        word_overlap = 0
+        common_count = 0
+
+    # 关键短语覆盖（4字及以上）
+    ref_phrases = set(re.findall(r"[\u4e00-\u9fff]{4,}", reference))
+    if len(ref_phrases) > 0:
+        phrase_hits = sum(1 for phrase in ref_phrases if phrase in generated)
+        phrase_coverage = phrase_hits / len(ref_phrases)
+    else:
+        phrase_coverage = 0
+
+    # 综合得分
+    score = (word_overlap * 0.6 + phrase_coverage * 0.4) * 100
+
+    return {
+        "score": score,
+        "word_overlap": word_overlap,
+        "phrase_coverage": phrase_coverage,
+        "common_words": common_count,
+        "total_ref_words": len(ref_words),
+    }
+
+
+@register_metric("keyword_overlap")
+def keyword_overlap(prediction: str, reference: str, mode: str = "char") -> float:
+    """
+    The keyword/phrase overlap score of `calculate_similarity`, scaled to [0, 1].
+    """
+    return calculate_similarity(prediction, reference)["score"] / 100
+
+
+def _score_chunk(args) -> list[dict[str, float]]:
+    predictions, references, metrics, mode = args
+    return [
+        {name: METRICS[name](pred, ref, mode) for name in metrics}
+        for pred, ref in zip(predictions, references)
+    ]
+
+
+def score_all(
+    predictions: Sequence[str],
+    references: Sequence[str],
+    metrics: Sequence[str] = ("rouge_l",),
+    mode: str = "char",
+    workers: int = 0,
+) -> list[dict[str, float]]:
+    """
+    Score every (prediction, reference) pair with each metric.
+
+    `workers=0` uses one process per CPU; large inputs are split into
+    chunks and scored across a process pool, small ones in-process.
+    """
+    unknown = [name for name in metrics if name not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics {unknown}; available: {sorted(METRICS)}")
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(predictions) < PARALLEL_THRESHOLD:
+        return _score_chunk((predictions, references, metrics, mode))
+
+    size = -(-len(predictions) // (workers * 4))
+    chunks = [
+        (predictions[i : i + size], references[i : i + size], metrics, mode)
+        for i in range(0, len(predictions), size)
+    ]
+    results: list[dict[str, float]] = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in pool.map(_score_chunk, chunks):
+            results.extend(chunk)
+    return results
+
+
+def average(scores: Sequence[dict[str, float]]) -> dict[str, float]:
+    """
+    Mean of each metric over all pairs.
+    """
+    if not scores:
+        return {}
+    return {name: sum(s[name] for s in scores) / len(scores) for name in scores[0]}
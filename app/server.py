@@ -1,11 +1,42 @@
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
-from fastapi.staticfiles import StaticFiles
+import hmac
+import ipaddress
+import os
+import time
+
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from app.inference import stream_response
-from app.comparison import stream_compare, load_models
-import os
+from starlette.background import BackgroundTask
+
+from app.adapters import AdapterInUseError
+from app.admission import AdmissionController, AdmissionRejected, Slot
+from app.comparison import (
+    BASE_MODEL_PATH,
+    COMPARE_MODE,
+    DEFAULT_ADAPTER,
+    MAX_NEW_TOKENS,
+    astream_compare,
+    compare_error,
+    get_registry,
+    load_models_in_background,
+)
+from app.inference import CHAT_MAX_NEW_TOKENS, CHAT_MODEL_PATH, astream_response
+from app.kv_blocks import combine_stats
+from app.loading import WARMUP
+from app.merge import LORA_ADAPTER_PATH, is_adapter, merged_model_path
+from app.metrics import METRICS, merge_snapshots
+from app.profiling import new_profile_name, profile_dir
+from app.quantization import QUANTIZATION
+from app.response_cache import (
+    ResponseCache,
+    cache_key,
+    decoding_params,
+    weights_fingerprint,
+)
+from app.scheduler import kv_stats
+from app.workers import SERVE_WORKERS, WorkerError, WorkerPool
 
 app = FastAPI()
 
@@ -19,30 +50,437 @@ app.add_middleware(
 )
 
 
+# With SERVE_WORKERS > 0, generation runs in model-worker processes and this
+# process only routes requests (see app/workers.py).
+_POOL: WorkerPool | None = None
+
+# Bounds concurrent + queued generation requests and gives each a deadline.
+# Worker processes (SERVE_WORKERS > 0) hold their own KV budgets; their
+# schedulers defer requests that do not fit.
+ADMISSION = AdmissionController(
+    kv_utilization=None if SERVE_WORKERS else lambda: kv_stats()["utilization"]
+)
+# Finished answers to repeated questions (greedy decoding only); checked
+# before admission, so hits never wait for a generation slot.
+RESPONSE_CACHE = ResponseCache()
+
+
 @app.on_event("startup")
 async def startup_event():
     """
-    Load models on startup so the first request isn't slow.
+    Start loading models in the background so the first request isn't slow.
+
+    The server accepts connections right away; `GET /api/ready` reports
+    warm-up progress and requests that arrive early wait for the model.
     """
-    try:
-        load_models()
-    except Exception as e:
-        print(f"[ERROR] Failed to load models on startup: {e}")
+    global _POOL
+    if SERVE_WORKERS > 0:
+        _POOL = WorkerPool(SERVE_WORKERS)
+        _POOL.start()
+        return
+    load_models_in_background()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if _POOL is not None:
+        _POOL.stop()
 
 
 class ChatRequest(BaseModel):
     message: str
 
 
+class CompareRequest(ChatRequest):
+    # Registered adapter for the "lora" side; defaults to law-qa-qwen-lora.
+    adapter: str | None = None
+
+
+class AdapterLoadRequest(BaseModel):
+    name: str
+    path: str
+
+
+# If set, admin endpoints require a matching `X-Admin-Token` header;
+# otherwise they only answer clients on the loopback interface.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+
+def _is_loopback(http_request: Request) -> bool:
+    host = http_request.client.host if http_request.client else None
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _check_admin(http_request: Request, token: str | None):
+    if ADMIN_TOKEN:
+        if not hmac.compare_digest(token or "", ADMIN_TOKEN):
+            raise HTTPException(status_code=401, detail="Invalid admin token")
+    elif not _is_loopback(http_request):
+        raise HTTPException(
+            status_code=403,
+            detail="Admin endpoints are local-only; set ADMIN_TOKEN to allow remote use",
+        )
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+async def _pool_stream(kind: str, payload: dict, slot: Slot, error_line):
+    try:
+        async for chunk in _POOL.stream(
+            kind, payload, cancel=slot.cancel, timeout=slot.remaining()
+        ):
+            yield chunk
+    except WorkerError as e:
+        yield error_line(e)
+
+
+async def _admitted(slot: Slot, chunks):
+    """
+    Stream `chunks` while holding `slot`.
+
+    Runs the `finally` on completion, error or client disconnect (Starlette
+    cancels this generator), which cancels generation and frees the slot.
+    """
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        ADMISSION.release(slot)
+
+
+def _admitted_response(slot: Slot, chunks, media_type: str) -> StreamingResponse:
+    # The background task also frees the slot if streaming never started.
+    return StreamingResponse(
+        _admitted(slot, chunks),
+        media_type=media_type,
+        background=BackgroundTask(ADMISSION.release, slot),
+    )
+
+
+# Adapter name -> (path, version) for response-cache keys. The version
+# changes on every admin load, so answers cached for an earlier adapter
+# under the same name are never served again.
+_ADAPTER_VERSIONS = {DEFAULT_ADAPTER: (LORA_ADAPTER_PATH, 0)}
+
+
+def _cache_key(kind: str, request: ChatRequest) -> str | None:
+    """
+    Response-cache key for a request, or None if its answer is not cacheable.
+    """
+    if not RESPONSE_CACHE.enabled:
+        return None
+    if kind == "chat":
+        decoding = decoding_params(CHAT_MODEL_PATH, BASE_MODEL_PATH)
+        weights = [CHAT_MODEL_PATH]
+        if is_adapter(CHAT_MODEL_PATH):
+            weights += [BASE_MODEL_PATH, merged_model_path(CHAT_MODEL_PATH)]
+        identity = {
+            "model": CHAT_MODEL_PATH,
+            "weights": weights_fingerprint(*weights),
+            "max_new_tokens": CHAT_MAX_NEW_TOKENS,
+        }
+    else:
+        decoding = decoding_params(BASE_MODEL_PATH)
+        adapter = request.adapter or DEFAULT_ADAPTER
+        path, version = _ADAPTER_VERSIONS.get(adapter, (None, 0))
+        identity = {
+            "model": BASE_MODEL_PATH,
+            "adapter": adapter,
+            "weights": weights_fingerprint(BASE_MODEL_PATH, path),
+            "adapter_version": version,
+            "max_new_tokens": MAX_NEW_TOKENS,
+            "mode": COMPARE_MODE,
+        }
+    if decoding["do_sample"]:
+        return None
+    return cache_key(
+        kind,
+        request.message,
+        quantization=QUANTIZATION,
+        decoding=decoding,
+        **identity,
+    )
+
+
+async def _cached(body: str):
+    yield body
+
+
 @app.post("/api/chat")
 async def chat_endpoint(request: ChatRequest):
-    return StreamingResponse(stream_response(request.message), media_type="text/plain")
+    key = _cache_key("chat", request)
+    body = RESPONSE_CACHE.get(key) if key else None
+    if body is not None:
+        return StreamingResponse(_cached(body), media_type="text/plain")
+    slot = await ADMISSION.acquire()
+    if _POOL is not None:
+        chunks = _pool_stream(
+            "chat",
+            {"message": request.message},
+            slot,
+            lambda e: f"[ERROR] Failed to stream inference: {e}",
+        )
+    else:
+        chunks = astream_response(request.message, slot.cancel, slot.remaining())
+    if key:
+        chunks = RESPONSE_CACHE.record(key, chunks, tag="chat")
+    return _admitted_response(slot, chunks, "text/plain")
 
 
 @app.post("/api/compare")
-async def compare_endpoint(request: ChatRequest):
-    return StreamingResponse(
-        stream_compare(request.message), media_type="application/x-ndjson"
+async def compare_endpoint(
+    request: CompareRequest,
+    http_request: Request,
+    profile: bool = False,
+    x_profile: str | None = Header(None),
+    x_admin_token: str | None = Header(None),
+):
+    # `?profile=1` or `X-Profile: 1` profiles this request (needs a configured
+    # ADMIN_TOKEN, never served from or stored in the response cache); the
+    # trace directory is returned in the `X-Profile-Trace` header. See
+    # app/profiling.py.
+    profile_name = None
+    if profile or x_profile == "1":
+        if not ADMIN_TOKEN:
+            raise HTTPException(
+                status_code=403, detail="Profiling requires ADMIN_TOKEN to be set"
+            )
+        _check_admin(http_request, x_admin_token)
+        profile_name = new_profile_name("compare")
+    key = None if profile_name else _cache_key("compare", request)
+    body = RESPONSE_CACHE.get(key) if key else None
+    if body is not None:
+        return StreamingResponse(_cached(body), media_type="application/x-ndjson")
+    slot = await ADMISSION.acquire()
+    if _POOL is not None:
+        chunks = _pool_stream(
+            "compare",
+            {
+                "message": request.message,
+                "adapter": request.adapter,
+                "profile": profile_name,
+            },
+            slot,
+            compare_error,
+        )
+    else:
+        chunks = astream_compare(
+            request.message,
+            request.adapter,
+            slot.cancel,
+            slot.remaining(),
+            profile_name,
+        )
+    if key:
+        chunks = RESPONSE_CACHE.record(
+            key, chunks, tag=request.adapter or DEFAULT_ADAPTER
+        )
+    response = _admitted_response(slot, chunks, "application/x-ndjson")
+    if profile_name:
+        response.headers["X-Profile-Trace"] = profile_dir(profile_name)
+    return response
+
+
+_ADMIN_ERRORS = {
+    "KeyError": 404,
+    "AdapterInUseError": 409,
+    "ValueError": 400,
+    "FileNotFoundError": 400,
+}
+
+
+def _registry_call(method: str, *args) -> list:
+    """
+    Run an adapter-registry method in-process, or in every worker.
+    """
+    if _POOL is None:
+        return [getattr(get_registry(), method)(*args)]
+    try:
+        return _POOL.call_all(method, *args)
+    except WorkerError as e:
+        raise HTTPException(status_code=_ADMIN_ERRORS.get(e.kind, 500), detail=str(e))
+
+
+# Admin endpoints are plain `def` so FastAPI runs them in its threadpool:
+# loading an adapter reads weights from disk and waits for the model lock.
+@app.get("/api/admin/adapters")
+def list_adapters(http_request: Request, x_admin_token: str | None = Header(None)):
+    _check_admin(http_request, x_admin_token)
+    return {"adapters": _registry_call("list")[0]}
+
+
+@app.post("/api/admin/adapters")
+def load_adapter(
+    request: AdapterLoadRequest,
+    http_request: Request,
+    x_admin_token: str | None = Header(None),
+):
+    _check_admin(http_request, x_admin_token)
+    try:
+        results = _registry_call("load", request.name, request.path)
+    except (ValueError, FileNotFoundError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except AdapterInUseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    evicted = sorted({name for result in results for name in result})
+    # Answers cached for an adapter of the same name came from other weights.
+    _ADAPTER_VERSIONS[request.name] = (request.path, time.time_ns())
+    RESPONSE_CACHE.invalidate(request.name)
+    return {"loaded": request.name, "evicted": evicted}
+
+
+@app.delete("/api/admin/adapters/{name}")
+def unload_adapter(
+    name: str, http_request: Request, x_admin_token: str | None = Header(None)
+):
+    _check_admin(http_request, x_admin_token)
+    try:
+        _registry_call("unload", name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Adapter '{name}' is not loaded")
+    except AdapterInUseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    _ADAPTER_VERSIONS.pop(name, None)
+    RESPONSE_CACHE.invalidate(name)
+    return {"unloaded": name}
+
+
+@app.get("/api/admin/cache")
+def cache_stats(http_request: Request, x_admin_token: str | None = Header(None)):
+    _check_admin(http_request, x_admin_token)
+    try:
+        kv_cache = _kv_stats()
+    except WorkerError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {
+        "response_cache": RESPONSE_CACHE.stats(),
+        "admission": ADMISSION.stats(),
+        "kv_cache": kv_cache,
+    }
+
+
+def _kv_stats() -> dict:
+    """
+    KV cache block usage of this process or of all workers combined.
+    """
+    if _POOL is None:
+        return kv_stats()
+    return combine_stats(_POOL.call_all("kv"))
+
+
+@app.delete("/api/admin/cache")
+def clear_cache(http_request: Request, x_admin_token: str | None = Header(None)):
+    _check_admin(http_request, x_admin_token)
+    RESPONSE_CACHE.invalidate()
+    return {"cleared": True}
+
+
+@app.get("/api/ready")
+def ready_endpoint():
+    """
+    Readiness probe: 200 once the models are loaded, 503 with warm-up
+    progress (per component: stage, seconds so far, peak RSS) until then.
+    """
+    if _POOL is None:
+        status = WARMUP.snapshot()
+    else:
+        try:
+            workers = _POOL.call_all("ready")
+        except WorkerError as e:
+            workers = [{"ready": False, "error": str(e)}]
+        status = {"ready": all(w["ready"] for w in workers), "workers": workers}
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """
+    Prometheus scrape endpoint: per-request latency breakdown from every
+    model process plus admission and response-cache counters.
+    """
+    try:
+        if _POOL is None:
+            snapshot = METRICS.snapshot()
+        else:
+            snapshot = merge_snapshots(_POOL.call_all("metrics"))
+        kv = _kv_stats()
+    except WorkerError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    admission, cache = ADMISSION.stats(), RESPONSE_CACHE.stats()
+    extra = {
+        "law_admission_active": (
+            "gauge",
+            "Requests holding a generation slot.",
+            admission["active"],
+        ),
+        "law_admission_waiting": (
+            "gauge",
+            "Requests waiting for a slot.",
+            admission["waiting"],
+        ),
+        "law_admission_rejected_total": (
+            "counter",
+            "Requests rejected with 429 (queue full).",
+            admission["rejected"],
+        ),
+        "law_admission_timed_out_total": (
+            "counter",
+            "Requests rejected with 503 (no slot before the deadline).",
+            admission["timed_out"],
+        ),
+        "law_admission_kv_rejected_total": (
+            "counter",
+            "Requests rejected with 429 (KV cache nearly full).",
+            admission["kv_rejected"],
+        ),
+        "law_kv_blocks_total": (
+            "gauge",
+            "KV cache blocks in the memory budget.",
+            kv["blocks_total"],
+        ),
+        "law_kv_blocks_used": (
+            "gauge",
+            "KV cache blocks held by running sequences.",
+            kv["blocks_used"],
+        ),
+        "law_kv_utilization": (
+            "gauge",
+            "Used share of the fullest KV cache budget.",
+            kv["utilization"],
+        ),
+        "law_kv_preemptions_total": (
+            "counter",
+            "Sequences preempted to stay within the KV cache budget.",
+            kv["preempted"],
+        ),
+        "law_response_cache_hits_total": (
+            "counter",
+            "Response cache hits.",
+            cache["hits"],
+        ),
+        "law_response_cache_misses_total": (
+            "counter",
+            "Response cache misses.",
+            cache["misses"],
+        ),
+        "law_response_cache_entries": (
+            "gauge",
+            "Entries in the response cache.",
+            cache["entries"],
+        ),
+    }
+    return PlainTextResponse(
+        METRICS.render(snapshot, extra), media_type="text/plain; version=0.0.4"
     )
 
 
@@ -0,0 +1,198 @@
+"""
+app/shared_weights.py
+
+Purpose:
+    One copy of the base weights in RAM for every model process on the host.
+    Normally each worker process (SERVE_WORKERS > 0) or `app.server` replica
+    loads its own fp16 copy of app/models/base, so RAM caps the replica
+    count. With `SHARED_WEIGHTS=1` the checkpoint is converted once to a
+    flat file in the serving dtype, and every process maps that file
+    read-only (copy-on-write) instead of loading it. The pages live in the
+    OS page cache and are shared by all mappers; each process only holds
+    its own KV caches, LoRA matrices and activations.
+
+    Only float ("none" quantization) CPU serving can share: quantized modes
+    rewrite the weights per process, and GPU weights are not host memory.
+    Merged-adapter loads write into the base weights, so they load normally.
+
+Inputs:
+    - `SHARED_WEIGHTS=1`: enable sharing (default off).
+    - `SHARED_WEIGHTS_DIR`: where the flat files live (default
+      app/data/cache/shared_weights; use a /dev/shm path to keep them in
+      RAM-backed tmpfs).
+    - A model directory with *.safetensors weights.
+
+Outputs:
+    - `<SHARED_WEIGHTS_DIR>/<key>.bin` + `<key>.json`: the flat weights and
+      their manifest (tensor name -> offset, shape). The key covers the
+      checkpoint files and the dtype, so a changed checkpoint gets a new
+      file.
+    - `load_shared_model`: a model whose parameters are views into the map.
+"""
+
+from __future__ import annotations
+
+import glob
+import hashlib
+import json
+import os
+
+import torch
+from safetensors import safe_open
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+from transformers.modeling_utils import no_init_weights
+
+from app.quantization import QUANTIZATION, model_load_kwargs
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+SHARED_WEIGHTS = os.environ.get("SHARED_WEIGHTS", "0") == "1"
+SHARED_WEIGHTS_DIR = os.environ.get(
+    "SHARED_WEIGHTS_DIR", "app/data/cache/shared_weights"
+)
+
+
+def _checkpoint_files(model_path: str) -> list[str]:
+    return sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+
+
+def unsupported_reason(model_path: str, quantization: str = QUANTIZATION) -> str | None:
+    """
+    Why `model_path` cannot be served from shared weights, or None if it can.
+    """
+    if quantization != "none":
+        return f"QUANTIZATION={quantization} rewrites the weights per process"
+    if torch.cuda.is_available():
+        return "weights are placed on the GPU"
+    if not _checkpoint_files(model_path):
+        return f"no *.safetensors weights in '{model_path}'"
+    return None
+
+
+def _cache_key(model_path: str, dtype: torch.dtype) -> str:
+    digest = hashlib.sha256(f"{os.path.realpath(model_path)}|{dtype}".encode())
+    for path in _checkpoint_files(model_path):
+        stat = os.stat(path)
+        digest.update(
+            f"|{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    return digest.hexdigest()[:16]
+
+
+def _write_flat(
+    model_path: str, dtype: torch.dtype, data_path: str, manifest_path: str
+):
+    """
+    Convert the checkpoint tensor by tensor into one flat `dtype` file.
+    """
+    tensors: dict[str, list] = {}
+    offset = 0
+    tmp_data = f"{data_path}.{os.getpid()}.tmp"
+    with open(tmp_data, "wb") as out:
+        for path in _checkpoint_files(model_path):
+            with safe_open(path, framework="pt") as checkpoint:
+                # safe_open handles have keys() but are not iterable.
+                for name in checkpoint.keys():  # noqa: SIM118
+                    tensor = checkpoint.get_tensor(name).to(dtype).contiguous()
+                    out.write(tensor.view(torch.uint8).numpy().tobytes())
+                    tensors[name] = [offset, list(tensor.shape)]
+                    offset += tensor.numel()
+    manifest = {
+        "model_path": os.path.realpath(model_path),
+        "dtype": str(dtype).replace("torch.", ""),
+        "numel": offset,
+        "tensors": tensors,
+    }
+    tmp_manifest = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_manifest, "w") as f:
+        json.dump(manifest, f)
+    # Data first: a manifest on disk always points at a complete file.
+    os.replace(tmp_data, data_path)
+    os.replace(tmp_manifest, manifest_path)
+
+
+def export_shared_weights(
+    model_path: str,
+    dtype: torch.dtype = torch.float16,
+    directory: str = SHARED_WEIGHTS_DIR,
+) -> str:
+    """
+    Write the flat weight file for `model_path` unless it already exists;
+    returns the manifest path.
+
+    Concurrent callers (workers starting together) wait on a lock file, so
+    the checkpoint is converted once.
+    """
+    os.makedirs(directory, exist_ok=True)
+    key = _cache_key(model_path, dtype)
+    manifest_path = os.path.join(directory, f"{key}.json")
+    data_path = os.path.join(directory, f"{key}.bin")
+    with open(os.path.join(directory, f"{key}.lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(manifest_path):
+            print(
+                f"[INFO] Writing shared weights for '{model_path}' to '{data_path}'..."
+            )
+            _write_flat(model_path, dtype, data_path, manifest_path)
+    return manifest_path
+
+
+def map_weights(manifest_path: str) -> tuple[torch.Tensor, dict[str, torch.Tensor]]:
+    """
+    A copy-on-write mapping of the flat file and {name: view into it}.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    dtype = getattr(torch, manifest["dtype"])
+    data_path = manifest_path[: -len(".json")] + ".bin"
+    # shared=False maps the file MAP_PRIVATE: reads hit the shared page
+    # cache, while an accidental in-place write stays private to this process.
+    flat = torch.from_file(data_path, shared=False, size=manifest["numel"], dtype=dtype)
+    state = {}
+    for name, (offset, shape) in manifest["tensors"].items():
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        state[name] = flat[offset : offset + numel].view(shape)
+    return flat, state
+
+
+def load_shared_model(model_path: str, quantization: str = QUANTIZATION):
+    """
+    Build `model_path`'s architecture without initialising weights, then
+    point every parameter at the shared mapping (exporting it first if
+    needed).
+    """
+    dtype = model_load_kwargs(quantization)["torch_dtype"]
+    manifest_path = export_shared_weights(model_path, dtype)
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    # Uninitialised parameters are never touched, so they take no resident
+    # memory before being swapped for the mapped views. (Building on the
+    # meta device instead pulls in ~100 MB of meta-kernel code per process.)
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(
+            config, torch_dtype=dtype, trust_remote_code=True
+        )
+    flat, state = map_weights(manifest_path)
+    model.load_state_dict(state, strict=False, assign=True)
+    model.tie_weights()
+    mapped = flat.untyped_storage().data_ptr()
+    missing = [
+        name
+        for name, param in model.named_parameters()
+        if param.untyped_storage().data_ptr() != mapped
+    ]
+    if missing:
+        raise ValueError(
+            f"Shared weights for '{model_path}' lack {len(missing)} parameters, "
+            f"e.g. {missing[:3]}"
+        )
+    model.requires_grad_(False)
+    model.config._name_or_path = model_path
+    if os.path.exists(os.path.join(model_path, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    return model
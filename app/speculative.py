@@ -0,0 +1,60 @@
+"""
+app/speculative.py
+
+Purpose:
+    Draft tokens for speculative decoding by prompt lookup: the last few
+    generated tokens are matched against the prompt and the answer so far,
+    and the tokens that followed the most recent match are proposed. Legal
+    answers quote the question, statute names and their own earlier phrases
+    a lot, so long stretches are drafted correctly for free. The scheduler
+    verifies a row's draft in the same forward pass as its next token and
+    keeps the longest prefix the model agrees with, so greedy output is
+    unchanged.
+
+Inputs:
+    - `SPECULATIVE_DECODING`: "none" (default) or "ngram".
+    - `NUM_SPECULATIVE_TOKENS`: max tokens drafted per row and step.
+    - `SPECULATIVE_MAX_BATCH`: only speculate while a batch has at most this
+      many rows; bigger batches already keep the CPU busy.
+
+Outputs:
+    - `ngram_draft`: proposed continuation token ids (possibly empty).
+"""
+
+from __future__ import annotations
+
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+SPECULATIVE_MODES = ("none", "ngram")
+SPECULATIVE_DECODING = os.environ.get("SPECULATIVE_DECODING", "none")
+NUM_SPECULATIVE_TOKENS = int(os.environ.get("NUM_SPECULATIVE_TOKENS", "5"))
+SPECULATIVE_MAX_BATCH = int(os.environ.get("SPECULATIVE_MAX_BATCH", "4"))
+# Longest / shortest suffix matched against earlier tokens.
+MAX_NGRAM = 3
+MIN_NGRAM = 1
+
+
+def ngram_draft(
+    tokens: Sequence[int], num_tokens: int, max_ngram: int = MAX_NGRAM
+) -> list[int]:
+    """
+    Up to `num_tokens` ids that followed the latest earlier occurrence of
+    the sequence's final n-gram (longest n first).
+    """
+    if num_tokens <= 0 or len(tokens) < 2:
+        return []
+    ids = np.asarray(tokens, dtype=np.int64)
+    for n in range(min(max_ngram, len(ids) - 1), MIN_NGRAM - 1, -1):
+        pattern = ids[-n:]
+        # Windows starting before the final n-gram itself.
+        windows = np.lib.stride_tricks.sliding_window_view(ids[:-1], n)
+        matches = np.flatnonzero((windows == pattern).all(axis=1))
+        if len(matches):
+            start = int(matches[-1]) + n
+            draft = ids[start : start + num_tokens]
+            if len(draft):
+                return draft.tolist()
+    return []
@@ -0,0 +1,115 @@
+"""
+app/tiny_model.py
+
+Purpose:
+    Build a tiny, randomly initialised stand-in for the base model and the
+    LoRA adapter, entirely offline, so the server, load tests and profiling
+    can run on a laptop or CI box without downloading Qwen2.5-1.5B. It keeps
+    the real architecture (Qwen2), tokenizer and chat template, and the
+    shipped adapter's LoRA settings, so every code path (prefix cache, PEFT
+    mixed-adapter batches, merging) is exercised. Its answers are noise.
+
+Inputs:
+    - app/models/base/config.json: architecture to shrink.
+    - app/models/law-qa-qwen-lora: tokenizer files and adapter_config.json.
+
+Outputs:
+    - app/models/tiny/: model + tokenizer (`BASE_MODEL_PATH` /
+      `CHAT_MODEL_PATH`).
+    - app/models/tiny-lora/: LoRA adapter (`LORA_ADAPTER_PATH`).
+"""
+
+import argparse
+import json
+import os
+
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+from app.merge import BASE_MODEL_PATH, LORA_ADAPTER_PATH
+
+TINY_MODEL_PATH = "app/models/tiny"
+TINY_ADAPTER_PATH = "app/models/tiny-lora"
+# Architecture overrides: a few MB of weights instead of a few GB.
+TINY_CONFIG = {
+    "hidden_size": 64,
+    "intermediate_size": 128,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "max_window_layers": 2,
+    "torch_dtype": "float32",
+}
+
+
+def build_tiny_model(
+    output: str = TINY_MODEL_PATH,
+    adapter_output: str = TINY_ADAPTER_PATH,
+    config_path: str = BASE_MODEL_PATH,
+    adapter_path: str = LORA_ADAPTER_PATH,
+    seed: int = 0,
+):
+    """
+    Save a random tiny model (with tokenizer) and a random LoRA adapter.
+    """
+    torch.manual_seed(seed)
+    tokenizer = AutoTokenizer.from_pretrained(adapter_path, trust_remote_code=True)
+    config = AutoConfig.from_pretrained(config_path, **TINY_CONFIG)
+    # Newer transformers keep one `layer_types` entry per layer and refuse to
+    # load a config whose list disagrees with `num_hidden_layers`.
+    if getattr(config, "layer_types", None):
+        config.layer_types = config.layer_types[: config.num_hidden_layers]
+    # The tokenizer may define more ids than the original embedding matrix.
+    config.vocab_size = max(config.vocab_size, len(tokenizer))
+
+    print(f"[INFO] Building tiny {config.model_type} model in '{output}'...")
+    model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32)
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    model.save_pretrained(output)
+    tokenizer.save_pretrained(output)
+
+    # Reloaded so the adapter records `output` as its base model.
+    model = AutoModelForCausalLM.from_pretrained(output)
+
+    with open(os.path.join(adapter_path, "adapter_config.json")) as f:
+        shipped = json.load(f)
+    lora_config = LoraConfig(
+        r=shipped["r"],
+        lora_alpha=shipped["lora_alpha"],
+        target_modules=shipped["target_modules"],
+        lora_dropout=shipped["lora_dropout"],
+        task_type="CAUSAL_LM",
+    )
+    peft_model = get_peft_model(model, lora_config)
+    # PEFT starts lora_B at zero (a no-op adapter); randomise it so base and
+    # LoRA answers differ like a trained adapter's would.
+    with torch.no_grad():
+        for name, param in peft_model.named_parameters():
+            if "lora_B" in name:
+                param.normal_(std=0.02)
+    peft_model.save_pretrained(adapter_output)
+    tokenizer.save_pretrained(adapter_output)
+    print(f"[INFO] Saved tiny LoRA adapter to '{adapter_output}'")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a tiny random stand-in model + LoRA adapter"
+    )
+    parser.add_argument("--output", default=TINY_MODEL_PATH)
+    parser.add_argument("--adapter-output", default=TINY_ADAPTER_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    build_tiny_model(args.output, args.adapter_output, seed=args.seed)
+    print(
+        "[RESULT] Serve it with: "
+        f"BASE_MODEL_PATH={args.output} LORA_ADAPTER_PATH={args.adapter_output} "
+        f"CHAT_MODEL_PATH={args.output} make dev"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,39 +3,269 @@ app/train.py
 
 Purpose:
     Execute Supervised Fine-Tuning (SFT) on the base model using the dataset.
+    Trains a PEFT/LoRA adapter for the Qwen2.5 base with length-grouped
+    batching (or sequence packing), gradient accumulation and optional
+    gradient checkpointing, printing tokens/s and samples/s per step.
 
 Inputs:
     - Base model path
-    - Dataset path
-    - Training arguments
+    - Dataset path (a DISC-Law-SFT style JSONL file or a directory of them,
+      records with "input"/"output" fields), read through the pre-tokenized
+      cache in app/data_cache.py
+    - Training arguments; LoRA defaults (r, alpha, dropout, target modules)
+      come from the existing `law-qa-qwen-lora/adapter_config.json`
 Outputs:
-    - Fine-tuned adapters (LoRA)
+    - Fine-tuned adapters (LoRA) + tokenizer in the output directory
 """
 
 import argparse
+import json
+import math
+import os
+import random
 import time
 
+import numpy as np
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    get_linear_schedule_with_warmup,
+)
 
-def train(base_model_path: str, data_path: str, output_dir: str):
+from app.data_cache import jsonl_files, load_or_build
+
+DEFAULT_ADAPTER_CONFIG = "app/models/law-qa-qwen-lora/adapter_config.json"
+SYSTEM_PROMPT = "你是一个专业的法律咨询助手。"
+IGNORE_INDEX = -100
+
+
+def load_lora_config(path: str = DEFAULT_ADAPTER_CONFIG, **overrides) -> LoraConfig:
+    """
+    Build a trainable LoraConfig from an existing adapter_config.json.
+    """
+    settings = {
+        "r": 4,
+        "lora_alpha": 8,
+        "lora_dropout": 0.05,
+        "target_modules": ["q_proj", "k_proj", "v_proj", "o_proj"],
+    }
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        settings.update({key: saved[key] for key in settings if key in saved})
+    settings.update({key: value for key, value in overrides.items() if value})
+    return LoraConfig(task_type="CAUSAL_LM", bias="none", **settings)
+
+
+def select_examples(dataset, limit: int = 0):
+    """
+    Indices of cached records that have both a question and an answer.
+    """
+    valid = np.flatnonzero(
+        (dataset.lengths("input") > 0) & (dataset.lengths("output") > 0)
+    )
+    return valid[:limit] if limit else valid
+
+
+def build_example(dataset, index: int, max_seq_len: int):
+    """
+    Prompt + answer token ids; only answer tokens contribute to the loss.
+    """
+    prompt_ids = dataset.prompt_ids(index)
+    answer_ids = dataset.answer_ids(index)
+    input_ids = (prompt_ids + answer_ids)[:max_seq_len]
+    labels = ([IGNORE_INDEX] * len(prompt_ids) + answer_ids)[:max_seq_len]
+    return input_ids, labels
+
+
+def length_grouped_batches(indices, lengths, batch_size: int, seed: int):
+    """
+    Shuffle, then sort within mega-batches by length so each batch pads little.
+
+    Returns lists of dataset indices; `lengths[k]` is the length of `indices[k]`.
+    """
+    rng = random.Random(seed)
+    order = list(range(len(indices)))
+    rng.shuffle(order)
+    mega = batch_size * 50
+    batches = []
+    for start in range(0, len(order), mega):
+        chunk = sorted(order[start : start + mega], key=lambda k: lengths[k])
+        batches.extend(
+            chunk[i : i + batch_size] for i in range(0, len(chunk), batch_size)
+        )
+    rng.shuffle(batches)
+    return [[int(indices[k]) for k in batch] for batch in batches]
+
+
+def packed_batches(dataset, indices, batch_size, max_seq_len, seed):
+    """
+    Concatenate shuffled examples into rows of exactly `max_seq_len` tokens.
+
+    A generator, so only the current batch is held in memory.
+    """
+    rng = random.Random(seed)
+    order = [int(i) for i in indices]
+    rng.shuffle(order)
+    rows, ids, labels = [], [], []
+    for index in order:
+        example_ids, example_labels = build_example(dataset, index, max_seq_len)
+        ids.extend(example_ids)
+        labels.extend(example_labels)
+        while len(ids) >= max_seq_len:
+            rows.append((ids[:max_seq_len], labels[:max_seq_len]))
+            ids, labels = ids[max_seq_len:], labels[max_seq_len:]
+            if len(rows) == batch_size:
+                yield rows
+                rows = []
+    if ids:
+        rows.append((ids, labels))
+    if rows:
+        yield rows
+
+
+def collate(batch, pad_id: int):
+    width = max(len(ids) for ids, _ in batch)
+    input_ids = torch.full((len(batch), width), pad_id, dtype=torch.long)
+    labels = torch.full((len(batch), width), IGNORE_INDEX, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+    for row, (ids, row_labels) in enumerate(batch):
+        input_ids[row, : len(ids)] = torch.tensor(ids)
+        labels[row, : len(row_labels)] = torch.tensor(row_labels)
+        attention_mask[row, : len(ids)] = 1
+    return {"input_ids": input_ids, "labels": labels, "attention_mask": attention_mask}
+
+
+def train(
+    base_model_path: str,
+    data_path: str,
+    output_dir: str,
+    *,
+    epochs: int = 1,
+    max_steps: int = 0,
+    batch_size: int = 4,
+    grad_accum: int = 4,
+    learning_rate: float = 2e-4,
+    warmup_ratio: float = 0.03,
+    max_seq_len: int = 1024,
+    limit: int = 0,
+    packing: bool = False,
+    gradient_checkpointing: bool = False,
+    adapter_config: str = DEFAULT_ADAPTER_CONFIG,
+    lora_r: int = 0,
+    seed: int = 42,
+    log_every: int = 1,
+):
     """
-    Mock training loop.
-    TODO: Implement PEFT/LoRA training using transformers.Trainer.
+    LoRA SFT loop. Returns the trained PeftModel.
     """
-    print("[MOCK] Starting training...")
+    torch.manual_seed(seed)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.bfloat16 if device == "cuda" else torch.float32
+
+    print("[INFO] Starting training...")
     print(f"       Base Model: {base_model_path}")
     print(f"       Data: {data_path}")
-    steps = 5
-    for i in range(steps):
-        print(f"[MOCK] Step {i + 1}/{steps} - Loss: {0.9 - i * 0.1:.4f}")
-        time.sleep(0.5)  # Simulate work
+    tokenizer = AutoTokenizer.from_pretrained(base_model_path, trust_remote_code=True)
+    pad_id = tokenizer.pad_token_id
+    if pad_id is None:
+        pad_id = tokenizer.eos_token_id
+
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model_path, trust_remote_code=True, torch_dtype=dtype
+    ).to(device)
+    if gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+        model.enable_input_require_grads()
+        model.config.use_cache = False
+
+    lora_config = load_lora_config(adapter_config, r=lora_r)
+    model = get_peft_model(model, lora_config)
+    model.print_trainable_parameters()
+
+    dataset = load_or_build(tokenizer, jsonl_files(data_path), SYSTEM_PROMPT)
+    indices = select_examples(dataset, limit)
+    if not len(indices):
+        raise ValueError(f"No input/output records found in '{data_path}'")
+    lengths = np.minimum(
+        dataset.lengths("prompt_ids")[indices] + dataset.lengths("answer_ids")[indices],
+        max_seq_len,
+    )
+    print(f"[INFO] Loaded {len(indices)} cached examples (packing={packing})")
+
+    if packing:
+        batches_per_epoch = math.ceil(
+            math.ceil(int(lengths.sum()) / max_seq_len) / batch_size
+        )
+    else:
+        batches_per_epoch = math.ceil(len(indices) / batch_size)
+
+    def epoch_batches(epoch):
+        if packing:
+            yield from packed_batches(
+                dataset, indices, batch_size, max_seq_len, seed + epoch
+            )
+            return
+        for batch in length_grouped_batches(indices, lengths, batch_size, seed + epoch):
+            yield [build_example(dataset, i, max_seq_len) for i in batch]
+
+    steps_per_epoch = math.ceil(batches_per_epoch / grad_accum)
+    total_steps = max_steps or steps_per_epoch * epochs
+    optimizer = torch.optim.AdamW(
+        (p for p in model.parameters() if p.requires_grad), lr=learning_rate
+    )
+    scheduler = get_linear_schedule_with_warmup(
+        optimizer, int(total_steps * warmup_ratio), total_steps
+    )
+
+    model.train()
+    step = 0
+    epoch = 0
+    window_micro = window_tokens = window_samples = 0
+    window_loss = 0.0
+    window_start = time.perf_counter()
+    while step < total_steps:
+        for index, batch in enumerate(epoch_batches(epoch)):
+            inputs = {k: v.to(device) for k, v in collate(batch, pad_id).items()}
+            loss = model(**inputs).loss
+            (loss / grad_accum).backward()
+            window_loss += loss.item()
+            window_micro += 1
+            window_tokens += int(inputs["attention_mask"].sum())
+            window_samples += len(batch)
+            # Step every `grad_accum` micro-batches and at the end of an epoch.
+            if (index + 1) % grad_accum and index + 1 < batches_per_epoch:
+                continue
+
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
+            step += 1
 
-    print(f"[MOCK] Training complete. Saving adapters to '{output_dir}'...")
-    # Simulate saving
-    import os
+            if step % log_every == 0 or step == total_steps:
+                elapsed = time.perf_counter() - window_start
+                print(
+                    f"[INFO] Step {step}/{total_steps} (epoch {epoch + 1}) - "
+                    f"Loss: {window_loss / window_micro:.4f} - "
+                    f"lr {scheduler.get_last_lr()[0]:.2e} - "
+                    f"{window_tokens / elapsed:.1f} tokens/s - "
+                    f"{window_samples / elapsed:.2f} samples/s"
+                )
+                window_micro = window_tokens = window_samples = 0
+                window_loss = 0.0
+                window_start = time.perf_counter()
+            if step >= total_steps:
+                break
+        epoch += 1
 
+    print(f"[INFO] Training complete. Saving adapters to '{output_dir}'...")
     os.makedirs(output_dir, exist_ok=True)
-    with open(os.path.join(output_dir, "adapter_config.json"), "w") as f:
-        f.write("{}")
+    model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    return model
 
 
 if __name__ == "__main__":
@@ -43,6 +273,44 @@ if __name__ == "__main__":
     parser.add_argument("--base_model", default="app/models/base")
     parser.add_argument("--data", default="app/data/train")
     parser.add_argument("--output", default="app/models/lora_output")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument(
+        "--max-steps", type=int, default=0, help="Stop after N optimizer steps"
+    )
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--grad-accum", type=int, default=4)
+    parser.add_argument("--lr", type=float, default=2e-4)
+    parser.add_argument("--max-seq-len", type=int, default=1024)
+    parser.add_argument(
+        "--limit", type=int, default=0, help="Use only the first N records"
+    )
+    parser.add_argument(
+        "--packing",
+        action="store_true",
+        help="Pack examples into full-length rows instead of length-grouped batches",
+    )
+    parser.add_argument("--gradient-checkpointing", action="store_true")
+    parser.add_argument("--adapter-config", default=DEFAULT_ADAPTER_CONFIG)
+    parser.add_argument("--lora-r", type=int, default=0, help="Override LoRA rank")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-every", type=int, default=1)
     args = parser.parse_args()
 
-    train(args.base_model, args.data, args.output)
+    train(
+        args.base_model,
+        args.data,
+        args.output,
+        epochs=args.epochs,
+        max_steps=args.max_steps,
+        batch_size=args.batch_size,
+        grad_accum=args.grad_accum,
+        learning_rate=args.lr,
+        max_seq_len=args.max_seq_len,
+        limit=args.limit,
+        packing=args.packing,
+        gradient_checkpointing=args.gradient_checkpointing,
+        adapter_config=args.adapter_config,
+        lora_r=args.lora_r,
+        seed=args.seed,
+        log_every=args.log_every,
+    )
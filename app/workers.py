@@ -0,0 +1,326 @@
+"""
+app/workers.py
+
+Purpose:
+    Multi-process serving mode. `WorkerPool` starts N model-worker processes,
+    each loading its own copy of the models with a bounded torch thread
+    count (and optionally pinned to its own slice of CPU cores), so decode
+    loops run in parallel instead of sharing one interpreter's GIL. The
+    FastAPI front end routes every request to the least-loaded worker over
+    multiprocessing queues and streams the chunks back as they arrive.
+
+Inputs:
+    - `SERVE_WORKERS`: number of worker processes (0 = serve in-process).
+    - `WORKER_THREADS`: torch threads per worker (default: cores / workers).
+    - `WORKER_PIN_CPUS=1`: pin each worker to a disjoint block of cores.
+    - `SHARED_WEIGHTS=1`: workers map one shared copy of the base weights
+      (app/shared_weights.py) instead of loading their own.
+
+Outputs:
+    - `WorkerPool.stream(kind, payload, cancel, timeout)`: an async iterator
+      of response chunks ("chat" -> text, "compare" -> NDJSON lines).
+    - `WorkerPool.call_all(method, *args)`: run an adapter-registry method
+      in every worker (admin endpoints), or collect their metrics, KV block
+      usage or warm-up status.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+from collections.abc import AsyncIterator
+
+from app.scheduler import AsyncSink
+
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", "0"))
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "0"))
+WORKER_PIN_CPUS = os.environ.get("WORKER_PIN_CPUS", "0") == "1"
+
+# How often a waiting stream checks that its worker is still alive and that
+# its request was not cancelled.
+_POLL_SECONDS = 0.5
+
+# Worker side: cancel events of the jobs running in this process.
+_CANCELS: dict[int, threading.Event] = {}
+
+
+class WorkerError(RuntimeError):
+    """
+    An exception raised inside a worker, re-raised in the front end.
+    """
+
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+def _cpu_blocks(workers: int) -> list[list[int]]:
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    if not cpus:
+        cpus = list(range(os.cpu_count() or 1))
+    size = max(1, len(cpus) // workers)
+    return [cpus[i * size : (i + 1) * size] or cpus for i in range(workers)]
+
+
+async def _run_job(job_id: int, kind: str, payload: dict, outbox):
+    # Imported here so the front-end process never loads model code.
+    from app.comparison import astream_compare
+    from app.inference import astream_response
+
+    cancel = _CANCELS[job_id]
+    timeout = payload.get("timeout")
+    try:
+        if kind == "chat":
+            chunks = astream_response(payload["message"], cancel, timeout)
+        elif kind == "compare":
+            chunks = astream_compare(
+                payload["message"],
+                payload.get("adapter"),
+                cancel,
+                timeout,
+                payload.get("profile"),
+            )
+        else:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        async for chunk in chunks:
+            if cancel.is_set():
+                break
+            outbox.put((job_id, "chunk", chunk))
+        outbox.put((job_id, "done", None))
+    except Exception as exc:  # noqa: BLE001
+        outbox.put((job_id, "error", (type(exc).__name__, str(exc))))
+    finally:
+        _CANCELS.pop(job_id, None)
+
+
+def _run_call(job_id: int, method: str, args: tuple, outbox):
+    from app.comparison import get_registry
+    from app.loading import WARMUP
+    from app.metrics import METRICS
+    from app.scheduler import kv_stats
+
+    try:
+        if method == "metrics":
+            result = METRICS.snapshot()
+        elif method == "ready":
+            result = WARMUP.snapshot()
+        elif method == "kv":
+            result = kv_stats()
+        else:
+            result = getattr(get_registry(), method)(*args)
+        outbox.put((job_id, "result", result))
+    except Exception as exc:  # noqa: BLE001
+        outbox.put((job_id, "error", (type(exc).__name__, str(exc))))
+
+
+def _worker_main(index: int, inbox, outbox, threads: int, cpus: list[int] | None):
+    """
+    Worker process entry point: start loading models, serve jobs until None.
+
+    Streaming jobs run as coroutines on one event-loop thread, so
+    concurrent requests reach the worker's continuous-batching scheduler
+    together without a thread each; registry calls get a thread.
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    import torch
+
+    torch.set_num_threads(threads)
+    print(f"[worker {index}] pid={os.getpid()} threads={threads} cpus={cpus or 'all'}")
+
+    from app.comparison import load_models_in_background
+
+    # Jobs and readiness calls are served while the models load.
+    load_models_in_background()
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="jobs", daemon=True).start()
+    while True:
+        job = inbox.get()
+        if job is None:
+            break
+        job_id, kind, body = job
+        if kind == "cancel":
+            event = _CANCELS.get(job_id)
+            if event is not None:
+                event.set()
+            continue
+        if kind == "call":
+            threading.Thread(
+                target=_run_call, args=(job_id, *body, outbox), daemon=True
+            ).start()
+            continue
+        _CANCELS[job_id] = threading.Event()
+        asyncio.run_coroutine_threadsafe(_run_job(job_id, kind, body, outbox), loop)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+class WorkerPool:
+    """
+    N model-worker processes behind least-loaded routing.
+    """
+
+    def __init__(
+        self,
+        workers: int = SERVE_WORKERS,
+        threads: int = WORKER_THREADS,
+        pin_cpus: bool = WORKER_PIN_CPUS,
+    ):
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.pin_cpus = pin_cpus
+        self._context = mp.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._inboxes = []
+        self._processes = []
+        self._load = [0] * workers
+        self._jobs: dict[int, queue.Queue] = {}
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._reader = None
+
+    def start(self):
+        blocks = _cpu_blocks(self.workers) if self.pin_cpus else [None] * self.workers
+        for index in range(self.workers):
+            inbox = self._context.Queue()
+            process = self._context.Process(
+                target=_worker_main,
+                args=(index, inbox, self._outbox, self.threads, blocks[index]),
+                name=f"model-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._inboxes.append(inbox)
+            self._processes.append(process)
+        self._reader = threading.Thread(
+            target=self._read, name="worker-pool-reader", daemon=True
+        )
+        self._reader.start()
+        print(
+            f"[INFO] Started {self.workers} model workers ({self.threads} threads each)"
+        )
+
+    def stop(self):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._outbox.put(None)
+
+    def _read(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                return
+            job_id = message[0]
+            with self._lock:
+                sink = self._jobs.get(job_id)
+            if sink is not None:
+                sink.put(message[1:])
+
+    def _open(self, worker: int | None = None, sink=None) -> tuple:
+        sink = sink if sink is not None else queue.Queue()
+        with self._lock:
+            if worker is None:
+                worker = min(range(self.workers), key=lambda i: self._load[i])
+            job_id = next(self._job_ids)
+            self._jobs[job_id] = sink
+            self._load[worker] += 1
+        return worker, job_id, sink
+
+    def _close(self, worker: int, job_id: int):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._load[worker] -= 1
+
+    def _wait(self, worker: int, sink: queue.Queue):
+        while True:
+            try:
+                return sink.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                self._check_alive(worker)
+
+    def _check_alive(self, worker: int):
+        if not self._processes[worker].is_alive():
+            raise WorkerError("WorkerDied", f"Model worker {worker} exited")
+
+    async def stream(
+        self,
+        kind: str,
+        payload: dict,
+        cancel: threading.Event | None = None,
+        timeout: float | None = None,
+    ) -> AsyncIterator[str]:
+        """
+        Run a "chat" or "compare" job on the least-loaded worker.
+
+        Chunks are awaited on the caller's event loop (the reader thread
+        feeds an `AsyncSink`). Setting `cancel`, or closing the iterator
+        early, stops the job in the worker; `timeout` is the job's
+        generation deadline in seconds.
+        """
+        worker, job_id, sink = self._open(sink=AsyncSink())
+        finished = False
+        try:
+            self._inboxes[worker].put((job_id, kind, {**payload, "timeout": timeout}))
+            while cancel is None or not cancel.is_set():
+                try:
+                    status, value = await asyncio.wait_for(sink.get(), _POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    self._check_alive(worker)
+                    continue
+                if status == "chunk":
+                    yield value
+                    continue
+                finished = True
+                if status == "done":
+                    return
+                raise WorkerError(*value)
+        finally:
+            if not finished:
+                self._inboxes[worker].put((job_id, "cancel", None))
+            self._close(worker, job_id)
+
+    def call_all(self, method: str, *args) -> list:
+        """
+        Call `get_registry().<method>(*args)` in every worker ("metrics",
+        "ready" and "kv" return each worker's metrics, warm-up snapshot and
+        KV block usage instead).
+
+        Returns the per-worker results; the first worker error is re-raised
+        as WorkerError after all workers have answered.
+        """
+        jobs = []
+        for worker in range(self.workers):
+            _, job_id, sink = self._open(worker)
+            self._inboxes[worker].put((job_id, "call", (method, args)))
+            jobs.append((worker, job_id, sink))
+        results, error = [], None
+        for worker, job_id, sink in jobs:
+            try:
+                status, value = self._wait(worker, sink)
+            except WorkerError as exc:
+                status, value = "error", (exc.kind, str(exc))
+            finally:
+                self._close(worker, job_id)
+            if status == "error":
+                error = error or WorkerError(*value)
+            else:
+                results.append(value)
+        if error is not None:
+            raise error
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "alive": sum(process.is_alive() for process in self._processes),
+                "in_flight": list(self._load),
+            }